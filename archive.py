@@ -0,0 +1,593 @@
+"""
+Archive: Write Duo log rows to daily JSON-line files
+"""
+
+import gzip
+import json
+import os
+import re
+import time
+
+import oplog
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Skip json.dumps' per call keyword handling, the output is the same
+encode = json.JSONEncoder().encode
+
+# Most rows in one indexed chunk (a frame, when compressed), bounding
+# what a reader has to read to get at any one row
+FRAME_ROWS = 1000
+
+# Compressed formats, by file name extension
+FORMATS = ('gz', 'zst')
+
+# A file rolling up the days from one %y%m%d to another, always compressed
+rollup_re = re.compile(r'^([0-9]{6})-([0-9]{6})\.(' + '|'.join(FORMATS) + r')$')
+
+
+def compressor(fmt):
+    """
+    Returns a function compressing bytes into one self-contained frame
+    """
+    if fmt == 'gz':
+        return gzip.compress
+    if fmt == 'zst':
+        if zstandard is None:
+            raise RuntimeError('The zst archive format needs the zstandard package')
+        return zstandard.ZstdCompressor().compress
+    raise ValueError('Unknown archive format {fmt}'.format(fmt = fmt))
+
+
+def decompressor(fmt):
+    """
+    Returns a function decompressing one frame written by compressor(fmt)
+    """
+    if fmt == 'gz':
+        return gzip.decompress
+    if fmt == 'zst':
+        if zstandard is None:
+            raise RuntimeError('The zst archive format needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    raise ValueError('Unknown archive format {fmt}'.format(fmt = fmt))
+
+
+def day_bounds(timestamp):
+    """
+    Returns the local midnight epochs that start and end the day holding timestamp
+    """
+    tm = time.localtime(timestamp)
+    start = time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday, 0, 0, 0, 0, 0, -1))
+    end = time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+    return start, end
+
+
+def row_keys(row):
+    """
+    The usernames and devices a row can be looked up by, as "u:name" and
+    "d:device", for both the v1 and v2 log layouts
+    """
+    if isinstance(row, Row):
+        return row.keys
+    keys = []
+    user = row.get('username') or (row.get('user') or {}).get('name')
+    if user:
+        keys.append('u:' + user)
+    device = row.get('device') or (row.get('auth_device') or {}).get('name')
+    if device:
+        keys.append('d:' + device)
+    return keys
+
+
+def row_facts(row):
+    """
+    (result, reason, factor, application, user) of a row in either the v1
+    or the v2 authentication log layout, what tally.py counts it by
+    """
+    if isinstance(row, Row):
+        return row.facts
+    application = row.get('integration') or (row.get('application') or {}).get('name')
+    user = row.get('username') or (row.get('user') or {}).get('name')
+    return (row.get('result') or '', row.get('reason') or '', row.get('factor') or '', application or '', user)
+
+
+class Row:
+    """
+    A fetched row kept as the JSON text it came in, see pages.py, with the
+    few fields collection needs pulled out.  It answers get() like the
+    decoded dict would, decoding its line for any other field.
+
+    timestamp: Integer -- The row's timestamp, or 0
+    txid:      String  -- Its v2 transaction id, or None
+    isotimestamp: String -- Its v2 time to the millisecond, or None
+    keys:      List    -- Its row_keys()
+    facts:     Tuple   -- Its row_facts(), for the tallies
+    line:      String  -- Its JSON, on one line
+    """
+    __slots__ = ('timestamp', 'txid', 'isotimestamp', 'keys', 'facts', 'line')
+
+    def __init__(self, obj, line):
+        self.timestamp = obj.get('timestamp', 0)
+        self.txid = obj.get('txid')
+        self.isotimestamp = obj.get('isotimestamp')
+        self.keys = row_keys(obj)
+        self.facts = row_facts(obj)
+        self.line = line
+
+    def decode(self):
+        return json.loads(self.line)
+
+    def get(self, name, default = None):
+        if name == 'timestamp':
+            return self.timestamp
+        if name in ('txid', 'isotimestamp'):
+            value = getattr(self, name)
+            return default if value is None else value
+        return self.decode().get(name, default)
+
+    def __getitem__(self, name):
+        value = self.get(name, KeyError)
+        if value is KeyError:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name, KeyError) is not KeyError
+
+
+def row_line(row):
+    """
+    The JSON line a row is archived as
+    """
+    if isinstance(row, Row):
+        return row.line
+    return encode(row)
+
+
+def load_index(fname):
+    """
+    Returns the index entries of a daily file, dropping any that point
+    past the end of the file
+    """
+    try:
+        size = os.path.getsize(fname)
+        with open(fname + '.idx') as fp:
+            lines = fp.readlines()
+    except FileNotFoundError:
+        return []
+
+    index = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            break
+        if entry['offset'] + entry['length'] > size:
+            break
+        index.append(entry)
+    return index
+
+
+def scan_index(fp, offset = 0):
+    """
+    Build index entries for the complete lines of a plain daily file from
+    offset on, for files (or parts of them) written before we kept an index
+    """
+    fp.seek(offset)
+    index = []
+    lines = []
+    for line in fp:
+        if not line.endswith(b'\n'):
+            break
+        lines.append(line)
+        if len(lines) == FRAME_ROWS:
+            index.append(index_entry(lines, offset))
+            offset = offset + index[-1]['length']
+            lines = []
+    if lines:
+        index.append(index_entry(lines, offset))
+    return index
+
+
+def index_entry(lines, offset):
+    length = 0
+    for line in lines:
+        length = length + len(line)
+    return {
+        't0': json.loads(lines[0]).get('timestamp', 0),
+        't1': json.loads(lines[-1]).get('timestamp', 0),
+        'offset': offset,
+        'length': length,
+        'rows': len(lines),
+    }
+
+
+def load_keys(fname):
+    """
+    Returns {offset: set of keys} for the chunks of a daily file written
+    with a key index
+    """
+    keys = {}
+    try:
+        with open(fname + '.keys') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                keys[entry['offset']] = set(entry['keys'])
+    except FileNotFoundError:
+        pass
+    return keys
+
+
+def day_files(dirname, day):
+    """
+    The daily files, in any format, for the day starting at midnight day
+    """
+    base = time.strftime(dirname + '/%y%m%d', time.localtime(day))
+    return [fname for fname in [base] + [base + '.' + fmt for fmt in FORMATS] if os.path.exists(fname)]
+
+
+def rollups(dirname):
+    """
+    (start, end, fname) for each file rolling up whole days in dirname,
+    start and end being the midnights starting its first day and ending
+    its last, oldest first
+    """
+    found = []
+    try:
+        names = os.listdir(dirname)
+    except FileNotFoundError:
+        return found
+    for name in names:
+        m = rollup_re.match(name)
+        if m:
+            first = time.mktime(time.strptime(m.group(1), '%y%m%d'))
+            last = time.mktime(time.strptime(m.group(2), '%y%m%d'))
+            found.append((day_bounds(first)[0], day_bounds(last)[1], os.path.join(dirname, name)))
+    return sorted(found)
+
+
+def files(dirname, start, end):
+    """
+    The files, daily or rolled up, that may hold rows with start <=
+    timestamp < end, oldest first and each once.  A day that has been
+    rolled up is only read from the rollup, even if its own file is still
+    around.
+    """
+    rolled = rollups(dirname)
+    found = []
+    day = day_bounds(start)[0]
+    while day < end:
+        covering = [entry for entry in rolled if entry[0] <= day < entry[1]]
+        if covering:
+            found.append(covering[0][2])
+            day = covering[0][1]
+            continue
+        found.extend(day_files(dirname, day))
+        day = day_bounds(day)[1]
+    return found
+
+
+def read_tail(fname):
+    """
+    Returns (offset, bytes) for the .tail of a compressed daily file: the
+    complete lines of the rows waiting to make up a frame, and the offset
+    that frame goes at.  None if there is no tail.
+    """
+    try:
+        with open(fname + '.tail', 'rb') as fp:
+            header = fp.readline()
+            data = fp.read()
+        offset = json.loads(header)['offset']
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    return offset, data[:data.rfind(b'\n') + 1]
+
+
+def tail_entry(index, tail):
+    """
+    An index entry for the rows of tail, read_tail()'s, that aren't framed
+    yet, or None.  A tail whose frame is in index has been framed since.
+    """
+    if not tail or not tail[1] or any(entry['offset'] == tail[0] for entry in index):
+        return None
+    entry = index_entry(tail[1].splitlines(True), tail[0])
+    entry['tail'] = True
+    return entry
+
+
+def read_entries(fname, start = None, end = None, key = None):
+    """
+    Yield (index entry, decompressed bytes) for each indexed chunk of a
+    daily or rolled up file that may hold rows with start <= timestamp <
+    end and, if the file has a key index, rows with the given key.
+    Everything else is skipped with a seek.  Plain files without an index
+    are indexed on the fly, and the rows in a compressed file's .tail come
+    last.
+    """
+    fmt = fname.rsplit('.', 1)[-1] if '.' in os.path.basename(fname) else None
+    decompress = decompressor(fmt) if fmt else None
+    # The tail before the index: its rows are framed and indexed before
+    # it is replaced, so one of the two has them
+    tail = read_tail(fname) if fmt else None
+    index = load_index(fname)
+    keys = load_keys(fname) if key else {}
+    with open(fname, 'rb') as fp:
+        if not fmt:
+            end_of_index = index[-1]['offset'] + index[-1]['length'] if index else 0
+            index = index + scan_index(fp, end_of_index)
+        for entry in index:
+            if start is not None and entry['t1'] < start:
+                continue
+            if end is not None and entry['t0'] >= end:
+                break
+            if key and entry['offset'] in keys and key not in keys[entry['offset']]:
+                continue
+            fp.seek(entry['offset'])
+            data = fp.read(entry['length'])
+            yield entry, decompress(data) if decompress else data
+    entry = tail_entry(index, tail)
+    if entry and not (start is not None and entry['t1'] < start) and not (end is not None and entry['t0'] >= end):
+        yield entry, tail[1]
+
+
+def read_chunks(fname, start = None, end = None, key = None):
+    """
+    Yield the (decompressed) bytes of each chunk read_entries() would
+    """
+    for entry, data in read_entries(fname, start, end, key):
+        yield data
+
+
+class DailyArchive:
+    """
+    Appends rows to one file per local day, named {dirname}/%y%m%d, one
+    JSON object per line.  Rows are expected in timestamp order; each batch
+    is serialized in one pass and written with one write per day it spans.
+
+    Every chunk of up to FRAME_ROWS rows gets a line in the file's .idx
+    side file giving its first and last timestamps, offset, length and row
+    count, so readers can seek straight to the rows they want.  With keys
+    set, a line listing the usernames and devices (see row_keys) in each
+    chunk also goes to a .keys side file.
+
+    With a compressed format the file is named {dirname}/%y%m%d.{fmt} and
+    each chunk is a separate gzip member or zstd frame, so the file as a
+    whole still decompresses with zcat or zstdcat.  A compressed chunk only
+    counts once it is in the index; one that never made it there is cut
+    off when the file is next opened.  A plain file just has any lines
+    past the end of its index indexed then, so files from before we kept
+    indexes pick one up.
+
+    A few rows a poll would make frames too small to compress, so rows
+    of a compressed file wait as plain lines in its .tail until there are
+    FRAME_ROWS of them, or the file is closed.  The .tail starts with a
+    line giving the offset their frame will go at; it is only replaced
+    once that frame is in the index, so a reader reading the tail before
+    the index sees the rows in one or the other.
+
+    dirname:   String  -- Directory holding the daily files
+    fmt:       String  -- Compressed format, or None for plain JSON lines
+    keys:      Boolean -- Keep a .keys index too
+    fname:     String  -- Current daily file, or None
+    fp:        File    -- Open handle on fname
+    idx:       File    -- Open handle on fname's .idx file
+    kfp:       File    -- Open handle on fname's .keys file, if keys
+    fsync:     Boolean -- Sync each day's files to disk as we close them
+    written:   Integer -- Bytes written to daily files, for the metrics
+    on_close:  List    -- Called with the name of each day's file once we
+                          move on to a later day
+    start:     time_t  -- Midnight starting the current file's day
+    end:       time_t  -- Midnight ending the current file's day
+    pending:   List    -- (line, row) of the rows in the .tail
+    tfp:       File    -- Open handle on fname's .tail, if compressed
+    """
+    def __init__(self, dirname, fmt = None, keys = False):
+        self.dirname = dirname
+        self.fmt = fmt
+        self.keys = keys
+        self.compress = compressor(fmt) if fmt else None
+        self.fname = None
+        self.fp = None
+        self.idx = None
+        self.kfp = None
+        self.fsync = False
+        self.written = 0
+        self.on_close = []
+        self.start = 0
+        self.end = 0
+        self.pending = []
+        self.tfp = None
+
+    def advance(self, timestamp):
+        """
+        Switch to the daily file covering timestamp
+        """
+        finished = self.fname if self.fname and timestamp >= self.end else None
+        self.close()
+        for func in self.on_close if finished else []:
+            func(finished)
+        self.start, self.end = day_bounds(timestamp)
+        self.fname = time.strftime(self.dirname + '/%y%m%d', time.localtime(timestamp))
+        if self.fmt:
+            self.fname = self.fname + '.' + self.fmt
+        self.fp = open(self.fname, 'ab')
+        self.recover()
+        self.idx = open(self.fname + '.idx', 'a')
+        if self.keys:
+            self.kfp = open(self.fname + '.keys', 'a')
+        oplog.info('Advancing to {file}', file = os.path.realpath(self.fname))
+
+    def write(self, rows, lines = None):
+        """
+        Append a batch of rows, given their JSON lines or not, returns the
+        lines
+        """
+        if lines is None:
+            lines = [row_line(row) for row in rows]
+        n = len(rows)
+        i = 0
+        while i < n:
+            timestamp = rows[i].get('timestamp', 0)
+            if not self.start <= timestamp < self.end:
+                self.advance(timestamp)
+            start = self.start
+            end = self.end
+            j = i + 1
+            while j < n and start <= rows[j].get('timestamp', 0) < end:
+                j = j + 1
+            self.write_run(rows, lines, i, j)
+            i = j
+        return lines
+
+    def write_run(self, rows, lines, i, j):
+        """
+        Write rows[i:j], all of the current day: in chunks of FRAME_ROWS
+        with one write, then index the chunks.  A compressed file frames
+        them along with the rows in its tail, leaving the rest there.
+        """
+        run = list(zip(lines[i:j], rows[i:j]))
+        if not self.fmt:
+            self.append(run)
+            return
+        n = len(self.pending)
+        self.pending.extend(run)
+        if len(self.pending) < FRAME_ROWS:
+            data = ''.join(line + '\n' for line, row in self.pending[n:]).encode('utf-8')
+            self.tfp.write(data)
+            self.tfp.flush()
+            self.written = self.written + len(data)
+            return
+        self.cut(len(self.pending) - len(self.pending) % FRAME_ROWS)
+
+    def append(self, run):
+        """
+        Write (line, row) pairs in chunks of FRAME_ROWS with one write,
+        then index the chunks
+        """
+        offset = self.fp.tell()
+        chunks = []
+        index = []
+        keys = []
+        for k in range(0, len(run), FRAME_ROWS):
+            part = run[k:k + FRAME_ROWS]
+            chunk = ('\n'.join(line for line, row in part) + '\n').encode('utf-8')
+            if self.compress:
+                chunk = self.compress(chunk)
+            chunks.append(chunk)
+            index.append(encode({
+                't0': part[0][1].get('timestamp', 0),
+                't1': part[-1][1].get('timestamp', 0),
+                'offset': offset,
+                'length': len(chunk),
+                'rows': len(part),
+            }) + '\n')
+            if self.keys:
+                found = set()
+                for line, row in part:
+                    found.update(row_keys(row))
+                keys.append(encode({'offset': offset, 'keys': sorted(found)}) + '\n')
+            offset = offset + len(chunk)
+        data = b''.join(chunks)
+        self.fp.write(data)
+        self.fp.flush()
+        self.written = self.written + len(data)
+        self.idx.write(''.join(index))
+        if self.keys:
+            self.kfp.write(''.join(keys))
+
+    def cut(self, n):
+        """
+        Frame the first n rows of the tail, then start the tail over with
+        the rest
+        """
+        self.append(self.pending[:n])
+        # Indexed before the tail goes, see read_entries()
+        self.idx.flush()
+        if self.kfp:
+            self.kfp.flush()
+        self.pending = self.pending[n:]
+        self.retail()
+
+    def retail(self):
+        """
+        Write the .tail afresh for the pending rows, their frame going at
+        the end of the file
+        """
+        if self.tfp:
+            self.tfp.close()
+        header = encode({'offset': self.fp.tell()}) + '\n'
+        with open(self.fname + '.tail.tmp', 'w') as fp:
+            fp.write(header + ''.join(line + '\n' for line, row in self.pending))
+        os.rename(self.fname + '.tail.tmp', self.fname + '.tail')
+        self.tfp = open(self.fname + '.tail', 'ab')
+
+    def recover(self):
+        """
+        Bring the file and its index back in line after a crash.  Index
+        entries for chunks that never made it to the file are dropped.  A
+        compressed file is cut back to the end of its last indexed frame; a
+        plain one loses any partial last line and has the complete lines
+        past its index indexed.
+        """
+        index = load_index(self.fname)
+        end = index[-1]['offset'] + index[-1]['length'] if index else 0
+        size = self.fp.seek(0, os.SEEK_END)
+        if size != end and not self.fmt:
+            with open(self.fname, 'rb') as fp:
+                index = index + scan_index(fp, end)
+            end = index[-1]['offset'] + index[-1]['length'] if index else 0
+        if size != end:
+            oplog.warning('Truncating {file} from {size} to {end}', file = os.path.realpath(self.fname), size = size, end = end)
+            self.fp.truncate(end)
+            self.fp.seek(end)
+        with open(self.fname + '.idx', 'w') as fp:
+            fp.write(''.join(encode(entry) + '\n' for entry in index))
+        if self.fmt:
+            # The tail's rows, unless a frame of them made it to the index
+            tail = read_tail(self.fname)
+            self.pending = []
+            if tail_entry(index, tail):
+                self.pending = [(line, json.loads(line)) for line in tail[1].decode('utf-8').splitlines()]
+            self.retail()
+
+    def flush(self):
+        for fp in (self.fp, self.idx, self.kfp, self.tfp):
+            if fp:
+                fp.flush()
+
+    def sync(self):
+        """
+        Flush the file and its side files and force them to disk
+        """
+        self.flush()
+        for fp in (self.fp, self.idx, self.kfp, self.tfp):
+            if fp:
+                os.fsync(fp.fileno())
+
+    def close(self):
+        """
+        Close the current file, framing whatever is in its tail
+        """
+        if self.tfp and self.pending:
+            self.cut(len(self.pending))
+        if self.fsync:
+            self.sync()
+        for fp in (self.fp, self.idx, self.kfp, self.tfp):
+            if fp:
+                fp.close()
+        if self.tfp:
+            os.remove(self.fname + '.tail')
+        self.fp = None
+        self.idx = None
+        self.kfp = None
+        self.tfp = None
+        self.pending = []
+        self.fname = None
+        self.start = 0
+        self.end = 0
@@ -8,6 +8,7 @@ import errno
 import json
 import os
 import re
+import selectors
 import socket
 import signal
 import sys
@@ -16,9 +17,22 @@ import time
 from time import localtime, strftime
 from threading import Thread, Event
 
+import oplog
+
 getSeq = re.compile(r'(^[0-9 ]*)(.*)')
 res_fmt = '{seq}P{alert}{status}\n\n{threads}'
-thread_re = re.compile(r'^thread ([a-z]+) ([a-zA-Z_0-9]+)[ ]*([a-zA-Z_0-9]+)*[ ]*([a-zA-Z_0-9]+)*')
+thread_re = re.compile(r'^thread ([a-z][a-zA-Z_0-9.-]*) ([a-zA-Z_0-9]+)[ ]*([a-zA-Z_0-9]+)*[ ]*([a-zA-Z_0-9]+)*')
+reply_re = re.compile(r'^P([0-9])(.*)', re.S)
+
+# Seconds the reporters' lines are reused in status replies
+REPORT_SECONDS = 5
+
+# Seconds between calls of the pollers
+POLL_SECONDS = 10
+
+# Seconds a TCP client has to send its query, and most bytes it may send
+QUERY_TIMEOUT = 10
+QUERY_BYTES = 65536
 
 class Argus_termination(Exception):
     pass
@@ -31,57 +45,177 @@ class Argus_thread:
     alert:     Integer -- Argus alert level for thread
     auto:      Boolean -- Auto start
     count:     Integer -- Number of cycles performed
+    group:     String  -- Group for status roll ups (None for ungrouped)
     handle:    Nonspec -- Thread specific
     interval:  Integer -- Cycle period in seconds
     maxcount:  Integer -- Maximum number of cycles (-1 for infinite)
     name:      String  -- Thread name
     resource:  String  -- Thread specific
+    restarting: Boolean -- A restart is under way in the background
     status:    String  -- Thread specific status message
     target:    Module  -- Thread loop processor
     terminate: Event   -- Thread termination control
     thread:    Thread  -- Thread instance
     timestamp: time_t  -- Last cycle timestamp
+
+    Setting active, alert or status bumps Argus_thread.generation, which
+    tells the Argus its cached status reply is out of date.
     """
+    generation = 0
+
     def __init__(self, name, resource, target,
                  maxcount = -1,
                  interval = 90,
-                 auto = True):
+                 auto = True,
+                 group = None):
         self.active = False
         self.alert = 0
         self.auto = auto
         self.count = 0
+        self.group = group
         self.handle = None
         self.interval = interval
         self.maxcount = maxcount
         self.name = name
         self.resource = resource
+        self.restarting = False
         self.status = 'Starting'
         self.target = target
         self.terminate = Event()
         self.thread = None
         self.timestamp = time.time()
 
+    def changed(self):
+        Argus_thread.generation = Argus_thread.generation + 1
+
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, value):
+        self._active = value
+        self.changed()
+
+    @property
+    def alert(self):
+        return self._alert
+
+    @alert.setter
+    def alert(self, value):
+        self._alert = value
+        self.changed()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+        self.changed()
+
+
+class Thread_runner:
+    """
+    Runs each Argus_thread's target loop in its own OS thread.  An Argus
+    hands all thread starts and stops to its runner, so a different runner
+    can schedule the same Argus_threads some other way.
+    """
+    def start(self, tp):
+        """
+        Start tp's target, raising an exception if that fails
+        """
+        tp.terminate.clear()
+        tp.count = 0
+        tp.thread = Thread(target=tp.target, args=(tp,), name=tp.name)
+        tp.thread.start()
+        tp.active = True
+
+    def stop(self, tp, timeout = 10.0):
+        """
+        Ask tp's target to stop, returns False if it wouldn't
+        """
+        tp.terminate.set()
+        tp.thread.join(timeout)
+        if tp.thread.is_alive():
+            return False
+        tp.active = False
+        tp.thread = None
+        return True
+
+    def background(self, func, *args):
+        """
+        Run func, which may block on stop(), without holding up the Argus
+        """
+        Thread(target = func, args = args, daemon = True).start()
+
+
+class Query:
+    """
+    One TCP client of the Argus: the query line it is sending us, then
+    the JSON reply we are sending back before we hang up
+    """
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.data = b''
+        self.out = b''
+        self.deadline = time.time() + QUERY_TIMEOUT
+
+
+class Message(str):
+    """
+    A query for our caller to answer, which also knows who asked it, so
+    the answer goes back to the right place whatever came in since.
+
+    seq:       String  -- The query's sequence number, put before the answer
+    addr:      Tuple   -- Address the query came from
+    reply:     Function -- Takes the JSON reply to a TCP client, None over UDP
+    """
+    def __new__(cls, text, seq, addr, reply = None):
+        msg = str.__new__(cls, text)
+        msg.seq = seq
+        msg.addr = addr
+        msg.reply = reply
+        return msg
+
 
 class Argus:
     """
     Instantiating the Argus class will start up the daemon and any
     auto start threads.  The main thread should then call getMessage()
-    in a loop to service the Argus queries.  The argus_cf file in
-    the starting directory contains the following:
+    in a loop to service the Argus queries.  The argus_cf file, in
+    the starting directory unless given, contains the following:
 
     {
         'addr':     '',                     # Server source IP address
         'port':     2680,                   # Server port
+        'tcp_port': 2680,                   # TCP/JSON query port, the same as port by default
+        'tcp_addr': '127.0.0.1',            # TCP/JSON query address, localhost by default
         'rundir':   '/usr/tmp'              # Directory to cd to
         'logfile':  'log',                  # File for query records/issues
         'pidfile':  '/var/run/xxx.pid',     # For daemon stopping
     }
+
+    Both sockets are served by one selector loop, which hands each query
+    to our caller and has it answered before the next is read.  Status replies come
+    from a snapshot that is only rebuilt when a thread's state changes,
+    and stopping or restarting a thread happens in the background, so a
+    status query is never kept waiting.
     """
-    def __init__(self, threads=[]):
+    def __init__(self, threads=[], runner=None, cf_path='argus_cf'):
         """
         threads: An array of type Argus_thread
+        runner:  Starts and stops the threads, a Thread_runner by default
+        cf_path: Our argus_cf file
+
+        Functions added to the reporters list are called for extra lines
+        to add to the end of status replies.  Functions added to the
+        pollers list are called every POLL_SECONDS from the main loop.
         """
-        with open('argus_cf') as fp:
+        self.cf_path = os.path.abspath(cf_path)
+        with open(self.cf_path) as fp:
             cf = json.load(fp)
 
         pname = sys.argv[0].split('/')[-1].split('.')[0]
@@ -91,10 +225,19 @@ class Argus:
         self.pidfile = cf.get('pidfile', '/var/run/' + pname + '.pid')
         self.port = cf.get('port', 2680)
         self.rundir = cf.get('rundir', '/var/tmp')
+        self.tcp_port = cf.get('tcp_port', self.port)
+        self.reporters = []
+        self.pollers = []
+        self.polled = time.time()
+        self.runner = runner or Thread_runner()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.status = 'Ready'
         self.terminate = False
         self.threads = threads
+        self.pending = []
+        self.snapshot = None
+        self.reports = (0, '')
+        self.queries = {}
 
         try:
             self.sock.bind((cf.get('addr', ''), self.port))
@@ -102,16 +245,30 @@ class Argus:
             sys.stderr.write('Unable to bind to UDP port {port}: {msg}\n'.format(port = self.port, msg = e.strerror))
             sys.exit(1)
 
+        self.tcp = None
+        if self.tcp_port:
+            self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.tcp.bind((cf.get('tcp_addr', '127.0.0.1'), self.tcp_port))
+                self.tcp.listen(16)
+                self.tcp.setblocking(False)
+            except socket.error as e:
+                oplog.warning('Unable to bind to TCP port {port}: {error}', port = self.tcp_port, error = e.strerror)
+                self.tcp.close()
+                self.tcp = None
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self.read_udp)
+        if self.tcp:
+            self.selector.register(self.tcp, selectors.EVENT_READ, self.accept)
+
         signal.signal(signal.SIGINT, self.shutdown)
         signal.signal(signal.SIGTERM, self.shutdown)
 
         os.chdir(self.rundir)
 
-        print('{ts} {pid}: Ready to accept requests on port {port}.'.format(
-            ts = time.strftime('%y-%m-%d %H:%M:%S'),
-            pid = os.getpid(),
-            port = self.port))
-        sys.stdout.flush()
+        oplog.info('Ready to accept requests on port {port}.', port = self.port)
 
     def deamonize(self):
         """
@@ -164,172 +321,346 @@ class Argus:
 
     def getMessage(self):
         """
-        Our main thread should spend all its time here as part of its main loop
+        Our main thread should spend all its time here as part of its main
+        loop, answering each Message returned with sendResponse() before
+        calling again.  The events of one select are handled one at a
+        time, so the rest wait for the next call.
         """
-        sys.stdout.flush()
-        sys.stderr.flush()
-
         while not self.terminate:
             try:
-                bytes, self.addr = self.sock.recvfrom(1024)
+                while self.pending:
+                    key, mask = self.pending.pop(0)
+                    msg = key.data(key.fileobj, mask)
+                    if msg:
+                        return msg
+                self.expire()
+                self.poll()
+                self.pending = self.selector.select(1.0 if self.queries else POLL_SECONDS if self.pollers else None)
             except Argus_termination:
                 continue
-            except IOError as e:
-                if e.errno == errno.EINTR:
-                    continue
-                raise
 
-            if not bytes:
-                continue
+        return None
 
-            cmd = getSeq.match(bytes.decode("utf-8"))
+    def read_udp(self, sock, mask):
+        bytes, addr = sock.recvfrom(1024)
+        return self.dispatch(bytes, addr)
 
-            self.seq = cmd.group(1)
-            self.msg = cmd.group(2)
+    def accept(self, sock, mask):
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:
+            return None
+        conn.setblocking(False)
+        query = Query(conn, addr)
+        self.queries[conn] = query
+        self.selector.register(conn, selectors.EVENT_READ, self.read_tcp)
+        return None
 
-            if len(self.msg) < 1:
-                continue
+    def read_tcp(self, conn, mask):
+        query = self.queries.get(conn)
+        if query is None:
+            return None
+        if mask & selectors.EVENT_WRITE:
+            self.write_tcp(query)
+            return None
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return None
+        except OSError:
+            data = b''
+        if not data:
+            self.hangup(query)
+            return None
+        query.data = query.data + data
+        if b'\n' not in query.data and len(query.data) < QUERY_BYTES:
+            return None
+        line = query.data.split(b'\n', 1)[0]
+
+        def reply(obj):
+            query.out = query.out + (json.dumps(obj) + '\n').encode('utf-8')
+            query.deadline = time.time() + QUERY_TIMEOUT
+            self.selector.modify(conn, selectors.EVENT_WRITE, self.read_tcp)
+
+        return self.query(line, query.addr, reply)
+
+    def write_tcp(self, query):
+        try:
+            sent = query.sock.send(query.out)
+        except BlockingIOError:
+            return
+        except OSError:
+            sent = len(query.out)
+        query.out = query.out[sent:]
+        if not query.out:
+            self.hangup(query)
+
+    def hangup(self, query):
+        self.selector.unregister(query.sock)
+        query.sock.close()
+        del self.queries[query.sock]
+
+    def expire(self):
+        """
+        Hang up on TCP clients that stopped talking or listening
+        """
+        now = time.time()
+        for query in list(self.queries.values()):
+            if now > query.deadline:
+                self.hangup(query)
 
-            # Ack commands will clear our current status
+    def poll(self):
+        """
+        Call the pollers if it's time
+        """
+        now = time.time()
+        if not self.pollers or now < self.polled + POLL_SECONDS:
+            return
+        self.polled = now
+        for poller in self.pollers:
+            try:
+                poller()
+            except Exception:
+                oplog.error('Unhandled exception in a poller', exc = True)
 
-            if self.msg == 'ack' or self.msg == 'clear':
-                self.alert = 0
-                self.status = 'Ready'
-                self.msg = 'status'
+    def query(self, line, addr, reply):
+        """
+        Handle a query line from a TCP client.  The line is either a JSON
+        object like {"query": "status", "seq": "1"} or the bare query, as
+        sent over UDP.  Every reply goes back through reply as a JSON
+        object.  Returns the Message if it is one for our caller to answer
+        with sendResponse(), otherwise None.
+        """
+        text = line.decode('utf-8', 'replace').strip()
+        try:
+            request = json.loads(text)
+        except ValueError:
+            request = None
+        if isinstance(request, dict):
+            text = '{seq}{query}'.format(seq = request.get('seq', ''), query = request.get('query', ''))
 
-            # We'll handle status queries from anywhere...
+        replied = []
 
-            if self.msg[0] == 's':
-                alert = self.alert
-                status = self.status
-                res_threads = ''
-                restart = None
-                for tp in self.threads:
-                    if not tp.active:
-                        res_threads = res_threads + '{name}: Idle\n'.format(name = tp.name)
-                        continue
-                    res_threads = res_threads + '{name}: {status}\n'.format(name = tp.name, status = tp.status)
-                    if alert < tp.alert:
-                        alert = tp.alert
-                    if alert < 6:
-                        if time.time() > tp.timestamp + 4 * tp.interval:
-                            alert = 5
-                            status = 'Dead thread: {name}'.format(name = tp.name)
-                            if tp.auto:
-                                alert = 6
-                                restart = tp
-                            else:
-                                alert = 5
-
-                response = res_fmt.format(seq = self.seq, alert = alert, status = status, threads = res_threads)
-                packet = response.encode("utf-8")
-                self.sock.sendto(packet, self.addr)
-
-                # Should we attempt to auto restart a dead thread??
-
-                if restart:
-                    restart.terminate.set()
-                    restart.thread.join(10.0)
-                    if restart.thread.isAlive():
-                        print('{ts} {pid}: Unable to terminate {name} thread.'.format(
-                            ts = time.strftime('%y-%m-%d %H:%M:%S'),
-                            pid = os.getpid(),
-                            name = restart.name))
-                        sys.stdout.flush()
-                        restart.auto = False
-                    else:
-                        restart.active = False
-                        restart.thread = None
-                        restart.terminate.clear()
-                        restart.count = 0
-                        try:
-                            restart.thread = Thread(target=restart.target, args=(restart,))
-                            restart.thread.start()
-                        except Exception as errtxt:
-                            print('{ts} {pid}: Unable to restart {name}: {msg}'.format(
-                                ts = time.strftime('%y-%m-%d %H:%M:%S'),
-                                pid = os.getpid(),
-                                name = restart.name,
-                                msg = errtxt))
-                            sys.stdout.flush()
-                        else:
-                            print('{ts} {pid}: Restarted {name} thread.'.format(
-                                ts = time.strftime('%y-%m-%d %H:%M:%S'),
-                                pid = os.getpid(),
-                                name = restart.name))
-                            sys.stdout.flush()
-                            restart.active = True
+        def answered(obj):
+            replied.append(obj)
+            reply(obj)
 
-                continue
+        msg = self.dispatch(text.encode('utf-8'), addr, answered)
+        if not msg and not replied:
+            reply({'alert': 5, 'text': 'Unrecognized or refused query'})
+        return msg
+
+    def send(self, text, to, extra = None):
+        """
+        Send a reply to the query to, a Message: the text after the
+        query's sequence number over UDP, or a JSON object to a TCP
+        client, with the alert level split out of the text and any extra
+        fields
+        """
+        if to.reply is None:
+            packet = '{seq}{text}'.format(seq = to.seq, text = text).encode('utf-8')
+            self.sock.sendto(packet, to.addr)
+            return
+        m = reply_re.match(text)
+        obj = {'seq': to.seq.strip(), 'alert': int(m.group(1)) if m else 0, 'text': m.group(2) if m else text}
+        obj.update(extra or {})
+        to.reply(obj)
+
+    def dispatch(self, bytes, addr, reply = None):
+        """
+        Handle one incoming query.  Returns it as a Message if it is one
+        for our caller to answer with sendResponse(), otherwise None.
+        Replies go back over UDP, or through reply for a TCP client.
+        """
+        if not bytes:
+            return None
 
-            # Other requests need to come from our localhost.
+        cmd = getSeq.match(bytes.decode("utf-8"))
 
-            if self.addr[0] != '127.0.0.1':
-                continue
+        msg = Message(cmd.group(2), cmd.group(1), addr, reply)
 
-            # We receive an 'n' to open a new log file
+        if len(msg) < 1:
+            return None
 
-            if self.msg == 'newlog' or self.msg == 'rotate':
-                sys.stdout.flush()
-                sys.stderr.flush()
+        # Ack commands will clear our current status
 
-                sys.stdout.close()
-                sys.stdout = open(self.logfile, 'a+')
+        if msg == 'ack' or msg == 'clear':
+            self.alert = 0
+            self.status = 'Ready'
+            msg = Message('status', msg.seq, addr, reply)
 
-                sys.stderr.close()
-                sys.stderr = open(self.logfile, 'a+')
+        # We'll handle status queries from anywhere...
 
-                fmt = ('{ts} {pid}: Continuing to accept '
-                       'requests on port {port}.')
-                print(fmt.format(ts = time.strftime('%y-%m-%d %H:%M:%S'), pid = os.getpid(), port = self.port))
-                sys.stdout.flush()
+        if msg[0] == 's':
+            alert, status, restart = self.health()
+            body, threads = self.status_body()
+            response = res_fmt.format(seq = '', alert = alert, status = status, threads = body)
+            self.send(response, msg, {'status': status, 'threads': threads})
 
-                response = '{seq}P0Okay\n'.format(seq = self.seq)
-                packet = response.encode("utf-8")
-                self.sock.sendto(packet, self.addr)
-                continue
+            # Should we attempt to auto restart a dead thread??
+
+            if restart and not restart.restarting:
+                restart.restarting = True
+                self.runner.background(self.restart_thread, restart)
+
+            return None
+
+        # Other requests need to come from our localhost.
+
+        if addr[0] != '127.0.0.1':
+            return None
+
+        # We receive an 'n' to open a new log file
+
+        if msg == 'newlog' or msg == 'rotate':
+            # The log's writer thread switches files between two records,
+            # so we never wait on the disk here
+            oplog.reopen(self.logfile)
+            oplog.info('Continuing to accept requests on port {port}.', port = self.port)
+
+            self.send('P0Okay\n', msg)
+            return None
 
-            print('{ts} {pid}: Incoming {msg}'.format(ts = time.strftime('%y-%m-%d %H:%M:%S'), pid = os.getpid(), msg = self.msg))
-            sys.stdout.flush()
+        oplog.info('Incoming {query}', query = msg)
 
-            if self.thread_cmd():
+        if self.thread_cmd(msg):
+            return None
+
+        return msg
+
+    def health(self):
+        """
+        Internal routine working out our overall alert level and status,
+        and which dead thread, if any, to restart
+        """
+        alert = self.alert
+        status = self.status
+        restart = None
+        now = time.time()
+        for tp in self.threads:
+            if not tp.active:
                 continue
+            if alert < tp.alert:
+                alert = tp.alert
+            if alert < 6:
+                if now > tp.timestamp + 4 * tp.interval:
+                    alert = 5
+                    status = 'Dead thread: {name}'.format(name = tp.name)
+                    if tp.auto:
+                        alert = 6
+                        restart = tp
+                    else:
+                        alert = 5
+        return alert, status, restart
 
-            return self.msg
+    def status_body(self):
+        """
+        Internal routine returning the thread and reporter lines of a
+        status reply, and the threads' state for TCP clients.  The thread
+        part is only rebuilt when a thread's state has changed, the
+        reporters' lines every REPORT_SECONDS.
+        """
+        generation = Argus_thread.generation
+        if self.snapshot is None or self.snapshot[0] != generation:
+            lines = [self.rollup()]
+            threads = []
+            for tp in self.threads:
+                lines.append('{name}: {status}\n'.format(name = tp.name, status = tp.status if tp.active else 'Idle'))
+                threads.append({
+                    'name': tp.name,
+                    'group': tp.group,
+                    'active': tp.active,
+                    'alert': tp.alert,
+                    'status': tp.status,
+                    'count': tp.count,
+                    'interval': tp.interval,
+                    'timestamp': tp.timestamp,
+                })
+            self.snapshot = (generation, ''.join(lines), threads)
+
+        now = time.time()
+        if now > self.reports[0] + REPORT_SECONDS:
+            self.reports = (now, ''.join(reporter() for reporter in self.reporters))
+        return self.snapshot[1] + self.reports[1], self.snapshot[2]
+
+    def rollup(self):
+        """
+        Internal routine summarizing the threads of each group when there
+        is more than one group
+        """
+        groups = {}
+        for tp in self.threads:
+            if tp.group is None:
+                continue
+            if tp.group not in groups:
+                groups[tp.group] = [0, 0, 0]
+            summary = groups[tp.group]
+            summary[1] = summary[1] + 1
+            if tp.active:
+                summary[0] = summary[0] + 1
+                if summary[2] < tp.alert:
+                    summary[2] = tp.alert
+        if len(groups) < 2:
+            return ''
+
+        res = []
+        for group in sorted(groups):
+            active, total, alert = groups[group]
+            res.append('{group}: {active}/{total} active alert: {alert}\n'.format(
+                group = group, active = active, total = total, alert = alert))
+        return ''.join(res) + '\n'
+
+    def restart_thread(self, tp):
+        """
+        Internal routine to restart a dead thread, run in the background
+        """
+        try:
+            self.restart(tp)
+        finally:
+            tp.restarting = False
 
-        return None
+    def restart(self, tp):
+        if not self.runner.stop(tp):
+            oplog.error('Unable to terminate {name} thread.', name = tp.name)
+            tp.auto = False
+            return
 
-    def sendResponse(self, message):
+        try:
+            self.runner.start(tp)
+        except Exception as errtxt:
+            oplog.error('Unable to restart {name}: {error}', name = tp.name, error = str(errtxt))
+        else:
+            oplog.warning('Restarted {name} thread.', name = tp.name)
+
+    def sendResponse(self, message, to):
         """
-        Sends a response back to the source of the most recent query
+        Sends a response back to the source of the query to, the Message
+        getMessage() or dispatch() returned
         """
-        response = '{seq}{message}\n'.format(seq = self.seq, message = message)
-        packet = response.encode("utf-8")
-        self.sock.sendto(packet, self.addr)
-        print('{ts} {pid}: Response {msg}'.format(
-            ts = time.strftime('%y-%m-%d %H:%M:%S'),
-            pid = os.getpid(),
-            msg = message))
-        sys.stdout.flush()
+        self.send('{message}\n'.format(message = message), to)
+        oplog.info('Response {response}', response = message)
 
     def shutdown(self, signum, frame):
         """
         Catch some otherwise fatal signals so we can shut ourselves down gracefully
         """
-        print('{ts} {pid}: Shutting down on signal {signum}'.format(
-            ts = time.strftime('%y-%m-%d %H:%M:%S'),
-            pid = os.getpid(),
-            signum = signum))
-        sys.stdout.flush()
+        oplog.info('Shutting down on signal {signum}', signum = signum)
 
         self.terminate = True
         raise Argus_termination()
 
-    def thread_cmd(self):
+    def stop_thread(self, tp):
+        """
+        Internal routine to stop a thread, run in the background
+        """
+        if not self.runner.stop(tp):
+            oplog.error('Thread {name} could not be joined.', name = tp.name)
+
+    def thread_cmd(self, msg):
         """
         Internal routine for handling thread releated requests
         """
-        m = thread_re.match(self.msg)
+        m = thread_re.match(msg)
         if not m:
             return False
 
@@ -337,14 +668,11 @@ class Argus:
         for tp in self.threads:
             if m.group(1) == tp.name:
                 if m.group(2) == 'terminate' or m.group(2) == 'stop':
-                    tp.terminate.set()
-                    tp.thread.join(10.0)
-                    if tp.thread.isAlive():
-                        answer = 'P5Thread {name} could not be joined'.format(name = tp.name)
+                    if not tp.active:
+                        answer = 'P5Thread {name} is not active.'.format(name = tp.name)
                     else:
-                        tp.active = False
-                        tp.thread = None
-                        answer = 'P2Thread {name} terminated'.format(name = tp.name)
+                        self.runner.background(self.stop_thread, tp)
+                        answer = 'P2Thread {name} stopping'.format(name = tp.name)
                     break
 
                 if m.group(2) == 'start':
@@ -352,16 +680,11 @@ class Argus:
                         answer = 'P5Thread {name} is already active.'.format(name = tp.name)
                         break
 
-                    tp.terminate.clear()
-                    tp.count = 0
                     try:
-                        tp.thread = Thread(target=tp.target, args=(tp,))
-                        tp.thread.start()
+                        self.runner.start(tp)
                     except Exception as errtxt:
                         answer = 'P5Thread {name} failed: {msg}'.format(name = tp.name, msg = errtxt)
-                        raise
                     else:
-                        tp.active = True
                         answer = 'P2Thread {name} started'.format(name = tp.name)
                     break
 
@@ -373,6 +696,7 @@ class Argus:
                         break
                     if n > 0:
                         tp.interval = n
+                        tp.changed()
                         answer = 'P2Thread {name} interval set to {n}'.format(name = tp.name, n = n)
                     else:
                         answer = 'P5Thread {name} invalid interval {n}'.format(name = tp.name, n = n)
@@ -381,16 +705,17 @@ class Argus:
                 if m.group(2) == 'maxcount':
                     try:
                         n = int(m.group(3))
-                    except Exception as errtext:
+                    except Exception as errtxt:
                         answer = 'P5Thread {name} invalid maxcount: {msg}'.format(name = tp.name, msg = errtxt)
                         break
 
                     tp.maxcount = n
+                    tp.changed()
                     answer = 'P2Thread {name} maxcount set to {n}'.format(name = tp.name, n = n)
                     break
 
                 answer = 'P5Thread {name} invalid option'.format(name = tp.name)
                 break
 
-        self.sendResponse(answer)
+        self.sendResponse(answer, msg)
         return True
@@ -0,0 +1,236 @@
+"""
+Async_collect: Run the Duo log watchers and the Argus endpoint on one
+asyncio event loop instead of one OS thread per watcher
+"""
+
+import asyncio
+import json
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import argus_daemon
+import oplog
+
+
+class Argus_protocol(asyncio.DatagramProtocol):
+    """
+    Feeds the Argus UDP socket's datagrams to Argus.dispatch()
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def datagram_received(self, data, addr):
+        argus = self.engine.argus
+        try:
+            line = argus.dispatch(data, addr)
+            if line:
+                argus.sendResponse(self.engine.answer(line), line)
+        except Exception:
+            oplog.error('Unhandled exception answering {addr}', exc = True, addr = addr[0])
+
+
+class Engine:
+    """
+    Runs each Argus_thread as a task on one event loop.  The Duo client is
+    synchronous, so the fetches themselves go to a small thread pool shared
+    by every watcher; the waiting between fetches and the Argus queries
+    all happen on the loop.  The engine stands in for the
+    Argus' Thread_runner so thread start/stop commands schedule tasks.
+
+    argus:    Argus   -- Our Argus daemon, its socket is served by the loop
+    threads:  List    -- The Argus_threads to run
+    update:   Module  -- Called with the Argus_thread and result after each
+                         fetch, returns True to fetch again right away
+    answer:   Module  -- Answers queries the Argus doesn't handle itself
+    workers:  Integer -- Size of the thread pool for Duo API calls
+    prepare:  Module  -- Called in the pool with an Argus_thread that has
+                         no watcher yet, to give it one
+    waiting:  Set     -- Names of the Argus_threads to start again once
+                         their last task is over
+    """
+    def __init__(self, argus, threads, update, answer, workers = 4, prepare = None):
+        self.argus = argus
+        self.threads = threads
+        self.update = update
+        self.answer = answer
+        self.prepare = prepare
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'duo')
+        self.loop = None
+        self.done = None
+        self.wakeups = {}
+        self.waiting = set()
+
+    def start(self, tp):
+        """
+        Start tp's watcher task.  If its last task is still finishing a
+        fetch, the new one is started once that is over, so a watcher
+        never has two tasks fetching at once.
+        """
+        old = tp.thread
+        if old is not None and not old.done():
+            if tp.name not in self.waiting:
+                self.waiting.add(tp.name)
+                old.add_done_callback(lambda task: self.restart(tp))
+            return
+        tp.terminate.clear()
+        tp.count = 0
+        self.wakeups[tp.name] = asyncio.Event()
+        tp.thread = self.loop.create_task(self.watch(tp), name = tp.name)
+        tp.active = True
+
+    def restart(self, tp):
+        """
+        Start tp's watcher task now its last one is over
+        """
+        self.waiting.discard(tp.name)
+        try:
+            self.start(tp)
+        except Exception as errtxt:
+            tp.alert = 8
+            tp.status = errtxt
+
+    def stop(self, tp, timeout = 10.0):
+        """
+        Ask tp's watcher task to stop.  A fetch already under way can't be
+        interrupted, so the task is marked inactive once it finishes, and
+        start() waits for that.
+        """
+        tp.terminate.set()
+        self.wakeups[tp.name].set()
+        task = tp.thread
+
+        def finished(task):
+            if tp.thread is task:
+                tp.active = False
+                tp.thread = None
+
+        if task.done():
+            finished(task)
+        else:
+            task.add_done_callback(finished)
+        return True
+
+    def background(self, func, *args):
+        """
+        Our start and stop never block, so there is nothing to wait for
+        """
+        func(*args)
+
+    async def query(self, reader, writer):
+        """
+        Answer one TCP query of the Argus, the counterpart of the UDP
+        datagrams Argus_protocol handles
+        """
+        argus = self.argus
+        replies = []
+        try:
+            line = await asyncio.wait_for(reader.readline(), argus_daemon.QUERY_TIMEOUT)
+            msg = argus.query(line, writer.get_extra_info('peername'), replies.append)
+            if msg:
+                argus.sendResponse(self.answer(msg), msg)
+            for obj in replies:
+                writer.write((json.dumps(obj) + '\n').encode('utf-8'))
+            await asyncio.wait_for(writer.drain(), argus_daemon.QUERY_TIMEOUT)
+        except (asyncio.TimeoutError, OSError, ValueError):
+            pass
+        except Exception:
+            oplog.error('Unhandled exception answering a TCP query', exc = True)
+        finally:
+            writer.close()
+
+    async def watch(self, tp):
+        """
+        Task to loop forever scarfing up Duo log messages, the asyncio
+        counterpart of collect.looper
+        """
+        oplog.info('Task {name} starting.', name = tp.name)
+
+        wakeup = self.wakeups[tp.name]
+        try:
+            if tp.handle is None and self.prepare:
+                await self.loop.run_in_executor(self.executor, self.prepare, tp)
+            while not tp.terminate.is_set():
+                while not tp.terminate.is_set():
+                    tp.timestamp = time.time()
+                    result = await self.loop.run_in_executor(self.executor, tp.handle.fetch)
+                    if not self.update(tp, result):
+                        break
+                try:
+                    await asyncio.wait_for(wakeup.wait(), tp.interval)
+                except asyncio.TimeoutError:
+                    pass
+                if tp.maxcount > 0 and tp.count > tp.maxcount:
+                    break
+            if tp.handle.backfill:
+                await self.loop.run_in_executor(self.executor, tp.handle.backfill.stop)
+            if tp.handle.unsaved:
+                await self.loop.run_in_executor(self.executor, tp.handle.save_state, True)
+            if tp.handle.tally:
+                await self.loop.run_in_executor(self.executor, tp.handle.tally.close)
+        except Exception as errtxt:
+            oplog.error('Task {name} failed: {error}', exc = True, name = tp.name, error = str(errtxt))
+
+        tp.status = 'Stopped ' + tp.status
+
+        oplog.info('Task {name} terminating.', name = tp.name)
+
+    async def poll(self):
+        """
+        Task calling the Argus' pollers, as its own main loop would
+        """
+        while True:
+            await asyncio.sleep(argus_daemon.POLL_SECONDS)
+            self.argus.poll()
+
+    def shutdown(self, signum):
+        oplog.info('Shutting down on signal {signum}', signum = signum)
+        self.done.set()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.done = asyncio.Event()
+        self.argus.runner = self
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.shutdown, signum)
+
+        transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: Argus_protocol(self), sock = self.argus.sock)
+        server = None
+        if self.argus.tcp:
+            server = await asyncio.start_server(self.query, sock = self.argus.tcp)
+
+        for tp in self.threads:
+            if tp.auto:
+                try:
+                    self.start(tp)
+                except Exception as errtxt:
+                    tp.alert = 8
+                    tp.status = errtxt
+
+        poller = self.loop.create_task(self.poll())
+        await self.done.wait()
+        poller.cancel()
+
+        oplog.info('Exiting main loop.')
+
+        tasks = []
+        for tp in self.threads:
+            if tp.active:
+                tasks.append(tp.thread)
+                self.stop(tp)
+        if tasks:
+            await asyncio.wait(tasks, timeout = 10.0)
+        transport.close()
+        if server:
+            server.close()
+
+    def main(self):
+        """
+        Run the event loop until we're told to shut down
+        """
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.executor.shutdown(wait = False)
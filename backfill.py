@@ -0,0 +1,248 @@
+"""
+Backfill: Catch a LogWatcher up on a long gap by fetching time slices of
+it at once while live collection carries on at the head
+"""
+
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+import archive
+import duo_watcher
+import durability
+import oplog
+
+# Seconds behind before a watcher backfills instead of paging forward
+BACKFILL_GAP = 3600
+
+# Longest time slice fetched by one worker
+SLICE_SECONDS = 3600
+
+# Seconds a worker waits after a failed fetch
+RETRY_SECONDS = 30
+
+
+def seed(dirname, state):
+    """
+    Give a staging watcher its starting state, unless it already has one
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if not os.path.exists(dirname + '/state'):
+        with open(dirname + '/state.new', 'w') as fp:
+            fp.write(json.dumps(state) + '\n')
+        os.rename(dirname + '/state.new', dirname + '/state')
+
+
+class Stoppable:
+    """
+    A watcher's rate limit as its staging watchers see it: once the
+    backfill is stopped nothing more is let through, so a worker gives up
+    even in the middle of draining a v2 slice.
+    """
+    def __init__(self, limiter, stopped):
+        self.limiter = limiter
+        self.stopped = stopped
+
+    def acquire(self, *args, **kwargs):
+        return not self.stopped.is_set() and self.limiter.acquire(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.limiter, name)
+
+
+class Backfill:
+    """
+    Splits the gap between a watcher's state and now into slices of up to
+    SLICE_SECONDS and has a pool of workers fetch them at once, each
+    slice into its own staging directory under {path}/backfill, through
+    the account's shared rate limit.  Meanwhile the watcher's own cycles
+    collect rows from the end of the gap on into backfill/head and merge
+    finished slices into the real archive, oldest first, so the archive
+    and state file only ever move forward in order.  Once every slice is
+    merged the head is merged too and the watcher goes back to fetching
+    for itself.
+
+    The plan of slices is kept in backfill/plan, and each slice's staging
+    watcher keeps its own state, so a restart picks up where we left off.
+
+    watcher:   LogWatcher -- The watcher we're catching up
+    slices:    List    -- (start, end) of the slices not yet merged
+    done:      Set     -- Starts of the slices fetched in full
+    head:      LogWatcher -- Staging watcher collecting from the end of the gap
+    """
+    def __init__(self, watcher, workers):
+        self.watcher = watcher
+        self.dirname = watcher.path + '/backfill'
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.done = set()
+        self.queue = queue.Queue()
+        self.limiter = Stoppable(watcher.limiter, self.stopped)
+        self.workers = []
+
+        plan = self.dirname + '/plan'
+        if os.path.exists(plan):
+            with open(plan) as fp:
+                plan = json.load(fp)
+        else:
+            plan = self.plan()
+        self.slices = [tuple(piece) for piece in plan['slices']]
+        self.end = plan['end']
+
+        oplog.info('Backfilling {name} from {start} to {end} in {n} slices', name = watcher.name,
+                   start = time.strftime('%y-%m-%d %H:%M:%S', time.localtime(self.slices[0][0] if self.slices else self.end)),
+                   end = time.strftime('%y-%m-%d %H:%M:%S', time.localtime(self.end)),
+                   n = len(self.slices))
+
+        for piece in self.slices:
+            if os.path.exists(self.slice_dir(piece) + '/done'):
+                self.done.add(piece[0])
+            else:
+                self.queue.put(piece)
+        seed(self.dirname + '/head', {'timestamp': self.end, 'count': 0, 'seen': []})
+        self.head = self.staging(self.dirname + '/head', None)
+
+        for i in range(min(workers, self.queue.qsize())):
+            self.workers.append(threading.Thread(target = self.work, name = watcher.name + '.backfill', daemon = True))
+            self.workers[-1].start()
+
+    def plan(self):
+        """
+        Slice up the gap from the watcher's state to now and save the plan
+        """
+        state = self.watcher.state
+        start = state.get('timestamp', 0)
+        end = int(time.time() - (duo_watcher.V2_MAXTIME_LAG if self.watcher.version == 2 else 0))
+        slices = []
+        while start < end:
+            slices.append((start, min(end, start + SLICE_SECONDS)))
+            start = slices[-1][1]
+        if slices:
+            # The first slice starts where the watcher is, so it shares its
+            # digests of the rows already archived at that timestamp
+            seed(self.slice_dir(slices[0]), {
+                'timestamp': state.get('timestamp', 0),
+                'count': state.get('count', 0),
+                'seen': state.get('seen', []),
+            })
+        plan = {'slices': slices, 'end': end}
+        self.save(plan)
+        return plan
+
+    def save(self, plan):
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        with open(self.dirname + '/plan.new', 'w') as fp:
+            fp.write(json.dumps(plan) + '\n')
+        os.rename(self.dirname + '/plan.new', self.dirname + '/plan')
+
+    def slice_dir(self, piece):
+        return '{dirname}/{start}'.format(dirname = self.dirname, start = piece[0])
+
+    def staging(self, dirname, until):
+        """
+        A watcher fetching into a staging directory, sharing our watcher's
+        client and rate limit
+        """
+        watcher = self.watcher
+        return duo_watcher.LogWatcher(watcher.name + '.backfill', watcher.resource, watcher.api, version = watcher.version,
+                                      path = dirname, limiter = self.limiter, policy = durability.Policy('none'),
+                                      until = until)
+
+    def work(self):
+        """
+        Worker thread: fetch slices until there are none left
+        """
+        while not self.stopped.is_set():
+            try:
+                piece = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            dirname = self.slice_dir(piece)
+            seed(dirname, {'timestamp': piece[0], 'count': 0, 'seen': []})
+            while not self.stopped.is_set():
+                try:
+                    staged = self.staging(dirname, piece[1])
+                    while not self.stopped.is_set():
+                        if staged.fetch():
+                            continue
+                        if not staged.limited:
+                            break
+                        # Held off longer than acquire() waits, after a 429
+                        self.stopped.wait(max(self.limiter.holdoff(), 1))
+                    staged.save_state(force = True)
+                    staged.writer.close()
+                    break
+                except Exception as errtxt:
+                    oplog.error('Backfill of {name} failed: {error}', exc = True, name = dirname, error = str(errtxt))
+                    self.stopped.wait(RETRY_SECONDS)
+            if self.stopped.is_set():
+                return
+            open(dirname + '/done', 'w').close()
+            with self.lock:
+                self.done.add(piece[0])
+
+    def merge(self, dirname):
+        """
+        Pass a staging directory's rows through our watcher into the real
+        archive.  Rows it already has are dropped on the way, so merging
+        again after a crash does no harm.  The staging directory is kept
+        if a required sink didn't take its rows.
+        """
+        watcher = self.watcher
+        for name in sorted(name for name in os.listdir(dirname) if durability.day_re.match(name)):
+            for chunk in archive.read_chunks(os.path.join(dirname, name)):
+                watcher.archive([json.loads(line) for line in chunk.splitlines()])
+                watcher.save_state()
+        watcher.save_state(force = True)
+        if watcher.stalled:
+            raise RuntimeError('A sink of {name} is refusing rows'.format(name = watcher.name))
+
+    def step(self):
+        """
+        One of the watcher's cycles while backfilling: merge the slices
+        that are ready, in order, and fetch at the head.  Returns True if
+        anything new was merged or fetched.
+        """
+        merged = False
+        while self.slices:
+            with self.lock:
+                ready = self.slices[0][0] in self.done
+            if not ready:
+                break
+            piece = self.slices.pop(0)
+            self.merge(self.slice_dir(piece))
+            self.save({'slices': self.slices, 'end': self.end})
+            shutil.rmtree(self.slice_dir(piece))
+            merged = True
+
+        if self.slices:
+            return self.head.fetch() or merged
+
+        self.head.save_state(force = True)
+        self.head.writer.close()
+        self.merge(self.dirname + '/head')
+        # Our old v2 cursor is long gone; the digests take care of the
+        # overlap until we have a new one
+        self.watcher.state.pop('next_offset', None)
+        shutil.rmtree(self.dirname)
+        self.watcher.backfill = None
+        oplog.info('Backfill of {name} done', name = self.watcher.name)
+        return True
+
+    def stop(self):
+        """
+        Stop the workers and wait for them to finish their current call.
+        The next Backfill for the watcher picks up from the plan.
+        """
+        self.stopped.set()
+        for thread in self.workers:
+            thread.join()
+        self.head.save_state(force = True)
+        self.head.writer.close()
+        if self.watcher.backfill is self:
+            self.watcher.backfill = None
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Bench_archive: Compare the batched DailyArchive writer against the old
+per-row json.dump loop on a synthetic page of Duo auth rows
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import archive
+
+
+def synthetic(n, start, span = 2 * 86400):
+    """
+    Build n auth log rows spread evenly over span seconds from start
+    """
+    step = float(span) / n
+    return [{
+        'timestamp': int(start + i * step),
+        'txid': '{n:08x}-0000-4000-8000-000000000000'.format(n = i),
+        'username': 'user{n}'.format(n = i % 5000),
+        'factor': 'Duo Push',
+        'result': 'SUCCESS' if i % 17 else 'FAILURE',
+        'reason': 'User approved',
+        'integration': 'UW NetID',
+        'ip': '10.{a}.{b}.{c}'.format(a = i % 250, b = i % 200, c = i % 150),
+        'access_device': {'browser': 'Chrome', 'os': 'Mac OS X', 'ip': '10.0.0.1'},
+        'location': {'city': 'Seattle', 'state': 'Washington', 'country': 'US'},
+    } for i in range(n)]
+
+
+def per_row(dirname, rows):
+    """
+    The loop LogWatcher.fetch used to run for each row
+    """
+    logname = None
+    logfp = None
+    for row in rows:
+        fname = time.strftime(dirname + '/%y%m%d', time.localtime(row.get('timestamp', 0)))
+        if logname and logname != fname:
+            logfp.close()
+            logname = None
+        if not logname:
+            logname = fname
+            logfp = open(fname, 'a')
+        json.dump(row, logfp)
+        logfp.write('\n')
+    logfp.close()
+
+
+def batched(dirname, rows):
+    writer = archive.DailyArchive(dirname)
+    writer.write(rows)
+    writer.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the archive writer')
+    ap.add_argument('-n', type=int, default=100000, help='Rows per page')
+    ap.add_argument('-r', type=int, default=5, help='Repetitions')
+    arg = ap.parse_args()
+
+    rows = synthetic(arg.n, time.time() - 3 * 86400)
+    top = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    try:
+        results = {}
+        for name, func in (('per-row', per_row), ('batched', batched)):
+            best = None
+            for rep in range(arg.r):
+                dirname = os.path.join(top, '{name}{rep}'.format(name = name, rep = rep))
+                os.mkdir(dirname)
+                sys.stdout = devnull
+                t0 = time.perf_counter()
+                func(dirname, rows)
+                elapsed = time.perf_counter() - t0
+                sys.stdout = stdout
+                best = elapsed if best is None or elapsed < best else best
+            results[name] = best
+            print('{name:8s} {n} rows in {t:.3f}s  ({rate:,.0f} rows/s)'.format(
+                name = name, n = arg.n, t = best, rate = arg.n / best))
+
+        for fname in sorted(os.listdir(os.path.join(top, 'per-row0'))):
+            with open(os.path.join(top, 'per-row0', fname), 'rb') as a, open(os.path.join(top, 'batched0', fname), 'rb') as b:
+                if a.read() != b.read():
+                    print('Output differs in {file}'.format(file = fname))
+                    return 1
+        print('speedup  {x:.2f}x, identical output'.format(x = results['per-row'] / results['batched']))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
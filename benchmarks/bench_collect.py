@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Bench_collect: Run LogWatchers end to end against benchmarks/mockduo.py
+and measure events/sec, catch-up time after an outage, CPU per event and
+ingest latency
+"""
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import duo_watcher
+import durability
+import ratelimit
+
+MOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mockduo.py')
+
+
+class Mock:
+    """
+    benchmarks/mockduo.py running in its own process, so its CPU isn't
+    counted against ours
+    """
+    def __init__(self, *args):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.proc = subprocess.Popen([sys.executable, MOCK, '-P', str(self.port)] + [str(arg) for arg in args],
+                                     stdout = subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def keys(self):
+        return {'ikey': 'mock', 'skey': 'mock', 'apihost': '127.0.0.1', 'port': self.port, 'ca_certs': 'HTTP'}
+
+    def stats(self):
+        with urllib.request.urlopen('http://127.0.0.1:{port}/mock/stats'.format(port = self.port)) as fp:
+            return json.load(fp)
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def event_time(row):
+    """
+    When a row's event happened: to the millisecond for v2 rows, to the
+    second for v1
+    """
+    if 'isotimestamp' in row:
+        return datetime.datetime.fromisoformat(row['isotimestamp'].replace('Z', '+00:00')).timestamp()
+    return row['timestamp']
+
+
+def lag(version):
+    """
+    How far behind real time the log is read
+    """
+    return duo_watcher.V2_MAXTIME_LAG if version == 2 else 0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def watcher(dirname, mock, version, policy, rate, slices = 0):
+    """
+    A LogWatcher on the mock's authentication log, recording the ingest
+    latency of every row it archives in its latencies list
+    """
+    api = duo_watcher.make_client(mock.keys())
+    limiter = ratelimit.TokenBucket('bench', rate, max(rate / 6, 1))
+    handle = duo_watcher.LogWatcher('auth', 'authentication', api, version = version,
+                                    path = os.path.join(dirname, 'auth'), limiter = limiter,
+                                    policy = durability.Policy(policy), slices = slices)
+    handle.latencies = []
+    write = handle.writer.write
+
+    def timed_write(rows, lines = None):
+        now = time.time()
+        handle.latencies.extend(now - event_time(row) for row in rows)
+        return write(rows, lines)
+
+    handle.writer.write = timed_write
+    return handle
+
+
+def catch_up(dirname, arg, version):
+    """
+    Start with arg.H hours of backlog at arg.R events/sec and fetch until
+    we've caught up
+    """
+    mock = Mock('-R', arg.R, '-H', arg.H, '-p', arg.p, '-L', arg.L, '-E', arg.E, '-Y', 1)
+    try:
+        if arg.B:
+            # Start from a state file, as a watcher coming back after an outage would
+            os.makedirs(os.path.join(dirname, 'auth'))
+            with open(os.path.join(dirname, 'auth', 'state'), 'w') as fp:
+                json.dump({'timestamp': int(time.time() - arg.H * 3600), 'count': 0}, fp)
+        handle = watcher(dirname, mock, version, arg.s, arg.r, arg.B)
+        target = time.time() - lag(version) - 1
+        t0 = time.perf_counter()
+        c0 = cpu()
+        while handle.backfill or handle.state['timestamp'] < target:
+            if not handle.fetch() and handle.backfill:
+                # Nothing ready to merge yet; the workers are at it
+                time.sleep(0.1)
+        elapsed = time.perf_counter() - t0
+        used = cpu() - c0
+        stats = mock.stats()
+        handle.writer.close()
+    finally:
+        mock.close()
+
+    rows = handle.accepted
+    # What the same calls would have taken under Duo's default rate limit
+    limited = stats['requests'] * ratelimit.weight('/admin/v{v}/logs/authentication'.format(v = version)) / float(ratelimit.RATE)
+    return [
+        ('events', '{n:,}'.format(n = rows)),
+        ('catch-up time', '{t:.2f}s'.format(t = elapsed)),
+        ('events/sec', '{n:,.0f}'.format(n = rows / elapsed if elapsed else 0)),
+        ('CPU per event', '{us:.1f}us'.format(us = used / rows * 1e6 if rows else 0)),
+        ('API calls', '{n} ({t} throttled)'.format(n = stats['requests'], t = stats['throttled'])),
+        ('at {r}/min'.format(r = ratelimit.RATE), '{m:.0f} min'.format(m = limited)),
+    ]
+
+
+def live(dirname, arg, version):
+    """
+    Poll a live log at arg.R events/sec every arg.i seconds for arg.T
+    seconds and look at how long rows took to reach the archive
+    """
+    mock = Mock('-R', arg.R, '-H', (lag(version) + 10) / 3600.0, '-p', arg.p, '-L', arg.L, '-E', arg.E, '-Y', 1)
+    try:
+        handle = watcher(dirname, mock, version, arg.s, arg.r)
+        handle.fetch()
+        handle.latencies = []
+        c0 = cpu()
+        end = time.time() + arg.T
+        while time.time() < end:
+            # Like collect.py's looper, go again only while pages come back full
+            while handle.fetch() and handle.received >= handle.page:
+                pass
+            time.sleep(arg.i)
+        used = cpu() - c0
+        handle.writer.close()
+    finally:
+        mock.close()
+
+    rows = len(handle.latencies)
+    return [
+        ('events', '{n:,}'.format(n = rows)),
+        ('CPU per event', '{us:.1f}us'.format(us = used / rows * 1e6 if rows else 0)),
+        ('p50 latency', '{t:.2f}s'.format(t = percentile(handle.latencies, 0.5))),
+        ('p99 latency', '{t:.2f}s'.format(t = percentile(handle.latencies, 0.99))),
+    ]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark log collection against the mock Duo API')
+    ap.add_argument('-2', dest='v2', action='store_true', help='Use the v2 authentication log')
+    ap.add_argument('-R', type=float, default=50.0, help='Authentication events per second (default 50)')
+    ap.add_argument('-H', type=float, default=4.0, help='Hours of outage to catch up on (default 4)')
+    ap.add_argument('-T', type=float, default=30.0, help='Seconds to poll the live log (default 30)')
+    ap.add_argument('-i', type=float, default=5.0, help='Polling interval on the live log (default 5)')
+    ap.add_argument('-p', type=int, default=1000, help='Rows per v1 page')
+    ap.add_argument('-L', type=float, default=0.0, help='Milliseconds of latency on each request')
+    ap.add_argument('-E', type=float, default=0.0, help='Fraction of requests answered 429')
+    ap.add_argument('-r', type=float, default=6000.0, help='Our API calls per minute (default 6000, '
+                    'far above Duo\'s, so the timings are ours)')
+    ap.add_argument('-B', type=int, default=0, help='Catch up with this many time slices at once')
+    ap.add_argument('-s', default='batch', help='Durability policy (default batch)')
+    ap.add_argument('-c', action='append', choices=['catch-up', 'live'], help='Run just this case (repeatable)')
+    arg = ap.parse_args()
+
+    version = 2 if arg.v2 else 1
+    stdout = sys.stdout
+    for case in arg.c or ['catch-up', 'live']:
+        top = tempfile.mkdtemp()
+        try:
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                results = (catch_up if case == 'catch-up' else live)(top, arg, version)
+            finally:
+                sys.stdout = stdout
+        finally:
+            shutil.rmtree(top)
+        print('{case} (v{v}, {r:g} events/sec):'.format(case = case, v = version, r = arg.R))
+        for label, value in results:
+            print('  {label:16s} {value}'.format(label = label, value = value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
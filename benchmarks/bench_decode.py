@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Bench_decode: Peak memory and CPU per 10k events of taking Duo log pages
+apart and archiving their rows, decoding each page into dicts and encoding
+every row again (as collection used to) against pages.py keeping each row
+as the JSON text it came in
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import archive
+import dedup
+import pages
+from mockduo import Log
+
+MODES = ('dicts', 'stream')
+
+
+class Response:
+    status = 200
+
+
+class Api:
+    def parse_json_response(self, response, data):
+        return json.loads(data)['response']
+
+
+def body(log, start, n, v2):
+    """
+    The JSON body of a page of n rows from event start, built a row at a
+    time so the page never exists as dicts
+    """
+    rows = ', '.join(json.dumps(log.row(i, v2)) for i in range(start, start + n))
+    if v2:
+        return ('{"stat": "OK", "response": {"authlogs": [' + rows + '], "metadata": {"next_offset": null}}}').encode('utf-8')
+    return ('{"stat": "OK", "response": [' + rows + ']}').encode('utf-8')
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(mode, events, page, v2):
+    """
+    Archive events rows in pages of page rows the way mode does.  Returns
+    CPU seconds spent on it, the baseline and the peak RSS in MB.
+    """
+    dirname = tempfile.mkdtemp()
+    log = Log('authentication', 50.0, int((time.time() - 86400) * 1000))
+    api = Api()
+    window = dedup.Window()
+    writer = archive.DailyArchive(dirname)
+    baseline = peak_mb()
+    used = 0.0
+    try:
+        for start in range(0, events, page):
+            data = body(log, start, min(page, events - start), v2)
+            t0 = time.process_time()
+            if mode == 'dicts':
+                response = api.parse_json_response(Response(), data)
+            else:
+                response = pages.parse(api, Response(), data)
+            rows = response['authlogs'] if v2 else response
+            fresh = window.filter(rows, after = v2)
+            if mode == 'dicts':
+                lines = [archive.encode(row) for row in fresh]
+            else:
+                lines = [archive.row_line(row) for row in fresh]
+            writer.write(fresh, lines)
+            del data, response, rows, fresh, lines
+            used = used + time.process_time() - t0
+        writer.close()
+    finally:
+        shutil.rmtree(dirname)
+    return used, baseline, peak_mb()
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark decoding and archiving Duo log pages')
+    ap.add_argument('-n', type=int, default=100000, help='Events (default 100000)')
+    ap.add_argument('-p', type=int, default=1000, help='Rows per page (default 1000, what Duo serves)')
+    ap.add_argument('-2', dest='v2', action='store_true', help='Use v2 authentication log pages')
+    ap.add_argument('-r', type=int, default=3, help='Runs of each, the best is shown (default 3)')
+    ap.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    arg = ap.parse_args()
+
+    if arg.mode:
+        print(json.dumps(run(arg.mode, arg.n, arg.p, arg.v2)))
+        return 0
+
+    print('{n:,} {v} events in pages of {p:,} rows (best of {r}):'.format(
+        n = arg.n, v = 'v2' if arg.v2 else 'v1', p = arg.p, r = arg.r))
+    for mode in MODES:
+        # A process per run, so each peak RSS is its own
+        runs = []
+        for i in range(arg.r):
+            cmd = [sys.executable, os.path.abspath(__file__), '--mode', mode, '-n', str(arg.n), '-p', str(arg.p)]
+            out = subprocess.run(cmd + (['-2'] if arg.v2 else []), stdout = subprocess.PIPE, check = True)
+            # The last line; the archive logs to stdout too
+            runs.append(json.loads(out.stdout.splitlines()[-1]))
+        used = min(run[0] for run in runs)
+        baseline = min(run[1] for run in runs)
+        peak = min(run[2] for run in runs)
+        print('  {mode:8s} CPU per 10k events {ms:7.1f}ms   peak RSS {peak:6.1f}MB ({grew:+.1f}MB over {base:.1f}MB at start)'.format(
+            mode = mode, ms = used / arg.n * 10000 * 1000, peak = peak, grew = peak - baseline, base = baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Bench_ha: Run collect.py instances sharing their logs through a lease
+table against benchmarks/mockduo.py.  Another instance joins, then one is
+killed, timing how long its logs take to move and to be fetched again by
+their new owners.  Finally every log's last owner is checked for a copy
+holding every row any instance archived, and none twice.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_collect import Mock
+from bench_startup import free_port, status
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, TOP)
+
+import archive
+import ha
+
+
+class Instance:
+    """
+    One collect.py in its own scratch directory, all of them on the same
+    lease directory
+    """
+    def __init__(self, top, name, mock, tenants, shared, ttl, v2):
+        self.name = name
+        self.top = os.path.join(top, name)
+        self.rundir = os.path.join(self.top, 'logs')
+        os.makedirs(os.path.join(self.top, 'credentials'))
+        os.makedirs(self.rundir)
+        self.tcp_port = free_port(socket.SOCK_STREAM)
+        with open(os.path.join(self.top, 'argus_cf'), 'w') as fp:
+            json.dump({'addr': '127.0.0.1', 'port': free_port(socket.SOCK_DGRAM), 'tcp_port': self.tcp_port,
+                       'rundir': self.rundir, 'logfile': 'log', 'pidfile': 'pid',
+                       'ha': {'dir': shared, 'instance': name, 'host': '127.0.0.1',
+                              'port': free_port(socket.SOCK_STREAM), 'ttl': ttl, 'secret': 'bench_ha'}}, fp)
+        for i in range(tenants):
+            with open(os.path.join(self.top, 'credentials', 'duo.json' if i == 0 else 'tenant{i}.json'.format(i = i)), 'w') as fp:
+                json.dump(mock.keys(), fp)
+        self.proc = subprocess.Popen([sys.executable, os.path.join(TOP, 'collect.py'), '-C', self.top, '-r', '6000']
+                                     + (['-2'] if v2 else []),
+                                     cwd = '/', stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    def fetched(self):
+        """
+        Count of each active thread, by name
+        """
+        threads = status(self.tcp_port) or []
+        return dict((tp['name'], tp['count']) for tp in threads if tp['active'])
+
+    def stop(self, sig = signal.SIGTERM):
+        if self.proc.poll() is None:
+            self.proc.send_signal(sig)
+            self.proc.wait()
+
+
+def owners(shared):
+    with open(os.path.join(shared, ha.TABLE)) as fp:
+        table = json.load(fp)
+    return dict((name, lease['owner']) for name, lease in table['leases'].items())
+
+
+def settle(shared, instances, names, timeout):
+    """
+    Wait until the logs are spread evenly over the live instances and each
+    is being fetched by its owner, and no other.  Returns the seconds that
+    took and who owns what.
+    """
+    t0 = time.time()
+    live = dict((each.name, each) for each in instances if each.proc.poll() is None)
+    while time.time() < t0 + timeout:
+        try:
+            found = owners(shared)
+        except (OSError, ValueError):
+            found = {}
+        load = [list(found.values()).count(each) for each in live]
+        if all(found.get(name) in live for name in names) and max(load) - min(load) <= 1:
+            counts = dict((each, live[each].fetched()) for each in live)
+            if all(counts[found[name]].get(name, 0) >= 1 for name in names) and \
+               all(found[name] == each for each in live for name in counts[each]):
+                return time.time() - t0, found
+        time.sleep(0.05)
+    raise RuntimeError('The logs did not settle within {timeout} seconds'.format(timeout = timeout))
+
+
+def rows(dirname):
+    """
+    The archived rows of a log, and the timestamp its state file is at
+    """
+    found = []
+    for fname in sorted(name for name in os.listdir(dirname) if name.isdigit()):
+        for chunk in archive.read_chunks(os.path.join(dirname, fname)):
+            found.extend(line for line in chunk.splitlines() if line)
+    with open(os.path.join(dirname, 'state')) as fp:
+        return found, json.load(fp)['timestamp']
+
+
+def check(instances, final):
+    """
+    Rows missing from, and rows twice in, the final owner's copy of each
+    log, counting the rows any instance archived up to where that copy is
+    """
+    missing = twice = 0
+    for name, owner in sorted(final.items()):
+        tenant, log = name.split('.') if '.' in name else (None, name)
+        path = os.path.join(tenant, log) if tenant else log
+        copy = dict((each.name, os.path.join(each.rundir, path)) for each in instances)
+        kept, until = rows(copy[owner])
+        twice = twice + len(kept) - len(set(kept))
+        seen = set()
+        for each, dirname in copy.items():
+            if each != owner and os.path.exists(os.path.join(dirname, 'state')):
+                seen.update(line for line in rows(dirname)[0] if json.loads(line)['timestamp'] <= until)
+        missing = missing + len(seen - set(kept))
+    return missing, twice
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark failover between collectors sharing their logs')
+    ap.add_argument('-n', type=int, default=2, help='Instances at the start (default 2)')
+    ap.add_argument('-t', type=int, default=2, help='Duo accounts, each with the three logs (default 2)')
+    ap.add_argument('-R', type=float, default=50.0, help='Authentication events per second (default 50)')
+    ap.add_argument('-H', type=float, default=0.5, help='Hours of events waiting in the mock (default 0.5)')
+    ap.add_argument('-l', type=float, default=ha.TTL, help='Lease seconds (default {ttl:g})'.format(ttl = ha.TTL))
+    ap.add_argument('-w', type=float, default=15.0, help='Seconds to run before each change (default 15)')
+    ap.add_argument('-2', dest='v2', action='store_true', help='Use the cursor paged v2 authentication log')
+    ap.add_argument('-T', type=float, default=120.0, help='Most seconds to wait for the logs to settle (default 120)')
+    arg = ap.parse_args()
+
+    mock = Mock('-R', arg.R, '-H', arg.H)
+    top = tempfile.mkdtemp()
+    shared = os.path.join(top, 'shared')
+    instances = []
+    try:
+        names = []
+        for i in range(arg.t):
+            names.extend(log if i == 0 else 'tenant{i}.{log}'.format(i = i, log = log) for log in ('auth', 'admin', 'phone'))
+
+        def start():
+            instances.append(Instance(top, 'c{n}'.format(n = len(instances) + 1), mock, arg.t, shared, arg.l, arg.v2))
+
+        for i in range(arg.n):
+            start()
+        took, found = settle(shared, instances, names, arg.T)
+        print('{n} instances, {logs} logs, {ttl:g}s leases:'.format(n = arg.n, logs = len(names), ttl = arg.l))
+        print('  {key:22s} {t:.1f}s, {spread}'.format(key = 'first fetches', t = took, spread = spread(found)))
+
+        time.sleep(arg.w)
+        start()
+        took, found = settle(shared, instances, names, arg.T)
+        print('  {key:22s} {t:.1f}s, {spread}'.format(key = 'handed to a newcomer', t = took, spread = spread(found)))
+
+        time.sleep(arg.w)
+        victim = max(set(found.values()), key = lambda each: list(found.values()).count(each))
+        [each for each in instances if each.name == victim][0].stop(signal.SIGKILL)
+        lost = sorted(name for name, owner in found.items() if owner == victim)
+        took, found = settle(shared, instances, names, arg.T)
+        print('  {key:22s} {t:.1f}s, {spread}'.format(key = 'killed ' + victim, t = took, spread = spread(found)))
+        print('  {key:22s} {logs}'.format(key = 'taken over', logs = ', '.join(lost)))
+
+        time.sleep(arg.w)
+        for each in instances:
+            each.stop()
+        missing, twice = check(instances, found)
+        print('  {key:22s} {m} missing, {d} twice'.format(key = 'final copies', m = missing, d = twice))
+    finally:
+        for each in instances:
+            each.stop()
+        mock.close()
+        shutil.rmtree(top)
+    return 0
+
+
+def spread(found):
+    counts = {}
+    for owner in found.values():
+        counts[owner] = counts.get(owner, 0) + 1
+    return ' '.join('{owner}:{n}'.format(owner = owner, n = n) for owner, n in sorted(counts.items()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Bench_query: Time indexed archive queries against a full scan over a year
+of synthetic daily auth files
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import archive
+import query
+from bench_archive import synthetic
+
+
+def build(dirname, days, per_day, fmt, keys):
+    """
+    Write days of synthetic rows ending yesterday, a page at a time
+    """
+    start = archive.day_bounds(time.time())[0] - days * 86400
+    rows = synthetic(days * per_day, start, days * 86400)
+    writer = archive.DailyArchive(dirname, fmt, keys)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for i in range(0, len(rows), 1000):
+            writer.write(rows[i:i + 1000])
+        writer.close()
+    finally:
+        sys.stdout = stdout
+    return start, rows
+
+
+def scan(dirname, start, end, user):
+    """
+    What we did before: decode every line of every file
+    """
+    found = 0
+    for fname in sorted(os.listdir(dirname)):
+        if not fname.isdigit():
+            continue
+        with open(os.path.join(dirname, fname), 'rb') as fp:
+            for line in fp:
+                row = json.loads(line)
+                if start <= row['timestamp'] < end and (user is None or row['username'] == user):
+                    found = found + 1
+    return found
+
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark archive queries')
+    ap.add_argument('-D', type=int, default=365, help='Days of data')
+    ap.add_argument('-n', type=int, default=2000, help='Rows per day')
+    ap.add_argument('-z', choices=archive.FORMATS, help='Compressed format to query too')
+    arg = ap.parse_args()
+
+    top = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(top, 'plain')
+        os.mkdir(plain)
+        start, rows = build(plain, arg.D, arg.n, None, True)
+        dirs = [('plain', plain)]
+        if arg.z:
+            packed = os.path.join(top, arg.z)
+            os.mkdir(packed)
+            build(packed, arg.D, arg.n, arg.z, True)
+            dirs.append((arg.z, packed))
+        print('{n:,} rows over {d} days'.format(n = len(rows), d = arg.D))
+
+        user = rows[len(rows) // 2]['username']
+        hour = rows[len(rows) // 2]['timestamp']
+        end = start + arg.D * 86400
+        cases = [
+            ('one hour', hour, hour + 3600, None),
+            ('one user, whole year', start, end, user),
+            ('one user, one week', hour - 7 * 86400, hour, user),
+        ]
+        for label, t0, t1, who in cases:
+            expected, elapsed = timed(scan, plain, t0, t1, who)
+            print('{label:22s} scan:  {n:6d} rows {t:8.3f}s'.format(label = label, n = expected, t = elapsed))
+            for name, dirname in dirs:
+                found, elapsed = timed(lambda: sum(1 for line in query.search(dirname, t0, t1, who)))
+                flag = '' if found == expected else '  MISMATCH'
+                print('{label:22s} {name:5s}  {n:6d} rows {t:8.3f}s{flag}'.format(
+                    label = '', name = name, n = found, t = elapsed, flag = flag))
+    finally:
+        shutil.rmtree(top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Bench_scan: Time the parallel scanner against a single process
+json.loads loop over synthetic daily auth files
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scan
+from bench_query import build
+
+
+def serial(dirname, fields):
+    counts = collections.Counter()
+    for fname in sorted(os.listdir(dirname)):
+        if not fname.isdigit():
+            continue
+        with open(os.path.join(dirname, fname)) as fp:
+            for line in fp:
+                row = json.loads(line)
+                counts[tuple(str(row.get(field)) for field in fields)] += 1
+    return counts
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the parallel archive scanner')
+    ap.add_argument('-D', type=int, default=370, help='Days of data')
+    ap.add_argument('-n', type=int, default=5000, help='Rows per day')
+    ap.add_argument('-j', type=int, help='Worker processes (default one per core)')
+    arg = ap.parse_args()
+
+    top = tempfile.mkdtemp()
+    try:
+        start, rows = build(top, arg.D, arg.n, None, False)
+        size = sum(os.path.getsize(os.path.join(top, fname)) for fname in os.listdir(top))
+        print('{n:,} rows, {mb:.0f} MB over {d} days, {cpus} cores'.format(
+            n = len(rows), mb = size / 1e6, d = arg.D, cpus = os.cpu_count()))
+        fields = ['result', 'factor']
+
+        t0 = time.perf_counter()
+        expected = serial(top, fields)
+        t1 = time.perf_counter()
+        total, counts = scan.scan(top, start, start + arg.D * 86400, fields, processes = arg.j)
+        t2 = time.perf_counter()
+        print('serial   {t:7.2f}s'.format(t = t1 - t0))
+        print('parallel {t:7.2f}s  {x:.1f}x{flag}'.format(
+            t = t2 - t1, x = (t1 - t0) / (t2 - t1), flag = '' if counts == expected else '  MISMATCH'))
+
+        t1 = time.perf_counter()
+        total, counts = scan.scan(top, start, start + arg.D * 86400, fields, ['FAILURE'], processes = arg.j)
+        t2 = time.perf_counter()
+        print('parallel {t:7.2f}s  with raw byte filter, {n} rows'.format(t = t2 - t1, n = total))
+    finally:
+        shutil.rmtree(top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
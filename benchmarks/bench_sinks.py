@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Bench_sinks: Catch up on a backlog from benchmarks/mockduo.py with and
+without network sinks sending the rows on to benchmarks/mocksink.py, and
+check that every archived row reached each collector
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_collect import Mock, cpu, lag
+from bench_startup import free_port
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import duo_watcher
+import durability
+import ratelimit
+import sinks
+
+MOCKSINK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mocksink.py')
+
+
+class Collectors:
+    """
+    benchmarks/mocksink.py running in its own process
+    """
+    def __init__(self, errors):
+        self.syslog = free_port(socket.SOCK_STREAM)
+        self.http = free_port(socket.SOCK_STREAM)
+        self.proc = subprocess.Popen([sys.executable, MOCKSINK, '-S', str(self.syslog), '-P', str(self.http), '-E', str(errors)],
+                                     stdout = subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.stats()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def stats(self):
+        with urllib.request.urlopen('http://127.0.0.1:{port}/mock/stats'.format(port = self.http)) as fp:
+            return json.load(fp)
+
+    def down(self, secs):
+        urllib.request.urlopen(urllib.request.Request('http://127.0.0.1:{port}/mock/down?secs={secs}'.format(
+            port = self.http, secs = secs), data = b''), timeout = 5).close()
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def run(dirname, arg, mock, collectors):
+    """
+    Catch up on the mock's backlog, with network sinks if collectors isn't
+    None, then wait for the sinks to drain.  Returns the watcher, seconds
+    and CPU seconds to catch up, and seconds to drain.
+    """
+    outputs = []
+    if collectors:
+        spool = os.path.join(dirname, 'spool')
+        outputs = [
+            sinks.Syslog_sink('syslog', spool, '127.0.0.1', collectors.syslog, batch = arg.b),
+            sinks.Http_sink('http', spool, 'http://127.0.0.1:{port}/'.format(port = collectors.http),
+                            gzip = arg.z, batch = arg.b),
+        ]
+        if arg.D:
+            collectors.down(arg.D)
+    api = duo_watcher.make_client(mock.keys())
+    handle = duo_watcher.LogWatcher('auth', 'authentication', api, path = os.path.join(dirname, 'auth'),
+                                    limiter = ratelimit.TokenBucket('bench', 6000, 1000),
+                                    policy = durability.Policy(arg.s), outputs = outputs)
+    target = time.time() - lag(1) - 1
+    t0 = time.perf_counter()
+    c0 = cpu()
+    while handle.state['timestamp'] < target:
+        handle.fetch()
+    elapsed = time.perf_counter() - t0
+    used = cpu() - c0
+    handle.writer.close()
+    deadline = time.time() + arg.T
+    while any(sink.rows < handle.accepted for sink in outputs) and time.time() < deadline:
+        time.sleep(0.01)
+    drained = time.perf_counter() - t0
+    for sink in outputs:
+        sink.close()
+    return handle, outputs, elapsed, used, drained
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the network sinks against mock collectors')
+    ap.add_argument('-R', type=float, default=50.0, help='Authentication events per second (default 50)')
+    ap.add_argument('-H', type=float, default=4.0, help='Hours of backlog to catch up on (default 4)')
+    ap.add_argument('-b', type=int, default=sinks.BATCH, help='Rows per sink batch (default {n})'.format(n = sinks.BATCH))
+    ap.add_argument('-z', action='store_true', help='Gzip the HTTP batches')
+    ap.add_argument('-E', type=float, default=0.0, help='Fraction of HTTP batches the collector refuses')
+    ap.add_argument('-D', type=float, default=0.0, help='Seconds the collectors are down at the start')
+    ap.add_argument('-T', type=float, default=120.0, help='Most seconds to wait for the sinks to drain (default 120)')
+    ap.add_argument('-s', default='batch', help='Durability policy (default batch)')
+    arg = ap.parse_args()
+
+    mock = Mock('-R', arg.R, '-H', arg.H)
+    collectors = Collectors(arg.E)
+    try:
+        for label, with_sinks in (('archive only', False), ('with sinks', True)):
+            dirname = tempfile.mkdtemp()
+            try:
+                handle, outputs, elapsed, used, drained = run(dirname, arg, mock, collectors if with_sinks else None)
+            finally:
+                shutil.rmtree(dirname)
+            rows = handle.accepted
+            print('{label}:'.format(label = label))
+            print('  {key:16s} {value}'.format(key = 'events', value = '{n:,}'.format(n = rows)))
+            print('  {key:16s} {value}'.format(key = 'events/sec', value = '{n:,.0f}'.format(n = rows / elapsed)))
+            print('  {key:16s} {value}'.format(key = 'CPU per event', value = '{us:.1f}us'.format(us = used / rows * 1e6)))
+            print('  {key:16s} {value}'.format(key = 'mean commit', value = '{ms:.2f}ms'.format(
+                ms = handle.metrics.commits.sum / max(1, sum(handle.metrics.commits.counts)) * 1000)))
+            if not outputs:
+                continue
+            stats = collectors.stats()
+            for sink in outputs:
+                got = stats[sink.name]
+                print('  {name}:'.format(name = sink.name))
+                print('    {key:14s} {value}'.format(key = 'delivered', value = '{n:,} rows in {b} batches, {mb:.1f}MB'.format(
+                    n = sink.rows, b = sink.batches, mb = sink.sent / 1e6)))
+                print('    {key:14s} {value}'.format(key = 'drained after', value = '{t:.2f}s ({n:,.0f} rows/sec)'.format(
+                    t = drained, n = sink.rows / drained)))
+                print('    {key:14s} {value}'.format(key = 'failed sends', value = sink.errors))
+                received = '{n:,} distinct, {d:,} twice, {m:,} missing, {x} malformed'.format(
+                    n = got['distinct'], d = got['duplicates'], m = rows - got['distinct'], x = got['bad'])
+                print('    {key:14s} {value}'.format(key = 'received', value = received))
+    finally:
+        collectors.close()
+        mock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
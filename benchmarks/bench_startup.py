@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Bench_startup: Time importing the modules, and a cold start of collect.py
+against benchmarks/mockduo.py up to its first answer and its first fetches
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_collect import Mock, percentile
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ('query', 'scan', 'stream', 'retention', 'duo_watcher', 'collect')
+
+
+def import_time(module):
+    """
+    Seconds a fresh interpreter takes to import module
+    """
+    code = 'import time; t0 = time.perf_counter(); import {module}; print(time.perf_counter() - t0)'.format(module = module)
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([TOP] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    out = subprocess.run([sys.executable, '-c', code], env = env, cwd = tempfile.gettempdir(),
+                         stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, check = True)
+    return float(out.stdout)
+
+
+def free_port(kind):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def status(port):
+    """
+    The threads in the daemon's status reply, or None if it isn't answering
+    """
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), 1)
+    except OSError:
+        return None
+    try:
+        sock.settimeout(5)
+        sock.sendall(b'{"query": "status", "seq": "1"}\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                return None
+            data = data + chunk
+        return json.loads(data).get('threads', [])
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def cold_start(mock, tenants, timeout):
+    """
+    Start collect.py in a scratch directory with tenants Duo accounts, all
+    on the mock, from outside that directory.  Returns the seconds to its
+    first status answer and to every watcher having finished a fetch.
+    """
+    top = tempfile.mkdtemp()
+    proc = None
+    try:
+        os.makedirs(os.path.join(top, 'credentials'))
+        os.makedirs(os.path.join(top, 'logs'))
+        tcp_port = free_port(socket.SOCK_STREAM)
+        with open(os.path.join(top, 'argus_cf'), 'w') as fp:
+            json.dump({'addr': '127.0.0.1', 'port': free_port(socket.SOCK_DGRAM), 'tcp_port': tcp_port,
+                       'rundir': os.path.join(top, 'logs'), 'logfile': 'log', 'pidfile': 'pid'}, fp)
+        for i in range(tenants):
+            with open(os.path.join(top, 'credentials', 'duo.json' if i == 0 else 'tenant{i}.json'.format(i = i)), 'w') as fp:
+                json.dump(mock.keys(), fp)
+
+        t0 = time.time()
+        proc = subprocess.Popen([sys.executable, os.path.join(TOP, 'collect.py'), '-C', top, '-r', '6000'],
+                                cwd = '/', stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        ready = None
+        while time.time() < t0 + timeout:
+            if proc.poll() is not None:
+                raise RuntimeError('collect.py exited with {code}'.format(code = proc.returncode))
+            threads = status(tcp_port)
+            if threads is not None and ready is None:
+                ready = time.time() - t0
+            if threads and all(tp['count'] >= 1 for tp in threads):
+                return ready, time.time() - t0
+            time.sleep(0.005)
+        raise RuntimeError('No first fetch within {timeout} seconds'.format(timeout = timeout))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(top)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark module imports and a cold start of the collector')
+    ap.add_argument('-n', type=int, default=5, help='Runs of each measurement (default 5)')
+    ap.add_argument('-t', type=int, default=1, help='Duo accounts, each with the three logs (default 1)')
+    ap.add_argument('-H', type=float, default=1.0, help='Hours of events waiting in the mock (default 1)')
+    ap.add_argument('-L', type=float, default=0.0, help='Milliseconds of latency on each request')
+    ap.add_argument('-T', type=float, default=60.0, help='Seconds to wait for a cold start (default 60)')
+    arg = ap.parse_args()
+
+    print('import (median of {n}):'.format(n = arg.n))
+    for module in MODULES:
+        times = [import_time(module) for i in range(arg.n)]
+        print('  {module:16s} {ms:.1f}ms'.format(module = module, ms = percentile(times, 0.5) * 1000))
+
+    mock = Mock('-R', 50, '-H', arg.H, '-L', arg.L)
+    try:
+        runs = [cold_start(mock, arg.t, arg.T) for i in range(arg.n)]
+    finally:
+        mock.close()
+    print('cold start ({t} account{s}, median of {n}):'.format(t = arg.t, s = '' if arg.t == 1 else 's', n = arg.n))
+    print('  {label:16s} {ms:.0f}ms'.format(label = 'first answer', ms = percentile([run[0] for run in runs], 0.5) * 1000))
+    print('  {label:16s} {ms:.0f}ms'.format(label = 'first fetches', ms = percentile([run[1] for run in runs], 0.5) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
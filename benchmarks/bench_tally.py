@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Bench_tally: What keeping tally.py's counts costs as rows are archived,
+and how long a question like "rows per hour and result" takes answered
+from the tally against scanning the day's archive for it
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import archive
+import tally
+from mockduo import Log
+
+PAGE = 1000
+
+
+def scan(dirname, day, by):
+    """
+    The report on day grouped by the fields in by, the hard way
+    """
+    start = tally.day_start(day)
+    end = archive.day_bounds(start)[1]
+    picks = [tally.FIELDS.index(field) for field in by]
+    groups = {}
+    users = set()
+    for fname in archive.files(dirname, start, end):
+        for chunk in archive.read_chunks(fname, start, end):
+            for line in chunk.splitlines():
+                row = json.loads(line)
+                result, reason, factor, application, user = tally.facts(row)
+                key = (time.localtime(row['timestamp']).tm_hour, result, reason, factor, application)
+                group = tuple(key[i] for i in picks)
+                groups[group] = groups.get(group, 0) + 1
+                users.add(user)
+    return groups, len(users)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the ingest-time tallies against scanning the archive')
+    ap.add_argument('-n', type=int, default=500000, help='Events archived (default 500000)')
+    ap.add_argument('-2', dest='v2', action='store_true', help='Use v2 authentication log rows')
+    ap.add_argument('-z', choices=archive.FORMATS, help='Compress the archive')
+    ap.add_argument('-b', default='hour,result', help='Fields to group by (default hour,result)')
+    arg = ap.parse_args()
+
+    by = tuple(arg.b.split(','))
+    dirname = tempfile.mkdtemp()
+    try:
+        # Events over the first 20 hours of yesterday, so they fit in a day
+        start = archive.day_bounds(time.time() - 86400)[0]
+        log = Log('authentication', arg.n / 72000.0, int(start * 1000))
+        writer = archive.DailyArchive(dirname, arg.z)
+        sink = tally.Tally_sink(dirname, (0, 0))
+        archived = tallied = 0.0
+        for first in range(0, arg.n, PAGE):
+            rows = [log.row(i, arg.v2) for i in range(first, min(arg.n, first + PAGE))]
+            lines = [archive.encode(row) for row in rows]
+            t0 = time.process_time()
+            writer.write(rows, lines)
+            t1 = time.process_time()
+            sink.write('bench', rows, lines)
+            tallied = tallied + time.process_time() - t1
+            archived = archived + t1 - t0
+        writer.close()
+        sink.close()
+        day = tally.day_of(start)
+
+        t0 = time.perf_counter()
+        report = tally.current(dirname, day).report(by, top = 1 << 30)
+        answered = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        groups, users = scan(dirname, day, by)
+        scanned = time.perf_counter() - t0
+
+        expected = dict((tuple(entry[field] for field in by), entry['rows']) for entry in report['groups'])
+        size = os.path.getsize(tally.path(dirname, day))
+        print('{n:,} {v} events, grouped by {by}:'.format(n = arg.n, v = 'v2' if arg.v2 else 'v1', by = ','.join(by)))
+        print('  {key:18s} {us:.1f}us per event'.format(key = 'archive write', us = archived / arg.n * 1e6))
+        print('  {key:18s} {us:.1f}us per event'.format(key = 'tally', us = tallied / arg.n * 1e6))
+        print('  {key:18s} {ms:.1f}ms ({kb:.1f}KB tally file)'.format(key = 'query tally', ms = answered * 1000, kb = size / 1024.0))
+        print('  {key:18s} {ms:.1f}ms'.format(key = 'scan archive', ms = scanned * 1000))
+        print('  {key:18s} {same}, {est:,} users estimated of {users:,}'.format(
+            key = 'groups match', same = expected == groups, est = report['users'], users = users))
+    finally:
+        shutil.rmtree(dirname)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
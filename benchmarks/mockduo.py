@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Mockduo: A local stand-in for the Duo Admin API log endpoints, for running
+collect.py and the benchmarks without Duo credentials
+
+Serves /admin/v1/logs/{authentication,administrator,telephony} and
+/admin/v2/logs/authentication over plain HTTP with keep-alive.  Events are
+generated on the fly at a steady rate, starting a backlog's worth of hours
+in the past and keeping up with the clock from then on, so every request
+sees the log as Duo would at that moment.  Requests aren't authenticated.
+
+To point collect.py at it, give it a credentials/duo.json like
+
+    {"ikey": "mock", "skey": "mock", "apihost": "127.0.0.1",
+     "port": 8443, "ca_certs": "HTTP"}
+"""
+
+import argparse
+import datetime
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Each log's share of the authentication log's event rate
+SHARES = {
+    'authentication': 1.0,
+    'administrator': 0.02,
+    'telephony': 0.05,
+}
+
+V2_LIMIT = 1000
+
+# (version, log) of each endpoint we serve
+ROUTES = set([('v1', 'authentication'), ('v1', 'administrator'), ('v1', 'telephony'), ('v2', 'authentication')])
+
+
+class Log:
+    """
+    An endless log of synthetic events.  Event i happens at millisecond
+    start + i * 1000 / rate, so any part of the log can be produced
+    without keeping it.
+
+    kind:      String  -- Which log: authentication, administrator or telephony
+    rate:      Float   -- Events per second
+    start:     Integer -- Epoch milliseconds of event 0
+    """
+    def __init__(self, kind, rate, start):
+        self.kind = kind
+        self.rate = rate
+        self.start = start
+
+    def ms(self, i):
+        return self.start + int(i * 1000.0 / self.rate)
+
+    def first(self, ms):
+        """
+        Index of the first event at or after epoch milliseconds ms
+        """
+        i = max(0, int(math.ceil((ms - self.start) * self.rate / 1000.0)))
+        while i > 0 and self.ms(i - 1) >= ms:
+            i = i - 1
+        while self.ms(i) < ms:
+            i = i + 1
+        return i
+
+    def visible(self):
+        """
+        Index of the first event still in the future
+        """
+        return self.first(int(time.time() * 1000) + 1)
+
+    def txid(self, i):
+        # Sorts in event order, and gives the index back
+        return '{n:08x}-0000-4000-8000-{n:012x}'.format(n = i)
+
+    def row(self, i, v2 = False):
+        ms = self.ms(i)
+        timestamp = ms // 1000
+        if self.kind == 'administrator':
+            return {
+                'timestamp': timestamp,
+                'username': 'admin{n}'.format(n = i % 7),
+                'action': ('user_update', 'admin_login', 'group_update')[i % 3],
+                'object': 'user{n}'.format(n = i % 5000),
+                'description': '{"status": "Active"}',
+            }
+        if self.kind == 'telephony':
+            return {
+                'timestamp': timestamp,
+                'context': 'authentication',
+                'type': 'sms' if i % 3 else 'phone',
+                'phone': '+1206555{n:04d}'.format(n = i % 10000),
+                'credits': 1,
+            }
+        if not v2:
+            return {
+                'timestamp': timestamp,
+                'txid': self.txid(i),
+                'username': 'user{n}'.format(n = i % 5000),
+                'factor': 'Duo Push',
+                'result': 'SUCCESS' if i % 17 else 'FAILURE',
+                'reason': 'User approved' if i % 17 else 'User mistake',
+                'integration': 'UW NetID',
+                'ip': '10.{a}.{b}.{c}'.format(a = i % 250, b = i % 200, c = i % 150),
+                'new_enrollment': False,
+                'device': '206-555-{n:04d}'.format(n = i % 10000),
+                'access_device': {'browser': 'Chrome', 'os': 'Mac OS X', 'ip': '10.0.0.1'},
+                'location': {'city': 'Seattle', 'state': 'Washington', 'country': 'US'},
+            }
+        return {
+            'timestamp': timestamp,
+            'isotimestamp': datetime.datetime.fromtimestamp(ms / 1000.0, datetime.timezone.utc).isoformat(
+                timespec = 'milliseconds').replace('+00:00', 'Z'),
+            'txid': self.txid(i),
+            'event_type': 'authentication',
+            'factor': 'duo_push',
+            'result': 'success' if i % 17 else 'denied',
+            'reason': 'user_approved' if i % 17 else 'user_mistake',
+            'user': {'name': 'user{n}'.format(n = i % 5000), 'key': 'DU{n:018d}'.format(n = i % 5000)},
+            'application': {'name': 'UW NetID', 'key': 'DIAPPLICATION000000'},
+            'access_device': {'browser': 'Chrome', 'os': 'Mac OS X', 'ip': '10.0.0.1',
+                              'location': {'city': 'Seattle', 'state': 'Washington', 'country': 'United States'}},
+            'auth_device': {'name': '206-555-{n:04d}'.format(n = i % 10000), 'ip': '10.1.1.1'},
+        }
+
+    def v1(self, params, limit):
+        i = self.first(int(params.get('mintime', '0')) * 1000)
+        end = min(self.visible(), i + limit)
+        return [self.row(n) for n in range(i, end)]
+
+    def v2(self, params):
+        limit = min(int(params.get('limit', '100')), V2_LIMIT)
+        end = min(self.visible(), self.first(int(params['maxtime']) + 1))
+        i = self.first(int(params['mintime']))
+        if params.get('next_offset'):
+            txid = params['next_offset'].split(',', 1)[1]
+            i = max(i, int(txid.split('-')[0], 16) + 1)
+        n = max(0, min(end, i + limit) - i)
+        rows = [self.row(k, True) for k in range(i, i + n)]
+        more = i + n < end
+        return {
+            'authlogs': rows,
+            'metadata': {
+                'next_offset': [str(self.ms(i + n - 1)), self.txid(i + n - 1)] if more and rows else None,
+                'total_objects': end - i,
+            },
+        }
+
+
+class Mock_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, status, body, headers = ()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/mock/stats':
+            with server.lock:
+                stats = dict(server.stats)
+            return self.send(200, stats)
+
+        parts = url.path.split('/')
+        route = (parts[2], parts[4]) if len(parts) == 5 and parts[1] == 'admin' and parts[3] == 'logs' else None
+        if route not in ROUTES:
+            return self.send(404, {'stat': 'FAIL', 'code': 40401, 'message': 'Resource not found'})
+        version = route[0]
+        log = server.logs[route[1]]
+
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.stats['requests'] = server.stats['requests'] + 1
+            throttle = server.rng.random() < server.errors
+            if throttle:
+                server.stats['throttled'] = server.stats['throttled'] + 1
+        if throttle:
+            return self.send(429, {'stat': 'FAIL', 'code': 42901, 'message': 'Too Many Requests'},
+                             [('Retry-After', str(server.retry))])
+
+        if version == 'v1':
+            response = log.v1(params, server.page)
+            rows = len(response)
+        else:
+            response = log.v2(params)
+            rows = len(response['authlogs'])
+        with server.lock:
+            server.stats['rows'] = server.stats['rows'] + rows
+        self.send(200, {'stat': 'OK', 'response': response})
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class Mock_server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def serve(port, rate = 50.0, hours = 0.0, page = 1000, latency = 0.0, errors = 0.0, retry = 5, addr = '127.0.0.1'):
+    """
+    Start serving in the background, returns the server
+    """
+    server = Mock_server((addr, port), Mock_handler)
+    start = int((time.time() - hours * 3600) * 1000)
+    server.logs = dict((kind, Log(kind, rate * share, start)) for kind, share in SHARES.items())
+    server.page = page
+    server.latency = latency / 1000.0
+    server.errors = errors
+    server.retry = retry
+    server.rng = random.Random(0)
+    server.lock = threading.Lock()
+    server.stats = {'requests': 0, 'throttled': 0, 'rows': 0}
+    threading.Thread(target = server.serve_forever, name = 'mockduo', daemon = True).start()
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Serve mock Duo Admin API logs')
+    ap.add_argument('-P', type=int, default=8443, help='Port (default 8443)')
+    ap.add_argument('-R', type=float, default=50.0, help='Authentication events per second (default 50)')
+    ap.add_argument('-H', type=float, default=0.0, help='Hours of backlog before now (default none)')
+    ap.add_argument('-p', type=int, default=1000, help='Rows per v1 page (default 1000)')
+    ap.add_argument('-L', type=float, default=0.0, help='Milliseconds of latency added to each request')
+    ap.add_argument('-E', type=float, default=0.0, help='Fraction of requests answered 429')
+    ap.add_argument('-Y', type=int, default=5, help='Retry-After seconds on a 429 (default 5)')
+    arg = ap.parse_args()
+
+    serve(arg.P, arg.R, arg.H, arg.p, arg.L, arg.E, arg.Y)
+    print('Serving mock Duo logs on 127.0.0.1:{port}'.format(port = arg.P))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Mocksink: Local stand-ins for the collectors the network sinks send to, a
+syslog receiver taking RFC 5424 messages over TCP with octet counting
+framing and an HTTP endpoint taking POSTed batches of JSON lines
+
+Every message is checked for the format the sinks promise and counted by
+log, separately for each collector.  Rows are also counted by their
+digest, so a test can tell rows lost from rows delivered twice.  Faults
+can be switched on: a fraction of HTTP batches refused with a 503, or the
+collectors down altogether for a while, the syslog port refusing
+connections as a stopped collector's would.  Syslog over TCP has no way to
+refuse a message, so what a syslog connection had in flight as the
+collector went down is lost, just as it would be.
+
+GET /mock/stats on the HTTP port returns the counts as JSON, and
+POST /mock/down?secs=N takes both collectors down for N seconds.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# <PRI>1 TIMESTAMP HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA MSG
+syslog_re = re.compile(rb'^<([0-9]{1,3})>1 ([0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+)?Z) (\S{1,255}) '
+                       rb'(\S{1,48}) (\S{1,128}) (\S{1,32}) (-|\[.*\]) (.*)$', re.S)
+
+
+class Counts:
+    """
+    What the collectors have received
+
+    rows:      Dict    -- Messages by log
+    seen:      Dict    -- Times each row digest was received
+    bad:       Integer -- Messages that weren't in the expected format
+    batches:   Integer -- Batches taken, syslog counting each read
+    refused:   Integer -- Batches refused on purpose
+    """
+    def __init__(self, errors = 0.0):
+        self.lock = threading.Lock()
+        self.errors = errors
+        self.down_until = 0
+        self.rows = {}
+        self.seen = {}
+        self.bad = 0
+        self.batches = 0
+        self.refused = 0
+
+    def down(self):
+        return time.time() < self.down_until
+
+    def fault(self):
+        """
+        Should this batch fail?
+        """
+        if self.down() or random.random() < self.errors:
+            with self.lock:
+                self.refused = self.refused + 1
+            return True
+        return False
+
+    def add(self, entries):
+        """
+        Count (log, row JSON) entries, None for one that was malformed
+        """
+        with self.lock:
+            self.batches = self.batches + 1
+            for entry in entries:
+                if entry is None:
+                    self.bad = self.bad + 1
+                    continue
+                log, row = entry
+                self.rows[log] = self.rows.get(log, 0) + 1
+                digest = hashlib.blake2b(row, digest_size = 16).digest()
+                self.seen[digest] = self.seen.get(digest, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rows': dict(self.rows),
+                'distinct': len(self.seen),
+                'duplicates': sum(n - 1 for n in self.seen.values()),
+                'bad': self.bad,
+                'batches': self.batches,
+                'refused': self.refused,
+            }
+
+
+def parse_syslog(msg):
+    m = syslog_re.match(msg)
+    if not m:
+        return None
+    try:
+        json.loads(m.group(9))
+    except ValueError:
+        return None
+    return m.group(7).decode('utf-8'), m.group(9)
+
+
+def syslog_reader(conn, counts):
+    """
+    Take messages from one connection until it closes or we go down
+    """
+    conn.settimeout(0.1)
+    buf = b''
+    with conn:
+        while not counts.down():
+            try:
+                data = conn.recv(1 << 16)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            buf = buf + data
+            entries = []
+            while True:
+                space = buf.find(b' ')
+                if space < 0:
+                    break
+                length = int(buf[:space])
+                if len(buf) < space + 1 + length:
+                    break
+                entries.append(parse_syslog(buf[space + 1:space + 1 + length]))
+                buf = buf[space + 1 + length:]
+            if entries:
+                counts.add(entries)
+
+
+def syslog_listener(port, counts):
+    """
+    Accept syslog connections, closing the port while we are down
+    """
+    while True:
+        sock = socket.create_server(('127.0.0.1', port))
+        sock.settimeout(0.1)
+        with sock:
+            while not counts.down():
+                try:
+                    conn, addr = sock.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target = syslog_reader, args = (conn, counts), daemon = True).start()
+        while counts.down():
+            time.sleep(0.05)
+
+
+class Http_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body = b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/mock/stats':
+            return self.reply(404)
+        stats = dict((name, counts.stats()) for name, counts in self.server.collectors.items())
+        self.reply(200, json.dumps(stats).encode('utf-8'))
+
+    def do_POST(self):
+        counts = self.server.counts
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/mock/down':
+            secs = float(urllib.parse.parse_qs(url.query).get('secs', ['10'])[0])
+            for each in self.server.collectors.values():
+                each.down_until = time.time() + secs
+            return self.reply(200)
+        if counts.fault():
+            return self.reply(503)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        entries = []
+        for line in body.splitlines():
+            try:
+                obj = json.loads(line)
+                entries.append((obj['log'], json.dumps(obj['event'], separators = (',', ':'), sort_keys = True).encode('utf-8')))
+            except (ValueError, KeyError):
+                entries.append(None)
+        counts.add(entries)
+        self.reply(204)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(syslog_port, http_port, errors = 0.0):
+    """
+    Start both collectors in the background, returns their Counts by name
+    """
+    collectors = {'syslog': Counts(), 'http': Counts(errors)}
+    threading.Thread(target = syslog_listener, args = (syslog_port, collectors['syslog']), daemon = True).start()
+    server = ThreadingHTTPServer(('127.0.0.1', http_port), Http_handler)
+    server.daemon_threads = True
+    server.counts = collectors['http']
+    server.collectors = collectors
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return collectors
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Serve mock syslog and HTTP collectors')
+    ap.add_argument('-S', type=int, default=6514, help='Syslog TCP port (default 6514)')
+    ap.add_argument('-P', type=int, default=8514, help='HTTP port (default 8514)')
+    ap.add_argument('-E', type=float, default=0.0, help='Fraction of HTTP batches refused')
+    arg = ap.parse_args()
+
+    serve(arg.S, arg.P, arg.E)
+    print('Serving mock syslog on 127.0.0.1:{syslog} and HTTP on 127.0.0.1:{http}'.format(syslog = arg.S, http = arg.P))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
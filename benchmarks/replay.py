@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Replay: Feed a LogWatcher from a fake Duo log that reorders and overlaps
+its pages, restarting and crashing the watcher along the way, and check
+that every row ends up archived exactly once
+"""
+
+import argparse
+import collections
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import archive
+import duo_watcher
+import durability
+import ratelimit
+
+
+class Response:
+    status = 200
+
+    def getheader(self, name, default = None):
+        return default
+
+
+class Fake:
+    """
+    Stands in for the Duo Admin client.  The log grows by a few seconds'
+    worth of rows per call; the rows of each second come back in a new
+    order every time, and with probability overlap a v1 page starts a few
+    seconds before mintime.
+
+    rows:      List    -- The whole log, in timestamp order
+    visible:   Integer -- Rows Duo has so far
+    sent:      Integer -- Rows handed out, counting repeats
+    """
+    def __init__(self, rows, overlap, rng):
+        self.rows = rows
+        self.overlap = overlap
+        self.rng = rng
+        self.visible = 0
+        self.sent = 0
+
+    def grow(self):
+        self.visible = min(len(self.rows), self.visible + self.rng.randint(0, 2500))
+
+    def shuffled(self, rows):
+        seconds = collections.OrderedDict()
+        for row in rows:
+            seconds.setdefault(row['timestamp'], []).append(row)
+        result = []
+        for group in seconds.values():
+            self.rng.shuffle(group)
+            result.extend(group)
+        return result
+
+    def api_call(self, method, path, params, consume = None):
+        self.grow()
+        rows = self.rows[:self.visible]
+        if '/v2/' in path:
+            data = self.v2(rows, params)
+            self.sent = self.sent + len(data['authlogs'])
+        else:
+            mintime = int(params['mintime'])
+            if self.rng.random() < self.overlap:
+                mintime = mintime - self.rng.randint(1, 5)
+            data = self.shuffled([row for row in rows if row['timestamp'] >= mintime])[:duo_watcher.V1_PAGE_LIMIT]
+            self.sent = self.sent + len(data)
+        body = json.dumps({'stat': 'OK', 'response': data}).encode('utf-8')
+        return Response(), consume(io.BytesIO(body)) if consume else body
+
+    def v2(self, rows, params):
+        def key(row):
+            return (ms(row), row['txid'])
+        rows = sorted((row for row in rows if int(params['mintime']) <= ms(row) < int(params['maxtime'])), key = key)
+        if params.get('next_offset'):
+            offset, txid = params['next_offset'].split(',')
+            rows = [row for row in rows if key(row) > (int(offset), txid)]
+        page = rows[:int(params['limit'])]
+        more = len(rows) > len(page)
+        return {
+            'authlogs': page,
+            'metadata': {'next_offset': [str(ms(page[-1])), page[-1]['txid']] if more else None},
+        }
+
+    def parse_json_response(self, response, data):
+        return json.loads(data)['response']
+
+
+def ms(row):
+    return int(datetime.datetime.fromisoformat(row['isotimestamp'].replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def generate(n, start, v2, rng):
+    """
+    n rows from start on, bunched into busy seconds.  v1 rows have no
+    txid and come from a small vocabulary, so identical rows in the same
+    second are common.
+    """
+    rows = []
+    timestamp = start
+    while len(rows) < n:
+        for i in range(min(n - len(rows), rng.choice([1, 1, 2, 5, 40, 300]))):
+            if v2:
+                stamp = datetime.datetime.fromtimestamp(timestamp + rng.randint(0, 999) / 1000.0, datetime.timezone.utc)
+                rows.append({
+                    'timestamp': timestamp,
+                    'isotimestamp': stamp.isoformat(timespec = 'milliseconds').replace('+00:00', 'Z'),
+                    'txid': '%032x' % rng.getrandbits(128),
+                    'user': {'name': 'user%d' % rng.randint(0, 50)},
+                    'result': rng.choice(['success', 'denied']),
+                })
+            else:
+                rows.append({
+                    'timestamp': timestamp,
+                    'username': 'admin%d' % rng.randint(0, 3),
+                    'action': rng.choice(['user_update', 'admin_login']),
+                })
+        timestamp = timestamp + rng.randint(1, 3)
+    if v2:
+        rows.sort(key = lambda row: (ms(row), row['txid']))
+    return rows
+
+
+def archived(dirname):
+    found = collections.Counter()
+    for name in os.listdir(dirname):
+        if durability.day_re.match(name):
+            for chunk in archive.read_chunks(os.path.join(dirname, name)):
+                found.update(chunk.splitlines())
+    return found
+
+
+def replay(dirname, rows, version, policy, overlap, restarts, rng):
+    api = Fake(rows, overlap, rng)
+    limiter = ratelimit.TokenBucket('replay', 1e9, 1e9)
+
+    def watcher():
+        return duo_watcher.LogWatcher('replay', 'authentication', api, version = version, path = dirname,
+                                      limiter = limiter, policy = durability.Policy(policy))
+
+    handle = watcher()
+    fetches = 0
+    new = True
+    # A watcher that keeps finding "new" rows is archiving duplicates
+    while (api.visible < len(rows) or new) and fetches < 100 + len(rows) // 100:
+        new = handle.fetch()
+        fetches = fetches + 1
+        if rng.random() < restarts:
+            if rng.random() < 0.5 and handle.unsaved:
+                # Crash: whatever wasn't committed is lost
+                handle.writer.flush()
+            else:
+                handle.save_state(force = True)
+            handle.writer.close()
+            handle = watcher()
+            new = True
+    handle.save_state(force = True)
+    handle.writer.close()
+    return api, fetches
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Replay a reordering, overlapping fake Duo log through a LogWatcher')
+    ap.add_argument('-n', type=int, default=50000, help='Rows in the log')
+    ap.add_argument('-2', dest='v2', action='store_true', help='Replay the v2 authentication log')
+    ap.add_argument('-s', default='rows:3000', help='Durability policy (default rows:3000)')
+    ap.add_argument('-o', type=float, default=0.3, help='Chance a v1 page starts before mintime')
+    ap.add_argument('-r', type=float, default=0.02, help='Chance of a restart or crash after a fetch')
+    ap.add_argument('--seed', type=int, default=1)
+    arg = ap.parse_args()
+
+    rng = random.Random(arg.seed)
+    rows = generate(arg.n, int(time.time()) - 2 * 86400, arg.v2, rng)
+    top = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        dirname = os.path.join(top, 'replay')
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            t0 = time.perf_counter()
+            api, fetches = replay(dirname, rows, 2 if arg.v2 else 1, arg.s, arg.o, arg.r, rng)
+            elapsed = time.perf_counter() - t0
+        finally:
+            sys.stdout = stdout
+        expected = collections.Counter(archive.encode(row).encode('utf-8') for row in rows)
+        found = archived(dirname)
+    finally:
+        shutil.rmtree(top)
+
+    missing = sum((expected - found).values())
+    extra = sum((found - expected).values())
+    print('{n} rows, {sent} sent in {fetches} fetches, {secs:.2f}s: {missing} missing, {extra} duplicated'.format(
+        n = len(rows), sent = api.sent, fetches = fetches, secs = elapsed, missing = missing, extra = extra))
+    return 1 if missing or extra else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
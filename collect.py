@@ -4,93 +4,486 @@ Collect: Collect Duo logs
 """
 
 import argparse
+import json
 import os
 import re
-import sys
 import time
-import traceback
-from threading import Thread, Event
+from threading import BoundedSemaphore, Thread, Event
 from time import localtime, strftime
 
+import archive
 import argus_daemon
+import config
+import durability
 import duo_watcher
+import export
+import ha
+import metrics
+import oplog
+import ratelimit
+import scheduler
+import sinks
+import stream
+import tally
+import transport
 
 
 def looper(tp):
     """
     Thread to loop forever scarfing up Duo log messages, yum, yum
     """
-    print('{ts} {pid}: Thread {name} starting.'.format(
-        ts = time.strftime('%y-%m-%d %H:%M:%S'),
-        pid = os.getpid(),
-        name = tp.name))
-    sys.stdout.flush()
+    oplog.info('Thread {name} starting.', name = tp.name)
 
-    while not tp.terminate.isSet():
-        while not tp.terminate.isSet():
+    if not owned(tp):
+        tp.status = 'Standby'
+        return
+
+    if tp.handle is None:
+        try:
+            add_watcher(tp)
+        except Exception as errtxt:
+            tp.alert = 8
+            tp.status = 'Unable to open the log: {msg}'.format(msg = errtxt)
+            oplog.error('Thread {name} failed: {error}', exc = True, name = tp.name, error = str(errtxt))
+            return
+
+    while not tp.terminate.isSet() and owned(tp):
+        while not tp.terminate.isSet() and owned(tp):
             tp.timestamp = time.time()
-            result = tp.handle.fetch()
-            tp.count = tp.count + 1
-            t0 = strftime('%H:%M:%S', localtime(tp.timestamp))
-            t1 = strftime('%y-%m-%d %H:%M:%S', localtime(tp.handle.state['timestamp']))
-            tp.status = 'At {wall} up to {log} count: {count} interval: {val}'.format(wall=t0, log=t1, count=tp.count, val=tp.interval)
-            if tp.handle.backoff > 0:
-                tp.status = tp.status + '+{bo}'.format(bo=tp.handle.backoff)
-            if not result:
+            with workers:
+                result = tp.handle.fetch()
+            if not finish_cycle(tp, result):
                 break
-        tp.terminate.wait(tp.interval + tp.handle.backoff)
+        tp.terminate.wait(tp.interval)
         if tp.maxcount > 0 and tp.count > tp.maxcount:
             break
 
+    if tp.handle.backfill:
+        tp.handle.backfill.stop()
+    if tp.handle.unsaved:
+        tp.handle.save_state(force = True)
+    if tp.handle.tally:
+        tp.handle.tally.close()
     tp.status = 'Stopped ' + tp.status
 
-    print('{ts} {pid}: Thread {name} terminating.'.format(
-        ts = time.strftime('%y-%m-%d %H:%M:%S'),
-        pid = os.getpid(),
-        name = tp.name))
-    sys.stdout.flush()
+    oplog.info('Thread {name} terminating.', name = tp.name)
 
-#
-#  Initialize our thread descriptions
-#
 
-threads = [
-    argus_daemon.Argus_thread('auth', 'authentication', auto = True, target = looper),
-    argus_daemon.Argus_thread('admin', 'administrator', auto = True, target = looper),
-    argus_daemon.Argus_thread('phone', 'telephony', auto = True, target = looper)
-]
+def owned(tp):
+    """
+    Whether tp's log is ours to collect: always, unless we share the logs
+    with other instances and don't hold its lease
+    """
+    return coordinator is None or coordinator.role(tp.name) == 'owner'
+
+
+def finish_cycle(tp, result):
+    """
+    Count a completed fetch cycle, pick the next interval and refresh the
+    thread's status line.  Returns True to fetch again right away.
+    """
+    again = result
+    if tp.handle.schedule:
+        tp.interval = tp.handle.schedule.observe(tp.handle)
+        again = result and tp.handle.schedule.behind()
+
+    tp.count = tp.count + 1
+    t0 = strftime('%H:%M:%S', localtime(tp.timestamp))
+    t1 = strftime('%y-%m-%d %H:%M:%S', localtime(tp.handle.state['timestamp']))
+    tp.status = 'At {wall} up to {log} count: {count} interval: {val}'.format(wall=t0, log=t1, count=tp.count, val=tp.interval)
+    return again
+
+
+def answer(line):
+    """
+    Answer the Argus queries the daemon itself doesn't handle
+    """
+    if line == 'help':
+        text = ('P3Help yourself\n\n' +
+                'Commands are:\n' +
+                '  clear: Clear status\n' +
+                '  status: Report status\n' +
+                '  rotate: Logfile rotation\n' +
+                '  reload: Apply changes to argus_cf and credentials\n' +
+                '  thread {name} start\n' +
+                '  thread {name} stop\n' +
+                '  thread {name} interval {seconds}\n' +
+                '  thread {name} maxcount {count}\n' +
+                '  tally {name} [day] [by field,...] [where field=value,...] [top N] [json]\n' +
+                'Threads are:\n')
+
+        for tp in threads:
+            text = text + '  {name}: Duo {resource} log watcher\n'.format(name = tp.name, resource = tp.resource)
+        return text
+
+    if line == 'reload':
+        try:
+            changes = reload()
+        except Exception as errtxt:
+            return 'P5Reload failed: {msg}'.format(msg = errtxt)
+        if not changes:
+            return 'P0No changes'
+        return 'P2Reloaded\n\n' + ''.join(line + '\n' for line in changes)
+
+    if line.startswith('tally '):
+        return report(line.split()[1:])
+
+    return 'P5Unrecognized command'
+
+
+def report(words):
+    """
+    Answer a tally query on a thread's log, see tally.py
+    """
+    tp = next((tp for tp in threads if words and tp.name == words[0]), None)
+    if tp is None:
+        return 'P5No such thread'
+    if tp.handle is None or tp.handle.tally is None:
+        return 'P5{name} is not tallied'.format(name = tp.name)
+    try:
+        day, by, where, top, as_json = tally.parse(words[1:])
+        result = tp.handle.tally.report(day, by, where, top)
+    except ValueError as errtxt:
+        return 'P5{msg}'.format(msg = errtxt)
+    if as_json:
+        return 'P0' + json.dumps(result) + '\n'
+    return 'P0' + tally.render(result)
+
+
+def make_threads(tenants, cf):
+    """
+    The Argus_threads for every log of every tenant
+    """
+    made = []
+    for tenant in tenants:
+        for name, resource in config.logs(cf):
+            if tenant != duo_watcher.DEFAULT_TENANT:
+                name = tenant + '.' + name
+            made.append(argus_daemon.Argus_thread(name, resource, auto = True, target = looper, group = tenant,
+                                                  interval = cf.get('interval', config.INTERVAL)))
+    return made
+
+
+def add_tenant(tenant, keys):
+    """
+    Set up the API client, polling budget and rate limit of a tenant
+    """
+    clients[tenant] = duo_watcher.make_client(keys)
+    budgets[tenant] = scheduler.Budget(arg.b)
+    limiters[tenant] = ratelimit.TokenBucket(tenant, arg.r)
+    argus.reporters.append(limiters[tenant].status)
+
+
+def where(tp):
+    """
+    The log version and archive directory of an Argus_thread's log
+    """
+    version = 2 if arg.v2 and tp.resource == 'authentication' else 1
+    return version, duo_watcher.tenant_dir(tp.group, tp.name.split('.')[-1])
+
+
+def add_watcher(tp):
+    """
+    Give an Argus_thread the LogWatcher for its log.  Opening the archive
+    and reconciling the state file can take a while, so each thread does
+    this for itself once started rather than holding up the daemon.
+    """
+    version, path = where(tp)
+    schedule = None
+    if arg.A:
+        schedule = scheduler.Adaptive(tp.name, budgets[tp.group], low = arg.l, high = arg.u, interval = tp.interval)
+    tp.handle = duo_watcher.LogWatcher(tp.name, tp.resource, clients[tp.group], version = version, path = path,
+                                       schedule = schedule, limiter = limiters[tp.group],
+                                       fmt = arg.z, keys = arg.k, bus = bus, policy = arg.s, slices = arg.B,
+                                       outputs = outputs, tallied = arg.t and tp.resource == 'authentication')
+    if exporter:
+        tp.handle.writer.on_close.append(exporter)
+
+
+def reload():
+    """
+    Re-read argus_cf and the credentials and apply what changed, without
+    touching the watchers that stay: a new default interval, logs and
+    tenants added or removed, and new keys for a tenant, which are swapped
+    into its watchers between calls.  Returns lines saying what changed.
+    """
+    global cf, tenants
+    new_cf = config.load(argus.cf_path)
+    new_tenants = duo_watcher.load_tenants(CREDENTIALS)
+
+    changes = ['argus_cf: ' + line for line in config.diff(cf, new_cf)]
+    for key in config.RESTART_KEYS:
+        if cf.get(key) != new_cf.get(key):
+            changes.append('argus_cf: {key} needs a restart to take effect'.format(key = key))
+    changes.extend('credentials: ' + line for line in config.diff(tenants, new_tenants, secret = True))
+
+    for tenant in new_tenants:
+        if tenant not in tenants:
+            add_tenant(tenant, new_tenants[tenant])
+        elif new_tenants[tenant] != tenants[tenant]:
+            clients[tenant] = duo_watcher.make_client(new_tenants[tenant])
+            for tp in threads:
+                if tp.group == tenant and tp.handle:
+                    tp.handle.api = clients[tenant]
+
+    oplog.set_level(new_cf.get('loglevel', 'info'))
+
+    interval = new_cf.get('interval', config.INTERVAL)
+    if interval != cf.get('interval', config.INTERVAL):
+        for tp in threads:
+            if tp.handle and tp.handle.schedule:
+                # The adaptive scheduler picks its own
+                continue
+            tp.interval = interval
+            tp.changed()
+
+    wanted = dict((tp.name, tp) for tp in make_threads(new_tenants, new_cf))
+    for tp in list(threads):
+        if tp.name not in wanted or wanted[tp.name].resource != tp.resource:
+            if tp.active:
+                argus.runner.background(argus.stop_thread, tp)
+            threads.remove(tp)
+            changes.append('thread {name} removed'.format(name = tp.name))
+    have = set(tp.name for tp in threads)
+    for name, tp in wanted.items():
+        if name in have:
+            continue
+        threads.append(tp)
+        if coordinator:
+            tp.status = 'Standby'
+        else:
+            try:
+                argus.runner.start(tp)
+            except Exception as errtxt:
+                tp.alert = 8
+                tp.status = errtxt
+        changes.append('thread {name} added'.format(name = name))
+
+    for tenant in tenants:
+        if tenant not in new_tenants:
+            argus.reporters.remove(limiters[tenant].status)
+            del clients[tenant], budgets[tenant], limiters[tenant]
+
+    cf = new_cf
+    tenants = new_tenants
+    return changes
+
+
+def coordinate():
+    """
+    Thread renewing our leases and starting and stopping our watchers and
+    standby copies to match, see ha.py
+    """
+    while not leaving.is_set():
+        try:
+            roles = coordinator.tick([tp.name for tp in threads])
+            for tp in list(threads):
+                match(tp, roles.get(tp.name))
+        except Exception:
+            oplog.error('Unhandled exception sharing the logs', exc = True)
+        leaving.wait(coordinator.ttl / 5)
+
+
+def match(tp, role):
+    """
+    Start or stop tp's watcher, and our standby copy of its log, to match
+    our role for it
+    """
+    if role == 'owner' and not tp.active and tp.name not in handing:
+        unfollow(tp.name)
+        try:
+            argus.runner.start(tp)
+        except Exception as errtxt:
+            tp.alert = 8
+            tp.status = errtxt
+    elif role != 'owner' and tp.active and tp.name not in handing:
+        handing.add(tp.name)
+        argus.runner.background(hand_over, tp)
+    owner = coordinator.owner(tp.name) if role == 'standby' else None
+    if tp.name in followers and followers[tp.name].owner != owner:
+        unfollow(tp.name)
+    if owner and tp.name not in followers and not tp.active:
+        version, path = where(tp)
+        followers[tp.name] = ha.Follower(tp.name, path, owner, version = version, fmt = arg.z, keys = arg.k,
+                                         fsync = arg.s.fsync, secret = coordinator.secret)
+
+
+def hand_over(tp):
+    """
+    Stop the watcher of a log we no longer hold, or are asked to give up,
+    then let the lease go.  The watcher is opened afresh if the log comes
+    back to us, from the copy we keep of it meanwhile.
+    """
+    try:
+        if not argus.runner.stop(tp):
+            oplog.error('Thread {name} could not be joined.', name = tp.name)
+            return
+        if tp.handle:
+            tp.handle.writer.close()
+            tp.handle = None
+        tp.status = 'Standby'
+        coordinator.release(tp.name)
+    finally:
+        handing.discard(tp.name)
+
+
+def unfollow(name):
+    follower = followers.pop(name, None)
+    if follower:
+        follower.stop()
+
+
+def poll():
+    """
+    Reload whenever the configuration files change
+    """
+    if not watcher.changed():
+        return
+    changes = reload()
+    if not changes:
+        return
+    oplog.info('Reloaded configuration', changes = changes)
+
+
+def setup(top = '.'):
+    """
+    Read argus_cf and the credentials in top, describe our threads and
+    start the Argus listener, which changes to its rundir.  Nothing is
+    done at import, so the module can be loaded by tools and benchmarks.
+    """
+    global CREDENTIALS, cf, tenants, watcher, argus
+    CREDENTIALS = os.path.abspath(os.path.join(top, 'credentials'))
+    cf_path = os.path.abspath(os.path.join(top, 'argus_cf'))
+    cf = config.load(cf_path)
+    oplog.set_level(cf.get('loglevel', 'info'))
+    tenants = duo_watcher.load_tenants(CREDENTIALS)
+    threads[:] = make_threads(tenants, cf)
+    watcher = config.Watcher([cf_path, CREDENTIALS])
+    argus = argus_daemon.Argus(threads, cf_path = cf_path)
+    return argus
 
 #
-#  Start the Argus listener and become a proper daemon
+#  Our thread descriptions, filled in by setup().  The list itself is
+#  shared with the Argus, the metrics server and the engine.
 #
 
-argus = argus_daemon.Argus(threads)
+CREDENTIALS = None
+cf = None
+tenants = {}
+threads = []
+watcher = None
+argus = None
+
+#  Set up by main() for reload() to build watchers the same way
+
+arg = None
+exporter = None
+bus = None
+outputs = []
+coordinator = None
+clients = {}
+budgets = {}
+limiters = {}
+
+#  Bounds the number of fetches running at once, whatever the number of threads
+
+workers = BoundedSemaphore(4)
+
+#  Our standby copies of the logs other instances own, and the logs we are
+#  handing over, when we share the logs with them
+
+followers = {}
+handing = set()
+leaving = Event()
 
 
 def main():
     ap = argparse.ArgumentParser(description='Collect Duo Logs')
     ap.add_argument('-d', action='store_true', help='Become a deamon')
+    ap.add_argument('-C', default='.', help='Directory holding argus_cf and credentials (default the current one)')
+    ap.add_argument('-2', dest='v2', action='store_true', help='Use the cursor paged v2 authentication log')
+    ap.add_argument('-a', action='store_true', help='Run the watchers on one asyncio event loop')
+    ap.add_argument('-w', type=int, default=4, help='Maximum number of Duo API calls at once')
+    ap.add_argument('-r', type=float, default=ratelimit.RATE, help='Duo API calls per minute allowed per account')
+    ap.add_argument('-z', choices=archive.FORMATS, help='Write compressed daily archives')
+    ap.add_argument('-k', action='store_true', help='Index the archives by username and device')
+    ap.add_argument('-x', choices=export.FORMATS, help='Export each day to a columnar file once it is over')
+    ap.add_argument('-S', type=int, help='Stream new rows to subscribers on this localhost TCP port')
+    ap.add_argument('-U', help='Stream new rows to subscribers on this Unix socket')
+    ap.add_argument('-s', type=durability.Policy, default=durability.Policy(),
+                    help='When to commit the archives and state files: none, batch (the default), rows:N or ms:T')
+    ap.add_argument('-B', type=int, default=0, help='Catch up on gaps of over an hour by fetching this many time slices at once')
+    ap.add_argument('-m', type=int, help='Serve Prometheus metrics on this HTTP port')
+    ap.add_argument('-A', action='store_true', help='Adapt polling intervals to the log volume')
+    ap.add_argument('-b', type=float, default=scheduler.BUDGET, help='Duo API calls per minute per account with -A')
+    ap.add_argument('-l', type=int, default=scheduler.MIN_INTERVAL, help='Shortest polling interval with -A')
+    ap.add_argument('-u', type=int, default=scheduler.MAX_INTERVAL, help='Longest polling interval with -A')
+    ap.add_argument('-t', action='store_true', help='Keep hourly tallies of the authentication logs, see tally.py')
+    global arg, workers, exporter, bus, coordinator
     arg = ap.parse_args()
+    workers = BoundedSemaphore(arg.w)
+
+    #
+    #  Start the Argus listener and become a proper daemon
+    #
+
+    setup(arg.C)
 
     if arg.d:
         argus.deamonize()
 
-    print('{ts} {pid}: Duo collection daemon starting...'.format(
-        ts = time.strftime('%y-%m-%d %H:%M:%S'),
-        pid = os.getpid()))
-    sys.stdout.flush()
+    oplog.info('Duo collection daemon starting...')
+
+    argus.reporters.append(transport.status)
+    argus.reporters.append(oplog.status)
+
+    exporter = export.Exporter(arg.x) if arg.x else None
+
+    if 'ha' in cf:
+        if arg.a:
+            ap.error('Sharing the logs with other instances (ha in argus_cf) needs the threaded runner, not -a')
+        ha_cf = cf['ha']
+        if not ha_cf.get('secret'):
+            ap.error('Sharing the logs with other instances needs a shared secret for their streams (secret in ha in argus_cf)')
+        coordinator = ha.Coordinator(ha_cf['dir'], ha_cf.get('instance'), ha_cf.get('host'),
+                                     ha_cf.get('port', ha.PORT), ha_cf.get('ttl', ha.TTL), ha_cf['secret'])
+        argus.reporters.append(coordinator.status)
+
+    if arg.S or arg.U or coordinator:
+        bus = stream.Bus()
+        argus.reporters.append(bus.status)
+
+    outputs[:] = sinks.make(cf)
+    for sink in outputs:
+        argus.reporters.append(sink.status)
+
+    for tenant in tenants:
+        add_tenant(tenant, tenants[tenant])
+
+    argus.pollers.append(poll)
+
+    if bus:
+        stream.serve(bus, port = arg.S, path = arg.U)
+    if coordinator:
+        stream.serve(bus, addr = cf['ha'].get('bind'), port = coordinator.port, secret = coordinator.secret)
+        Thread(target = coordinate, name = 'ha', daemon = True).start()
+
+    if arg.m:
+        metrics.serve(threads, arg.m, sinks = outputs)
+
+    if arg.a:
+        import async_collect
+        engine = async_collect.Engine(argus, threads, finish_cycle, answer, workers = arg.w, prepare = add_watcher)
+        engine.main()
+        return
 
     for tp in threads:
-        tp.handle = duo_watcher.LogWatcher(tp.name, tp.resource)
-        if tp.auto:
+        if tp.auto and not coordinator:
             try:
-                tp.thread = Thread(target=looper, args=(tp,))
-                tp.thread.start()
+                argus.runner.start(tp)
             except Exception as errtxt:
                 tp.alert = 8
                 tp.status = errtxt
-            else:
-                tp.active = True
 
     #
     #  Enter the main loop
@@ -100,54 +493,44 @@ def main():
         try:
             line = argus.getMessage()
         except KeyboardInterrupt:
-            print('')
             break
         except:
-            print('Exiting loop because of unhandled exception')
-            traceback.print_exc()
+            oplog.error('Exiting loop because of unhandled exception', exc = True)
             break
 
         if not line:
             break
 
-        answer = 'P5Unrecognized command'
-
-        if line == 'help':
-            answer = ('P3Help yourself\n\n' +
-                      'Commands are:\n' +
-                      '  clear: Clear status\n' +
-                      '  status: Report status\n' +
-                      '  rotate: Logfile rotation\n' +
-                      '  thread {name} start\n' +
-                      '  thread {name} stop\n' +
-                      '  thread {name} interval {seconds}\n' +
-                      '  thread {name} maxcount {count}\n' +
-                      'Threads are:\n')
-
-            for tp in threads:
-                answer = answer + '  {name}: Duo {resource} log watcher\n'.format(name = tp.name, resource = tp.resource)
-
-        argus.sendResponse(answer)
+        argus.sendResponse(answer(line), line)
 
     #
     #  Clean up after termination
     #
 
-    print('Exiting main loop.')
-    sys.stdout.flush()
+    oplog.info('Exiting main loop.')
 
+    leaving.set()
     for tp in threads:
         if tp.active:
             tp.terminate.set()
 
     for tp in threads:
         if tp.active:
-            print('Joining thread for {name}'.format(name = tp.name))
-            sys.stdout.flush()
+            oplog.info('Joining thread for {name}', name = tp.name)
             tp.thread.join(10.0)
         tp.active = False
         tp.thread = None
 
+    for name in list(followers):
+        unfollow(name)
+    if coordinator:
+        coordinator.leave()
+
+    for sink in outputs:
+        sink.close()
+
+    oplog.flush()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,91 @@
+"""
+Config: Notice changes to the collector's configuration files and work
+out what changed, so they can be applied without a restart
+"""
+
+import json
+import os
+
+# argus_cf entries only read at startup
+RESTART_KEYS = ('addr', 'port', 'tcp_port', 'tcp_addr', 'rundir', 'logfile', 'pidfile', 'sinks', 'spool', 'ha')
+
+# The logs collected for every tenant, unless argus_cf has a "logs" entry
+# mapping directory names to Duo log names
+LOGS = [
+    ('auth', 'authentication'),
+    ('admin', 'administrator'),
+    ('phone', 'telephony'),
+]
+
+# Polling interval of each watcher, unless argus_cf has an "interval"
+INTERVAL = 90
+
+
+def load(fname):
+    with open(fname) as fp:
+        return json.load(fp)
+
+
+def logs(cf):
+    """
+    The (name, resource) pairs of the logs argus_cf asks for
+    """
+    if 'logs' in cf:
+        return list(cf['logs'].items())
+    return list(LOGS)
+
+
+def fingerprint(paths):
+    """
+    (path, mtime, size) of each file in paths, or of the JSON files in it
+    for a directory, to tell when any of them changes
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.json'))
+        else:
+            names = [path]
+        for name in names:
+            try:
+                st = os.stat(name)
+            except FileNotFoundError:
+                continue
+            found.append((name, st.st_mtime_ns, st.st_size))
+    return found
+
+
+def diff(old, new, secret = False):
+    """
+    Lines saying how dict new differs from dict old.  With secret set the
+    values are left out.
+    """
+    lines = []
+    for key in sorted(set(old) | set(new)):
+        if key not in new:
+            lines.append('- {key}'.format(key = key))
+        elif key not in old:
+            lines.append('+ {key}'.format(key = key) if secret else
+                         '+ {key}: {new}'.format(key = key, new = json.dumps(new[key])))
+        elif old[key] != new[key]:
+            lines.append('~ {key}'.format(key = key) if secret else
+                         '~ {key}: {old} -> {new}'.format(key = key, old = json.dumps(old[key]), new = json.dumps(new[key])))
+    return lines
+
+
+class Watcher:
+    """
+    Tells when any of a set of configuration files or directories has
+    changed since we last looked.  Polling mtimes needs nothing beyond
+    the standard library and works on any filesystem.
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        self.seen = fingerprint(paths)
+
+    def changed(self):
+        found = fingerprint(self.paths)
+        if found == self.seen:
+            return False
+        self.seen = found
+        return True
@@ -0,0 +1,82 @@
+"""
+Dedup: Recognise the log rows a fetch gets back that we've already archived
+"""
+
+import collections
+import hashlib
+import json
+
+import archive
+
+# Most digests kept, far more rows than Duo logs in one second
+WINDOW_ROWS = 10000
+
+
+def digests(rows):
+    """
+    Digest each row, numbering identical rows so that two real events
+    that happen to look the same in the same second stay distinct
+    """
+    seen = collections.Counter()
+    result = []
+    for row in rows:
+        if isinstance(row, archive.Row):
+            row = row.decode()
+        text = json.dumps(row, sort_keys = True, separators = (',', ':'))
+        seen[text] = seen[text] + 1
+        data = '{text}#{n}'.format(text = text, n = seen[text]).encode('utf-8')
+        result.append(hashlib.blake2b(data, digest_size = 8).hexdigest())
+    return result
+
+
+class Window:
+    """
+    Digests of the rows archived with the latest timestamp.  Duo's mintime
+    is in whole seconds, so each fetch gets the rows of the second it
+    resumes from back again, in no particular order; they are picked out
+    by digest rather than by position.  The digests are kept in the state
+    file, so resuming is exact across restarts too.
+
+    timestamp: Integer -- Timestamp of the rows the digests are for
+    digests:   Deque   -- Their digests, oldest first, at most WINDOW_ROWS
+    """
+    def __init__(self, timestamp = 0, seen = ()):
+        self.timestamp = timestamp
+        self.digests = collections.deque(seen, WINDOW_ROWS)
+        self.members = set(self.digests)
+
+    def add(self, digest):
+        if len(self.digests) == self.digests.maxlen:
+            self.members.discard(self.digests[0])
+        self.digests.append(digest)
+        self.members.add(digest)
+
+    def filter(self, rows, after = False):
+        """
+        Returns the rows we haven't archived yet, in timestamp order, and
+        remembers them.  Rows from before our timestamp are older than the
+        mintime of any fetch and are dropped.  With after set the rows are
+        known to follow everything we have (they come after a v2 cursor),
+        so they are only remembered.
+        """
+        rows = sorted(rows, key = lambda row: row.get('timestamp', 0))
+        current = [row for row in rows if row.get('timestamp', 0) == self.timestamp]
+        fresh = []
+        if current:
+            known = set() if after else self.members
+            for row, digest in zip(current, digests(current)):
+                if digest not in known:
+                    fresh.append(row)
+                    self.add(digest)
+        fresh.extend(row for row in rows if row.get('timestamp', 0) > self.timestamp)
+        if fresh and fresh[-1].get('timestamp', 0) > self.timestamp:
+            self.timestamp = fresh[-1].get('timestamp', 0)
+            last = [row for row in fresh if row.get('timestamp', 0) == self.timestamp]
+            self.digests.clear()
+            self.members.clear()
+            for digest in digests(last):
+                self.add(digest)
+        return fresh
+
+    def dump(self):
+        return list(self.digests)
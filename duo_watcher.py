@@ -2,109 +2,363 @@
 Duo_watcher: Access Duo logs
 """
 
-import duo_client
+import archive
+import backfill
+import datetime
+import dedup
+import durability
 import json
+import metrics
 import errno
+import oplog
+import pages
+import ratelimit
+import sinks
+import tally
 import time
-import sys
 import os
 
 
-with open('credentials/duo.json') as fp:
-    keys = json.load(fp)
+# The tenant whose credentials are in credentials/duo.json; its logs
+# live in the top level auth, admin and phone directories.
+DEFAULT_TENANT = 'default'
 
-# Configuration and information about objects to create.
-admin_api = duo_client.Admin(
-    ikey = keys['ikey'],
-    skey = keys['skey'],
-    host = keys['apihost']
-)
+
+def load_tenants(dirname = 'credentials'):
+    """
+    Returns {tenant: keys} for each credential set in dirname.  duo.json
+    holds the keys of the default tenant, any other {tenant}.json those of
+    an additional Duo account.
+    """
+    tenants = {}
+    for fname in sorted(os.listdir(dirname)):
+        if not fname.endswith('.json'):
+            continue
+        tenant = fname[:-5]
+        if tenant == 'duo':
+            tenant = DEFAULT_TENANT
+        with open(os.path.join(dirname, fname)) as fp:
+            tenants[tenant] = json.load(fp)
+    return tenants
+
+
+def tenant_dir(tenant, name):
+    """
+    Returns the directory holding the state and archive of a tenant's log
+    """
+    if tenant == DEFAULT_TENANT:
+        return name
+    return os.path.join(tenant, name)
+
+
+def make_client(keys):
+    """
+    Build a Duo Admin API client from a credential set.  A set may also
+    give a port and duo_client's ca_certs, e.g. "HTTP" to talk plain HTTP
+    to benchmarks/mockduo.py.
+    """
+    # duo_client comes in with transport, and only the collector needs it
+    import transport
+    extra = {}
+    for key in ('port', 'ca_certs'):
+        if key in keys:
+            extra[key] = keys[key]
+    return transport.PooledAdmin(
+        ikey = keys['ikey'],
+        skey = keys['skey'],
+        host = keys['apihost'],
+        **extra
+    )
+
+
+# The v2 log API wants a maxtime, and Duo suggests staying a couple of
+# minutes behind real time so late arriving events aren't skipped.
+V2_MAXTIME_LAG = 120
+V2_PAGE_LIMIT = 1000
+
+# The v1 log API returns at most this many rows at a time
+V1_PAGE_LIMIT = 1000
 
 
 class LogWatcher:
-    def __init__(self, name, resource):
+    """
+    Fetches one Duo log and archives it under path, which defaults to name.
+
+    api:       Admin   -- Duo Admin API client for the log's account
+    schedule:  Adaptive -- Picks our polling interval, or None for fixed
+    limiter:   TokenBucket -- Rate limit shared with the account's other logs
+    fmt:       String  -- Compressed archive format, or None for plain files
+    keys:      Boolean -- Keep a username/device index of the archive
+    bus:       Bus     -- Where to publish newly archived rows, if anywhere
+    sinks:     List    -- Where archived rows go: a File_sink for our daily
+                          files, then the network sinks in outputs, which
+                          are shared with other watchers
+    stalled:   Boolean -- A required sink refused our last commit
+    tally:     Tally_sink -- Hourly counts of our log kept as rows are
+                          archived, the last of our sinks, or None
+    policy:    Policy  -- When to commit the archive and state file
+    received:  Integer -- Rows in the last page fetched
+    page:      Integer -- Most rows a page can hold
+    accepted:  Integer -- Rows archived since we started
+    metrics:   Watcher_metrics -- Call, page and commit statistics
+    window:    Window  -- Digests of the archived rows at the state's timestamp
+    unsaved:   Integer -- Rows archived since our last commit
+    since:     Float   -- Monotonic time of the first of those rows
+    limited:   Boolean -- Whether our last call was held up by the rate limit
+    until:     time_t  -- Only fetch rows before this, or None for no end
+    slices:    Integer -- Time slices to fetch at once to catch up on a gap
+                          of over backfill.BACKFILL_GAP, or 0 not to
+    backfill:  Backfill -- The catch-up under way, or None
+    """
+    def __init__(self, name, resource, api, version = 1, path = None, schedule = None, limiter = None, fmt = None, keys = False, bus = None,
+                 policy = None, until = None, slices = 0, outputs = (), tallied = False):
         self.name = name
+        self.path = path or name
         self.resource = resource
-        self.logname = None
-        self.backoff = 0
+        self.api = api
+        self.version = version
+        self.schedule = schedule
+        self.limiter = limiter or ratelimit.TokenBucket(name)
+        self.received = 0
+        self.page = V2_PAGE_LIMIT if version == 2 else V1_PAGE_LIMIT
+        self.accepted = 0
+        self.metrics = metrics.Watcher_metrics()
+        self.writer = archive.DailyArchive(self.path, fmt, keys)
+        self.policy = policy or durability.Policy()
+        self.writer.fsync = self.policy.fsync
+        self.sinks = [sinks.File_sink(self.writer)] + list(outputs)
+        self.stalled = False
+        self.tally = None
+        self.bus = bus
+        self.pending = []
+        self.unsaved = 0
+        self.since = 0
+        self.limited = False
+        self.until = until
+        self.slices = slices
+        self.backfill = None
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
         try:
-            with open(name + '/state') as fp:
+            with open(self.path + '/state') as fp:
                 self.state = json.load(fp)
         except IOError as e:
             if e.errno == errno.ENOENT:
                 self.state = {'timestamp': 0, 'count': 0}
             else:
-                print('Unable to load {file}: {msg}'.format(
-                    file = os.path.realpath(name + '/state'), msg = msg))
-                sys.stdout.flush()
+                oplog.error('Unable to load {file}: {error}', file = os.path.realpath(self.path + '/state'), error = str(e))
                 raise
         except Exception as msg:
-            print('Unable to load {file}: {msg}'.format(
-                file = os.path.realpath(name + '/state'), msg = msg))
-            sys.stdout.flush()
+            oplog.error('Unable to load {file}: {error}', file = os.path.realpath(self.path + '/state'), error = str(msg))
             raise
+        found = self.reconcile()
+        seen = self.state.get('seen')
+        if seen is None and found and found[0] == self.state.get('timestamp', 0):
+            # State files from before we kept digests
+            seen = dedup.digests([json.loads(line) for line in found[2]])
+        self.window = dedup.Window(self.state.get('timestamp', 0), seen or ())
+        if tallied:
+            self.tally = tally.Tally_sink(self.path, (self.state.get('timestamp', 0), self.state.get('count', 0)))
+            self.sinks.append(self.tally)
+        if bus:
+            bus.register(name, self.path, (self.state.get('timestamp', 0), self.state.get('count', 0)))
 
     def fetch(self):
-        try:
+        """
+        Fetch whatever is new in our log and archive it.  Returns True if
+        anything new was archived.
+        """
+        if self.slices and not self.backfill and self.behind():
+            self.backfill = backfill.Backfill(self, self.slices)
+        if self.backfill:
+            return self.backfill.step()
+
+        if self.stalled and not self.save_state(force = True):
+            return False
+
+        if self.version == 2:
+            return self.fetch_v2()
+
+        params = {
+            'mintime': str(self.state.get('timestamp', 0))
+        }
+        response = self.call('/admin/v1/logs/' + self.resource, params)
+        if response is None:
+            return False
+        if self.until:
+            response = [row for row in response if row.get('timestamp', 0) < self.until]
+
+        newRow = self.archive(response)
+        if self.unsaved:
+            self.save_state(force = self.received < self.page)
+        return newRow
+
+    def fetch_v2(self):
+        """
+        Fetch from the v2 authentication log, following the next_offset
+        cursors until the log is drained.  The cursor of the last row we
+        archived is kept in our state file so the next cycle picks up
+        exactly where this one left off.
+        """
+        newRow = False
+        maxtime = int((time.time() - V2_MAXTIME_LAG) * 1000)
+        if self.until:
+            maxtime = min(maxtime, self.until * 1000 - 1)
+        while True:
             params = {
-                'mintime': str(self.state.get('timestamp', 0))
+                'mintime': str(self.state.get('timestamp', 0) * 1000),
+                'maxtime': str(maxtime),
+                'limit': str(V2_PAGE_LIMIT),
+                'sort': 'ts:asc',
             }
-            response = admin_api.json_api_call(
-                'GET',
-                '/admin/v1/logs/' + self.resource,
-                params,
-            )
-        except RuntimeError as e:
-            if e.args == ('Received 429 Too Many Requests',):
-                self.backoff = 1 + 2 * self.backoff
-                if self.backoff > 1800:
-                    self.backoff = 1800
-                if self.backoff > 10:
-                    print('{ts} {pid}: Backing off to {bo} on {name}'.format(
-                        ts = time.strftime('%y-%m-%d %H:%M:%S'),
-                        pid = os.getpid(),
-                        bo = self.backoff,
-                        name = self.name))
-                    sys.stdout.flush()
-                return False
-            raise
-        else:
-            self.backoff = self.backoff / 2
+            cursor = self.state.get('next_offset')
+            if cursor:
+                params['next_offset'] = ','.join(cursor)
+            response = self.call('/admin/v2/logs/' + self.resource, params)
+            if response is None:
+                break
 
-        prev_ts = -1
-        newRow = False
-        for row in response:
+            rows = response.get('authlogs', [])
+            archived = self.archive(rows, after = bool(cursor))
+            if archived:
+                self.state['next_offset'] = v2_cursor(rows[-1])
+                self.save_state()
+                newRow = True
+                if self.stalled:
+                    break
+
+            metadata = response.get('metadata') or {}
+            if not rows or not metadata.get('next_offset'):
+                break
+
+        if self.unsaved:
+            self.save_state(force = True)
+        return newRow
+
+    def call(self, path, params):
+        """
+        Make a GET request within our account's rate limit.  Returns the
+        decoded response, its rows as archive.Rows, or None if the rate
+        limit got in the way.
+        """
+        t0 = time.monotonic()
+        acquired = self.limiter.acquire(ratelimit.weight(path))
+        t1 = time.monotonic()
+        self.metrics.backoff = self.metrics.backoff + (t1 - t0)
+        self.limited = not acquired
+        if self.limited:
+            return None
+        response, data = self.api.api_call('GET', path, params, consume = pages.read)
+        self.metrics.calls.observe(time.monotonic() - t1)
+        if response.status == 429:
+            self.metrics.throttled = self.metrics.throttled + 1
+            self.limited = True
+            wait = ratelimit.retry_after(response)
+            self.limiter.throttle(wait)
+            oplog.warning('Too many requests on {name}, holding off {secs:.0f}s', key = ('429', self.name),
+                          name = self.name, secs = wait)
+            return None
+        self.limiter.update(response)
+        return pages.parse(self.api, response, data)
+
+    def behind(self):
+        """
+        Is there a gap worth backfilling, or one we started on already?
+        A log we have nothing of yet just pages forward from the start.
+        """
+        timestamp = self.state.get('timestamp', 0)
+        if not timestamp:
+            return False
+        if os.path.exists(self.path + '/backfill/plan'):
+            return True
+        now = time.time() - (V2_MAXTIME_LAG if self.version == 2 else 0)
+        return now - timestamp > backfill.BACKFILL_GAP
+
+    def archive(self, response, after = False):
+        """
+        Append the rows we haven't seen before to the daily log files,
+        keeping our state at the timestamp of the last one and the count
+        of rows archived with it.  With after set the rows follow a v2
+        cursor, so they are all new.  Returns True if anything was written.
+        """
+        rows = self.window.filter(response, after)
+        counts = []
+        for row in rows:
             timestamp = row.get('timestamp', 0)
-            if timestamp == prev_ts:
-                count = count + 1
+            if timestamp == self.state.get('timestamp', 0):
+                self.state['count'] = self.state.get('count', 0) + 1
             else:
-                prev_ts = timestamp
-                count = 1
-            if (timestamp > self.state.get('timestamp', 0) or
-                    (timestamp == self.state.get('timestamp', 0) and count > self.state.get('count', 0))):
-                tm = time.localtime(timestamp)
-                fname = time.strftime(self.name + '/%y%m%d', tm)
-                if self.logname and self.logname != fname:
-                    self.logfp.close()
-                    self.logname = None
-                if not self.logname:
-                    self.logname = fname
-                    self.logfp = open(fname, 'a')
-                    print('{ts} {pid}: Advancing to {file}'.format(
-                        ts = time.strftime('%y-%m-%d %H:%M:%S'),
-                        pid = os.getpid(),
-                        file = os.path.realpath(fname)))
-                    sys.stdout.flush()
-                json.dump(row, self.logfp)
-                self.logfp.write('\n')
                 self.state['timestamp'] = timestamp
-                self.state['count'] = count
-                newRow = True
+                self.state['count'] = 1
+            counts.append(self.state['count'])
+        self.received = len(response)
+        self.metrics.rows.observe(self.received)
+        if rows:
+            if not self.unsaved:
+                self.since = time.monotonic()
+            self.unsaved = self.unsaved + len(rows)
+            lines = [archive.row_line(row) for row in rows]
+            for sink in self.sinks:
+                sink.write(self.name, rows, lines)
+            if self.bus:
+                self.pending.extend(zip([row.get('timestamp', 0) for row in rows], counts, lines))
+            self.accepted = self.accepted + len(rows)
+        return len(rows) > 0
 
-        if newRow:
-            self.logfp.flush()
-            with open(self.name + '/state.new', 'w') as fp:
-                json.dump(self.state, fp)
-                fp.write('\n')
-            os.rename(self.name + '/state.new', self.name + '/state')
-        return newRow
+    def save_state(self, force = False):
+        """
+        Commit the log and our state file together if our durability
+        policy says it's time, or force is set.  Rows are only published
+        once committed.  Returns True if we committed.  If a required sink
+        refuses the rows we are stalled: nothing more is fetched until a
+        later commit gets them through.
+        """
+        if not force and not self.policy.due(self.unsaved, self.since):
+            return False
+        self.state['seen'] = self.window.dump()
+        t0 = time.monotonic()
+        self.stalled = not durability.commit(self.sinks, self.path, self.state, self.policy.fsync, self.name)
+        if self.stalled:
+            return False
+        self.metrics.commits.observe(time.monotonic() - t0)
+        self.unsaved = 0
+        if self.pending:
+            self.bus.publish(self.name, self.pending)
+            self.pending = []
+        return True
+
+    def reconcile(self):
+        """
+        Bring our state in line with the end of the archive, which is what
+        survived if we went down between archiving rows and committing: a
+        state file ahead of the archive is rolled back so the lost rows are
+        fetched again, one behind it is rolled forward so the rows we have
+        aren't archived twice.
+        """
+        found = durability.tail(self.path)
+        position = (self.state.get('timestamp', 0), self.state.get('count', 0))
+        if found is None or found[:2] == position:
+            return found
+        oplog.warning('Rolling {name} state {way} from {old} to {new}', name = self.name,
+                      way = 'back' if found[:2] < position else 'forward', old = list(position), new = list(found[:2]))
+        self.state['timestamp'], self.state['count'] = found[:2]
+        self.state.pop('seen', None)
+        if self.version == 2:
+            cursor = v2_cursor(json.loads(found[2][-1]))
+            if cursor:
+                self.state['next_offset'] = cursor
+            else:
+                self.state.pop('next_offset', None)
+        return found
+
+
+def v2_cursor(row):
+    """
+    Build the v2 next_offset cursor (milliseconds, txid) for a log row.
+    The millisecond timestamp comes from isotimestamp since the integer
+    timestamp only has whole seconds.
+    """
+    if not row.get('txid') or not row.get('isotimestamp'):
+        return None
+    ts = datetime.datetime.fromisoformat(row['isotimestamp'].replace('Z', '+00:00'))
+    return [str(int(ts.timestamp() * 1000)), row['txid']]
@@ -0,0 +1,127 @@
+"""
+Durability: Decide when a LogWatcher commits its archive and state file,
+do the commit, and square the state file with the archive after a crash
+"""
+
+import json
+import os
+import re
+import time
+
+import archive
+
+day_re = re.compile(r'^[0-9]{6}(\.(' + '|'.join(archive.FORMATS) + r'))?$')
+
+
+class Policy:
+    """
+    When to commit, parsed from one of
+
+        none      commit after every batch, without fsync (the old behavior)
+        batch     commit after every batch
+        rows:N    commit once N rows are waiting
+        ms:T      commit once the oldest waiting row has waited T ms
+
+    A fetch that finds its log caught up always commits whatever is
+    waiting, so rows are only held back while we are catching up.
+
+    fsync:     Boolean -- Force the archive and state file to disk
+    rows:      Integer -- Rows to wait for, or 0
+    interval:  Float   -- Seconds to wait, or 0
+    """
+    def __init__(self, text = 'batch'):
+        kind, sep, value = text.partition(':')
+        if kind not in ('none', 'batch', 'rows', 'ms') or bool(sep) != (kind in ('rows', 'ms')):
+            raise ValueError('Bad durability policy {text}'.format(text = text))
+        self.text = text
+        self.fsync = kind != 'none'
+        self.rows = int(value) if kind == 'rows' else 0
+        self.interval = float(value) / 1000 if kind == 'ms' else 0
+
+    def __repr__(self):
+        return self.text
+
+    def due(self, rows, since):
+        """
+        Is it time to commit, with rows waiting since the monotonic time since?
+        """
+        if self.rows:
+            return rows >= self.rows
+        if self.interval:
+            return time.monotonic() - since >= self.interval
+        return True
+
+
+def fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit(sinks, dirname, state, fsync = True, log = None):
+    """
+    Make what log has written to sinks durable, then atomically replace
+    the state file in dirname.  With fsync each sink, the archive first,
+    syncs once, before the new state is written, synced and renamed into
+    place, and the directory is synced last so both the rename and any new
+    daily files survive a crash; the state file never gets ahead of the
+    archive.  Returns False, leaving the state file alone, if a required
+    sink didn't take the rows.
+    """
+    acked = True
+    for sink in sinks:
+        if not sink.commit(log, fsync) and sink.required:
+            acked = False
+    if not acked:
+        return False
+    with open(dirname + '/state.new', 'w') as fp:
+        fp.write(json.dumps(state) + '\n')
+        if fsync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.rename(dirname + '/state.new', dirname + '/state')
+    if fsync:
+        fsync_dir(dirname)
+    return True
+
+
+def last_rows(fname):
+    """
+    Returns (timestamp, count, lines) for the rows of a daily file with
+    its last timestamp, count being how many there are, or None if the
+    file holds no complete rows.  Only the chunks holding the last
+    timestamp are read.
+    """
+    index = archive.load_index(fname)
+    start = index[-1]['t1'] if index else None
+    last = None
+    lines = []
+    for chunk in archive.read_chunks(fname, start):
+        for line in chunk.splitlines(True):
+            timestamp = json.loads(line).get('timestamp', 0)
+            if timestamp != last:
+                last = timestamp
+                lines = []
+            lines.append(line)
+    return (last, len(lines), lines) if lines else None
+
+
+def tail(dirname):
+    """
+    Returns (timestamp, count, lines) for the rows archived in dirname
+    with the latest timestamp, (timestamp, count) being the position the
+    state file should hold, or None if there are no daily files
+    """
+    names = [name for name in os.listdir(dirname) if day_re.match(name)]
+    if not names:
+        return None
+    day = max(name[:6] for name in names)
+    found = None
+    for name in names:
+        if name.startswith(day):
+            last = last_rows(os.path.join(dirname, name))
+            if last and (found is None or last[:2] > found[:2]):
+                found = last
+    return found
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Export: Convert closed daily archives into columnar Parquet or Arrow files
+"""
+
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+import archive
+import oplog
+
+# pyarrow takes a while to import, so it's only loaded by check(), the
+# first time something is actually exported
+pyarrow = None
+
+FORMATS = ('parquet', 'arrow')
+
+day_re = re.compile(r'^[0-9]{6}(\.(' + '|'.join(archive.FORMATS) + r'))?$')
+
+
+def check():
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.feather
+            import pyarrow.parquet
+        except ImportError:
+            pyarrow = None
+            raise RuntimeError('Columnar export needs the pyarrow package')
+
+
+def flatten(row, prefix = '', out = None):
+    """
+    Flatten nested objects into dotted column names.  Lists are kept as
+    JSON text.
+    """
+    if out is None:
+        out = {}
+    for key, value in row.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flatten(value, name + '.', out)
+        elif isinstance(value, list):
+            out[name] = json.dumps(value)
+        else:
+            out[name] = value
+    return out
+
+
+def column(values):
+    """
+    Build a typed Arrow array for one column: integers, floats and
+    booleans keep their types, anything else becomes dictionary encoded
+    strings
+    """
+    kinds = set(type(value) for value in values if value is not None)
+    if kinds == {bool}:
+        return pyarrow.array(values, pyarrow.bool_())
+    if kinds == {int}:
+        return pyarrow.array(values, pyarrow.int64())
+    if kinds and kinds <= {int, float}:
+        return pyarrow.array(values, pyarrow.float64())
+    strings = [None if value is None else str(value) for value in values]
+    return pyarrow.array(strings, pyarrow.string()).dictionary_encode()
+
+
+def table(fname):
+    """
+    Read a daily file into an Arrow table of flattened columns, plus a
+    'time' column holding the timestamp as a proper timestamp type
+    """
+    rows = []
+    for chunk in archive.read_chunks(fname):
+        for line in chunk.splitlines():
+            rows.append(flatten(json.loads(line)))
+
+    names = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    arrays = [column([row.get(name) for row in rows]) for name in names]
+    if 'timestamp' in seen:
+        names.append('time')
+        arrays.append(pyarrow.array([row.get('timestamp') for row in rows], pyarrow.int64()).cast(pyarrow.timestamp('s', 'UTC')))
+    return pyarrow.table(arrays, names = names)
+
+
+def target(fname, fmt):
+    """
+    Returns the columnar file name for a daily file
+    """
+    base = fname
+    for ext in archive.FORMATS:
+        if base.endswith('.' + ext):
+            base = base[:-len(ext) - 1]
+    return base + '.' + fmt
+
+
+def export(fname, fmt = 'parquet'):
+    """
+    Write the columnar copy of one daily file, returns its name
+    """
+    check()
+    out = target(fname, fmt)
+    tmp = out + '.new'
+    data = table(fname)
+    if fmt == 'parquet':
+        pyarrow.parquet.write_table(data, tmp, compression = 'zstd', use_dictionary = True)
+    else:
+        pyarrow.feather.write_feather(data, tmp, compression = 'zstd')
+    os.rename(tmp, out)
+    return out
+
+
+class Exporter:
+    """
+    Exports daily files on a background thread, so a DailyArchive can hand
+    over each day as it closes it without holding up the watcher
+    """
+    def __init__(self, fmt = 'parquet'):
+        check()
+        self.fmt = fmt
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.run, name = 'export', daemon = True)
+        self.thread.start()
+
+    def __call__(self, fname):
+        self.queue.put(fname)
+
+    def run(self):
+        while True:
+            fname = self.queue.get()
+            try:
+                out = export(fname, self.fmt)
+            except Exception as errtxt:
+                oplog.error('Unable to export {file}: {error}', file = os.path.realpath(fname), error = str(errtxt))
+            else:
+                oplog.info('Exported {file}', file = os.path.realpath(out))
+
+
+def pending(dirname, fmt):
+    """
+    The daily files in dirname, other than today's, with no up to date
+    columnar copy
+    """
+    today = time.strftime('%y%m%d')
+    for name in sorted(os.listdir(dirname)):
+        if not day_re.match(name) or name.startswith(today):
+            continue
+        fname = os.path.join(dirname, name)
+        out = target(fname, fmt)
+        if not os.path.exists(out) or os.path.getmtime(out) < os.path.getmtime(fname):
+            yield fname
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Export daily Duo log archives to columnar files')
+    ap.add_argument('-F', choices=FORMATS, default='parquet', help='Output format (default parquet)')
+    ap.add_argument('-d', default='auth', help='Export every closed day in this directory not yet exported')
+    ap.add_argument('files', nargs='*', help='Export just these daily files')
+    arg = ap.parse_args()
+
+    check()
+    for fname in arg.files or pending(arg.d, arg.F):
+        print(export(fname, arg.F))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
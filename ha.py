@@ -0,0 +1,417 @@
+"""
+HA: Share the watchers between collectors on more than one logger.  The
+instances keep a lease table in a directory they can all reach, which
+says who owns each watcher and who stands by for it, and each standby
+follows its owner's stream to keep a copy of the log it can take over.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+import archive
+import durability
+import duo_watcher
+import oplog
+import sinks
+
+# Seconds a lease or membership lasts without being renewed
+TTL = 10.0
+
+# TCP port the instances stream their logs to each other on
+PORT = 2682
+
+# Seconds between a standby's commits of what it has followed
+COMMIT_SECONDS = 1.0
+
+# Seconds a standby waits before trying its owner again
+RETRY_SECONDS = 2.0
+
+# Seconds a standby waits on a quiet connection
+READ_TIMEOUT = 1.0
+
+TABLE = 'leases.json'
+LOCK = 'leases.lock'
+
+
+@contextlib.contextmanager
+def locked(dirname, timeout):
+    """
+    Hold the lock on the lease table in dirname, giving up with an OSError
+    after timeout seconds.  lockf locks are seen across NFS clients, and
+    the lock goes with the process if it dies holding it.
+    """
+    fd = os.open(os.path.join(dirname, LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN) or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield
+    finally:
+        os.close(fd)
+
+
+def load(dirname):
+    try:
+        with open(os.path.join(dirname, TABLE)) as fp:
+            table = json.load(fp)
+    except FileNotFoundError:
+        table = {}
+    table.setdefault('members', {})
+    table.setdefault('leases', {})
+    return table
+
+
+def store(dirname, table, instance):
+    fname = os.path.join(dirname, TABLE)
+    with open(fname + '.' + instance, 'w') as fp:
+        fp.write(json.dumps(table, indent = 1, sort_keys = True) + '\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(fname + '.' + instance, fname)
+
+
+def spread(name, member):
+    """
+    Where member falls among the candidates for log name, so ties go to a
+    different instance for each log but the same one every time
+    """
+    return hashlib.blake2b((name + '\0' + member).encode('utf-8'), digest_size = 8).digest()
+
+
+def plan(table, names):
+    """
+    Have the leases of table target an even spread of the logs in names
+    over its members, each with a standby on another member if there is
+    one.  Logs stay where they are as long as their instance isn't over
+    its share, so adding an instance only moves the logs it takes on.
+    """
+    leases = table['leases']
+    for name in list(leases):
+        if name not in names:
+            del leases[name]
+    members = sorted(table['members'])
+    if not members:
+        return
+    share = -(-len(names) // len(members))
+    load = dict.fromkeys(members, 0)
+    homeless = []
+    for name in sorted(names):
+        lease = leases.setdefault(name, {'owner': None, 'expires': 0, 'epoch': 0})
+        where = lease.get('target') if lease.get('target') in load else lease['owner']
+        if where in load and load[where] < share:
+            lease['target'] = where
+            load[where] = load[where] + 1
+        else:
+            homeless.append(name)
+    for name in homeless:
+        where = min(members, key = lambda member: (load[member], spread(name, member)))
+        leases[name]['target'] = where
+        load[where] = load[where] + 1
+
+    standing = dict.fromkeys(members, 0)
+    for name in sorted(names):
+        lease = leases[name]
+        others = [member for member in members if member != lease['target']]
+        if not others:
+            lease['standby'] = None
+            continue
+        if lease.get('standby') not in others:
+            lease['standby'] = min(others, key = lambda member: (standing[member], load[member], spread(name, member)))
+        standing[lease['standby']] = standing[lease['standby']] + 1
+
+
+class Coordinator:
+    """
+    One instance's membership of the lease table.  Every tick() renews our
+    membership and the leases we hold under the table's lock; the leader,
+    whichever instance holds the leader lease, also plans who should own
+    each log.  An owner asked to give a log up stops its watcher, then
+    releases the lease, and the new owner picks it up at its next tick.
+    A dead owner's leases lapse after ttl seconds and are taken over the
+    same way.  Clocks must agree to well within ttl.
+
+    dirname:   String  -- Directory holding the lease table, shared by the
+                          instances
+    instance:  String  -- Our name in the table
+    host:      String  -- Where the other instances reach our stream
+    port:      Integer -- And on what port
+    secret:    String  -- What the instances' streams ask each other for
+    ttl:       Float   -- Seconds a lease lasts unless renewed
+    roles:     Dict    -- What we are for each log: 'owner', 'release' when
+                          we should give it up, 'standby' or None
+    owners:    Dict    -- (host, port) of the owner of each log we stand
+                          by for
+    stopped:   Set     -- Logs we were asked to give up and have stopped
+    leader:    Boolean -- Whether we hold the leader lease
+    valid:     Float   -- Monotonic time our leases can be relied on until
+    ticks:     Integer -- Renewals that went through
+    failures:  Integer -- Renewals that didn't
+    """
+    def __init__(self, dirname, instance = None, host = None, port = PORT, ttl = TTL, secret = None):
+        self.dirname = dirname
+        self.instance = instance or socket.gethostname()
+        self.host = host or socket.getfqdn()
+        self.port = port
+        self.secret = secret
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.roles = {}
+        self.owners = {}
+        self.stopped = set()
+        self.leader = False
+        self.valid = 0
+        self.ticks = 0
+        self.failures = 0
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def tick(self, names):
+        """
+        Renew our membership and leases, taking up the logs in names
+        targeted at us and giving back the ones we have stopped.  Returns
+        our roles; after an OSError, such as the shared directory going
+        away, we still hold what we held until valid.
+        """
+        t0 = time.monotonic()
+        try:
+            with locked(self.dirname, self.ttl / 4):
+                table = load(self.dirname)
+                now = time.time()
+                members = table['members']
+                for member in list(members):
+                    if members[member]['expires'] < now and member != self.instance:
+                        del members[member]
+                members[self.instance] = {'host': self.host, 'port': self.port, 'expires': now + self.ttl}
+                leader = table.get('leader') or {}
+                if leader.get('instance') == self.instance or leader.get('expires', 0) < now:
+                    if leader.get('instance') != self.instance:
+                        oplog.info('Leading the collectors as {instance}', instance = self.instance)
+                    table['leader'] = {'instance': self.instance, 'expires': now + self.ttl}
+                self.leader = table['leader']['instance'] == self.instance
+                if self.leader:
+                    plan(table, names)
+                roles, owners = self.claim(table, now)
+                store(self.dirname, table, self.instance)
+        except (OSError, ValueError) as errtxt:
+            self.failures = self.failures + 1
+            oplog.warning('Unable to renew our leases in {dirname}: {error}', dirname = self.dirname, error = str(errtxt))
+            with self.lock:
+                if time.monotonic() > self.valid:
+                    self.roles = dict((name, None) for name in self.roles)
+                    self.owners = {}
+                return dict(self.roles)
+        with self.lock:
+            self.roles = roles
+            self.owners = owners
+            # Stop relying on them well before anyone else may take them
+            self.valid = t0 + self.ttl / 2
+            self.ticks = self.ticks + 1
+            return dict(roles)
+
+    def claim(self, table, now):
+        """
+        Our part of a tick, the table locked: renew, take and release
+        leases.  Returns our roles and the owners we follow.
+        """
+        roles = {}
+        owners = {}
+        for name, lease in table['leases'].items():
+            target = lease.get('target')
+            if lease['owner'] == self.instance:
+                if target == self.instance:
+                    lease['expires'] = now + self.ttl
+                    roles[name] = 'owner'
+                elif name in self.stopped:
+                    lease['owner'] = None
+                    lease['expires'] = 0
+                    roles[name] = None
+                    oplog.info('Released {name} to {target}', name = name, target = target)
+                else:
+                    lease['expires'] = now + self.ttl
+                    roles[name] = 'release'
+            elif target == self.instance and (lease['owner'] is None or lease['expires'] < now):
+                lease['owner'] = self.instance
+                lease['expires'] = now + self.ttl
+                lease['epoch'] = lease.get('epoch', 0) + 1
+                roles[name] = 'owner'
+                oplog.info('Took {name} over (epoch {epoch})', name = name, epoch = lease['epoch'])
+            elif lease.get('standby') == self.instance and lease['owner'] in table['members']:
+                member = table['members'][lease['owner']]
+                roles[name] = 'standby'
+                owners[name] = (member['host'], member['port'])
+            else:
+                roles[name] = None
+        self.stopped = set(name for name in self.stopped if roles.get(name) == 'release')
+        return roles, owners
+
+    def role(self, name):
+        with self.lock:
+            if time.monotonic() > self.valid:
+                return None
+            return self.roles.get(name)
+
+    def owner(self, name):
+        with self.lock:
+            return self.owners.get(name)
+
+    def release(self, name):
+        """
+        Note that our watcher of name has stopped, so the lease can go
+        """
+        with self.lock:
+            self.stopped.add(name)
+
+    def leave(self):
+        """
+        Give up everything at once as we shut down, once our watchers have
+        stopped, so the standbys needn't wait for our leases to lapse
+        """
+        try:
+            with locked(self.dirname, self.ttl / 4):
+                table = load(self.dirname)
+                table['members'].pop(self.instance, None)
+                if (table.get('leader') or {}).get('instance') == self.instance:
+                    del table['leader']
+                for lease in table['leases'].values():
+                    if lease['owner'] == self.instance:
+                        lease['owner'] = None
+                        lease['expires'] = 0
+                    if lease.get('target') == self.instance:
+                        lease['target'] = None
+                store(self.dirname, table, self.instance)
+        except (OSError, ValueError) as errtxt:
+            oplog.warning('Unable to give up our leases in {dirname}: {error}', dirname = self.dirname, error = str(errtxt))
+        with self.lock:
+            self.roles = {}
+            self.valid = 0
+
+    def status(self):
+        with self.lock:
+            owned = sorted(name for name, role in self.roles.items() if role in ('owner', 'release'))
+            standby = sorted(name for name, role in self.roles.items() if role == 'standby')
+            lapsed = ' leases lapsed' if self.roles and time.monotonic() > self.valid else ''
+            return 'ha: {instance}{leader} owns {owned}, stands by for {standby}{lapsed}\n'.format(
+                instance = self.instance, leader = ' (leader)' if self.leader else '',
+                owned = ', '.join(owned) or 'nothing', standby = ', '.join(standby) or 'nothing', lapsed = lapsed)
+
+
+class Follower:
+    """
+    Keeps a standby's copy of a log another instance owns: the owner's
+    stream is archived as it comes, and the state file follows it, so
+    that when we take the log over our own LogWatcher picks up from the
+    last row we got, with its seen digests and v2 cursor rebuilt from the
+    end of the archive.  We follow on from the end of our copy, or from
+    the start of the day for a new one; older days are for a one off copy
+    like a migration's.
+
+    path:      String  -- Our copy of the log
+    owner:     Tuple   -- (host, port) of the owner's stream
+    secret:    String  -- What the owner's stream asks for
+    rows:      Integer -- Rows followed since we started
+    """
+    def __init__(self, name, path, owner, version = 1, fmt = None, keys = False, fsync = True, secret = None):
+        self.name = name
+        self.path = path
+        self.owner = owner
+        self.secret = secret
+        self.version = version
+        self.fmt = fmt
+        self.keys = keys
+        self.fsync = fsync
+        self.rows = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = 'follow ' + name, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        oplog.info('Following {name} from {host}:{port}', name = self.name, host = self.owner[0], port = self.owner[1])
+        while not self.stopping.is_set():
+            try:
+                self.follow()
+            except (OSError, ValueError) as errtxt:
+                oplog.warning('Lost {name} from {host}:{port}: {error}', name = self.name, host = self.owner[0],
+                              port = self.owner[1], error = str(errtxt))
+                self.stopping.wait(RETRY_SECONDS)
+
+    def follow(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        found = durability.tail(self.path)
+        state = {'timestamp': found[0], 'count': found[1]} if found else {'timestamp': 0, 'count': 0}
+        resume = [state['timestamp'], state['count']] if found else [archive.day_bounds(time.time())[0], 0]
+        request = {'log': self.name, 'resume': resume}
+        if self.secret:
+            request['secret'] = self.secret
+        writer = archive.DailyArchive(self.path, self.fmt, self.keys)
+        writer.fsync = self.fsync
+        files = [sinks.File_sink(writer)]
+        try:
+            with socket.create_connection(self.owner, timeout = READ_TIMEOUT * 10) as sock:
+                sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                sock.settimeout(READ_TIMEOUT)
+                buf = b''
+                dirty = False
+                committed = time.monotonic()
+                while not self.stopping.is_set():
+                    try:
+                        data = sock.recv(1 << 16)
+                    except socket.timeout:
+                        data = None
+                    if data == b'':
+                        raise OSError('The owner hung up')
+                    if data:
+                        buf = buf + data
+                        frames = buf.split(b'\n')
+                        buf = frames.pop()
+                        if frames:
+                            self.archive(writer, state, frames)
+                            dirty = True
+                    if dirty and time.monotonic() - committed >= COMMIT_SECONDS:
+                        durability.commit(files, self.path, state, self.fsync, self.name)
+                        dirty = False
+                        committed = time.monotonic()
+                if dirty:
+                    durability.commit(files, self.path, state, self.fsync, self.name)
+        finally:
+            writer.close()
+
+    def archive(self, writer, state, frames):
+        """
+        Archive [timestamp, count, row] frames from the owner, keeping each
+        row's JSON as the owner archived it
+        """
+        rows = []
+        lines = []
+        for frame in frames:
+            if frame.startswith(b'{'):
+                raise ValueError(json.loads(frame).get('error', 'refused'))
+            start = frame.index(b',', frame.index(b',') + 1) + 1
+            line = frame[start:-1].decode('utf-8')
+            obj = json.loads(line)
+            rows.append(archive.Row(obj, line))
+            lines.append(line)
+            state['timestamp'], state['count'] = json.loads(frame[:start - 1] + b']')
+            if self.version == 2:
+                cursor = duo_watcher.v2_cursor(obj)
+                if cursor:
+                    state['next_offset'] = cursor
+        writer.write(rows, lines)
+        self.rows = self.rows + len(rows)
+
+    def stop(self, timeout = 10.0):
+        self.stopping.set()
+        self.thread.join(timeout)
@@ -0,0 +1,183 @@
+"""
+Metrics: Per watcher counters and histograms, served over HTTP in the
+Prometheus text exposition format
+"""
+
+import bisect
+import http.server
+import threading
+import time
+
+import oplog
+
+# Histogram bucket upper bounds
+CALL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROWS_BUCKETS = (0, 1, 10, 100, 250, 500, 1000)
+COMMIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets.  Like the rest of a
+    Watcher_metrics it is only updated from its watcher's own fetches, so
+    there is no lock; a scrape may catch a count one observation ahead of
+    the sum, which Prometheus doesn't mind.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+
+    def lines(self, name, labels):
+        total = 0
+        for le, n in zip(self.buckets + ('+Inf',), list(self.counts)):
+            total = total + n
+            yield '{name}_bucket{{{labels},le="{le}"}} {n}\n'.format(name = name, labels = labels, le = le, n = total)
+        yield '{name}_sum{{{labels}}} {sum}\n'.format(name = name, labels = labels, sum = self.sum)
+        yield '{name}_count{{{labels}}} {n}\n'.format(name = name, labels = labels, n = total)
+
+
+class Watcher_metrics:
+    """
+    What one LogWatcher counts as it goes
+
+    calls:     Histogram -- Seconds per Duo API call
+    rows:      Histogram -- Rows per page fetched
+    commits:   Histogram -- Seconds per archive and state file commit
+    throttled: Integer -- 429 responses
+    backoff:   Float   -- Seconds spent waiting on the rate limit
+    """
+    def __init__(self):
+        self.calls = Histogram(CALL_BUCKETS)
+        self.rows = Histogram(ROWS_BUCKETS)
+        self.commits = Histogram(COMMIT_BUCKETS)
+        self.throttled = 0
+        self.backoff = 0.0
+
+
+# (name, type, help, function of (Argus_thread, now)) for the simple values
+GAUGES = [
+    ('duo_watcher_up', 'gauge', 'Whether the watcher thread is running',
+     lambda tp, now: 1 if alive(tp) else 0),
+    ('duo_watcher_rows_total', 'counter', 'Rows archived since startup',
+     lambda tp, now: tp.handle.accepted),
+    ('duo_watcher_written_bytes_total', 'counter', 'Bytes written to the daily files since startup',
+     lambda tp, now: tp.handle.writer.written),
+    ('duo_watcher_ingest_lag_seconds', 'gauge', 'Age of the newest archived row',
+     lambda tp, now: now - tp.handle.state.get('timestamp', 0)),
+    ('duo_watcher_last_fetch_timestamp_seconds', 'gauge', 'When the last fetch started',
+     lambda tp, now: tp.timestamp),
+    ('duo_watcher_interval_seconds', 'gauge', 'Current polling interval',
+     lambda tp, now: tp.interval),
+    ('duo_watcher_backoff_seconds_total', 'counter', 'Seconds spent waiting on the rate limit',
+     lambda tp, now: tp.handle.metrics.backoff),
+    ('duo_watcher_throttled_total', 'counter', '429 responses from Duo',
+     lambda tp, now: tp.handle.metrics.throttled),
+]
+
+HISTOGRAMS = [
+    ('duo_watcher_call_seconds', 'Duo API call latency', 'calls'),
+    ('duo_watcher_fetch_rows', 'Rows per page fetched', 'rows'),
+    ('duo_watcher_commit_seconds', 'Archive and state file commit latency', 'commits'),
+]
+
+# The same for each network sink, as functions of the Spooled_sink
+SINK_GAUGES = [
+    ('duo_watcher_sink_rows_total', 'counter', 'Rows delivered by the sink since startup',
+     lambda sink: sink.rows),
+    ('duo_watcher_sink_sent_bytes_total', 'counter', 'Bytes delivered by the sink since startup',
+     lambda sink: sink.sent),
+    ('duo_watcher_sink_batches_total', 'counter', 'Batches delivered by the sink since startup',
+     lambda sink: sink.batches),
+    ('duo_watcher_sink_errors_total', 'counter', 'Failed sends to the sink',
+     lambda sink: sink.errors),
+    ('duo_watcher_sink_dropped_total', 'counter', 'Rows the sink had no room for',
+     lambda sink: sink.dropped),
+    ('duo_watcher_sink_refused_total', 'counter', 'Commits held up by the sink',
+     lambda sink: sink.refused),
+    ('duo_watcher_sink_spooled_bytes', 'gauge', 'Bytes waiting in the sink\'s spool',
+     lambda sink: sink.spool.waiting()),
+]
+
+SINK_HISTOGRAMS = [
+    ('duo_watcher_sink_send_seconds', 'Sink batch delivery latency', 'sends'),
+]
+
+
+def alive(tp):
+    """
+    Is the watcher's thread, or asyncio task, running?
+    """
+    thread = tp.thread
+    if not tp.active or thread is None:
+        return False
+    if hasattr(thread, 'done'):
+        return not thread.done()
+    return thread.is_alive()
+
+
+def render(threads, sinks = ()):
+    """
+    The metrics of every watcher and network sink in the text exposition
+    format
+    """
+    now = time.time()
+    watchers = [(tp, 'log="{name}",tenant="{group}"'.format(name = tp.name, group = tp.group)) for tp in threads if tp.handle]
+    out = []
+    for name, kind, text, value in GAUGES:
+        out.append('# HELP {name} {text}\n# TYPE {name} {kind}\n'.format(name = name, text = text, kind = kind))
+        for tp, labels in watchers:
+            out.append('{name}{{{labels}}} {value}\n'.format(name = name, labels = labels, value = value(tp, now)))
+    for name, text, attr in HISTOGRAMS:
+        out.append('# HELP {name} {text}\n# TYPE {name} histogram\n'.format(name = name, text = text))
+        for tp, labels in watchers:
+            out.extend(getattr(tp.handle.metrics, attr).lines(name, labels))
+    labelled = [(sink, 'sink="{name}"'.format(name = sink.name)) for sink in sinks]
+    for name, kind, text, value in SINK_GAUGES if sinks else []:
+        out.append('# HELP {name} {text}\n# TYPE {name} {kind}\n'.format(name = name, text = text, kind = kind))
+        for sink, labels in labelled:
+            out.append('{name}{{{labels}}} {value}\n'.format(name = name, labels = labels, value = value(sink)))
+    for name, text, attr in SINK_HISTOGRAMS if sinks else []:
+        out.append('# HELP {name} {text}\n# TYPE {name} histogram\n'.format(name = name, text = text))
+        for sink, labels in labelled:
+            out.extend(getattr(sink, attr).lines(name, labels))
+    return ''.join(out)
+
+
+class Metrics_handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        data = render(self.server.threads, self.server.sinks).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class Metrics_server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def serve(threads, port, addr = '', sinks = ()):
+    """
+    Serve the metrics of threads' watchers and of sinks on /metrics in the
+    background, returns the server
+    """
+    server = Metrics_server((addr, port), Metrics_handler)
+    server.threads = threads
+    server.sinks = sinks
+    threading.Thread(target = server.serve_forever, name = 'metrics', daemon = True).start()
+    oplog.info('Serving metrics on port {port}', port = port)
+    return server
@@ -0,0 +1,215 @@
+"""
+Oplog: The collector's own log, as JSON lines written by one background
+thread so no watcher ever waits on the disk
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+# Seconds a message logged with a key is held back for after it is shown,
+# unless the caller says otherwise
+EVERY = 60
+
+# Most records written with one write
+BATCH = 256
+
+
+class Writer:
+    """
+    Takes records off a queue and writes them to stdout, one JSON object
+    per line, from a single thread.  Callers only put a tuple on the
+    queue; the time stamp, message and JSON are formatted here, and a
+    batch of records goes out with one write and one flush.
+
+    A record logged with a key is held back if another with the same key
+    was shown less than its every seconds before.  The next one shown
+    says how many were held back.
+
+    Reopening the log file, for rotation, also happens on this thread,
+    between two records: the new file is swapped in under stdout and
+    stderr with dup2, so nothing written is lost or split.
+
+    records:   SimpleQueue -- Records and control functions to write
+    level:     Integer -- Records below this level are dropped by the caller
+    held:      Dict    -- Key: (time it may be shown again, times held back)
+    written:   Integer -- Records written
+    repeated:  Integer -- Records held back
+    failed:    Integer -- Records lost to write errors
+    """
+    def __init__(self):
+        self.level = LEVELS['info']
+        self.written = 0
+        self.repeated = 0
+        self.failed = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Start over with an empty queue and no thread, as in a forked child
+        """
+        self.records = queue.SimpleQueue()
+        self.held = {}
+        self.thread = None
+        self.starting = threading.Lock()
+
+    def put(self, record):
+        if self.thread is None:
+            with self.starting:
+                if self.thread is None:
+                    self.thread = threading.Thread(target = self.run, name = 'oplog', daemon = True)
+                    self.thread.start()
+                    atexit.register(flush)
+        self.records.put(record)
+
+    def run(self):
+        records = self.records
+        while True:
+            batch = [records.get()]
+            while len(batch) < BATCH:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if callable(record):
+                    self.write(lines)
+                    lines = []
+                    record()
+                    continue
+                line = self.format(record)
+                if line:
+                    lines.append(line)
+            self.write(lines)
+
+    def format(self, record):
+        """
+        The JSON line for a record, or None if it is held back
+        """
+        ts, level, thread, msg, fields, key, every = record
+        if key is not None:
+            until, count = self.held.get(key, (0, 0))
+            if ts < until:
+                self.held[key] = (until, count + 1)
+                self.repeated = self.repeated + 1
+                return None
+            self.held[key] = (ts + every, 0)
+            if count:
+                fields['repeated'] = count
+        try:
+            text = msg.format(**fields) if fields else msg
+        except (KeyError, IndexError, ValueError):
+            text = msg
+        local = time.localtime(ts)
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', local) + '.{ms:03d}'.format(ms = int(ts % 1 * 1000)) + time.strftime('%z', local)
+        obj = {
+            'ts': stamp,
+            'level': level,
+            'pid': os.getpid(),
+            'thread': thread,
+            'msg': text,
+        }
+        for name, value in fields.items():
+            obj.setdefault(name, value)
+        return json.dumps(obj, default = str) + '\n'
+
+    def write(self, lines):
+        if not lines:
+            return
+        try:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+            self.written = self.written + len(lines)
+        except (OSError, ValueError):
+            self.failed = self.failed + len(lines)
+
+    def reopen(self, fname):
+        """
+        Point stdout and stderr at a fresh fname, after rotation moved the
+        old one aside
+        """
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.dup2(fd, sys.stdout.fileno())
+            os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+        except (OSError, ValueError) as errtxt:
+            self.write([self.format((time.time(), 'error', 'oplog', 'Unable to reopen {file}: {msg}',
+                                     {'file': fname, 'msg': str(errtxt)}, None, 0))])
+
+
+writer = Writer()
+os.register_at_fork(after_in_child = writer.reset)
+
+
+def log(level, msg, /, key = None, every = EVERY, exc = False, **fields):
+    """
+    Queue a record.  msg is formatted with fields on the writer thread,
+    and the fields go into the record as they are.  With a key, repeats
+    are shown at most once every every seconds.  With exc, the traceback
+    of the exception being handled goes along.
+    """
+    if LEVELS[level] < writer.level:
+        return
+    if exc:
+        fields['traceback'] = traceback.format_exc()
+    writer.put((time.time(), level, threading.current_thread().name, msg, fields, key, every))
+
+
+def debug(msg, /, **fields):
+    log('debug', msg, **fields)
+
+
+def info(msg, /, **fields):
+    log('info', msg, **fields)
+
+
+def warning(msg, /, **fields):
+    log('warning', msg, **fields)
+
+
+def error(msg, /, **fields):
+    log('error', msg, **fields)
+
+
+def set_level(level):
+    if level not in LEVELS:
+        raise ValueError('Unknown log level {level}'.format(level = level))
+    writer.level = LEVELS[level]
+
+
+def reopen(fname):
+    """
+    Have the writer switch to a fresh fname once it has written what is
+    already queued.  Returns at once.
+    """
+    writer.put(lambda: writer.reopen(fname))
+
+
+def flush(timeout = 5.0):
+    """
+    Wait, up to timeout seconds, for everything queued so far to be written
+    """
+    if writer.thread is None:
+        return True
+    done = threading.Event()
+    writer.put(done.set)
+    return done.wait(timeout)
+
+
+def status():
+    """
+    Argus status line for the log
+    """
+    return 'log: written: {written} repeats held back: {repeated} lost: {failed}\n'.format(
+        written = writer.written, repeated = writer.repeated, failed = writer.failed)
@@ -0,0 +1,200 @@
+"""
+Pages: Decode a Duo log response one row at a time as it is read, keeping
+each row as the JSON text it came in rather than as a dict to be encoded
+again
+"""
+
+import codecs
+import io
+import json
+import re
+
+import archive
+
+decoder = json.JSONDecoder()
+scanstring = json.decoder.scanstring
+ws_re = re.compile(r'[ \t\n\r]*')
+
+# Where the rows are in a response: the array under "response" for the v1
+# logs, the one under "response" / "authlogs" for the v2 log
+ROWS = {'response': {'authlogs': None}}
+
+# Bytes of a response body read at a time
+BLOCK = 65536
+
+
+class Malformed(ValueError):
+    pass
+
+
+class Reader:
+    """
+    A response body as far as it has been read, a block at a time as the
+    decoder gets to the end of what it has, forgetting what the decoder
+    has gone past
+
+    fp:        File    -- The body, anything with read(n)
+    text:      String  -- What has been read and not gone past yet
+    i:         Integer -- Where the decoder is in text
+    eof:       Boolean -- The rest of the body is all in text
+    blocks:    List    -- The bytes text was decoded from
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.i = 0
+        self.eof = False
+        self.blocks = []
+
+    def more(self):
+        """
+        Read another block onto text.  Returns False at the end of the body.
+        """
+        if self.eof:
+            return False
+        block = self.fp.read(BLOCK)
+        if block and self.i:
+            self.text = self.text[self.i:]
+            self.i = 0
+            self.blocks = []
+        self.blocks.append(block)
+        self.text = self.text + self.utf8.decode(block, not block)
+        self.eof = not block
+        return True
+
+    def rest(self):
+        """
+        The bytes we still have of the body, and those not read yet
+        """
+        return b''.join(self.blocks) + (b'' if self.eof else self.fp.read())
+
+    def skip(self):
+        """
+        Go past any whitespace.  Returns the next character, '' at the end
+        of the body.
+        """
+        while True:
+            self.i = ws_re.match(self.text, self.i).end()
+            if self.i < len(self.text) or not self.more():
+                return self.text[self.i:self.i + 1]
+
+    def expect(self, chars):
+        c = self.skip()
+        if not c or c not in chars:
+            raise Malformed('Expecting one of {chars}'.format(chars = chars))
+        return c
+
+    def take(self, scan, offset = 0):
+        """
+        The value scan(text, i + offset) finds and the index after it,
+        reading on until it is all there.  A value running to the end of
+        what we have could carry on in the next block.
+        """
+        while True:
+            try:
+                value, end = scan(self.text, self.i + offset)
+            except ValueError:
+                end = None
+            if end is not None and (end < len(self.text) or self.eof):
+                return value, end
+            if not self.more():
+                raise Malformed('Truncated body')
+
+
+def walk(reader, rows):
+    """
+    Decode the object at the reader, turning the arrays under the keys in
+    rows into lists of archive.Rows and walking into the objects under
+    them the same way
+    """
+    reader.expect('{')
+    reader.i = reader.i + 1
+    obj = {}
+    if reader.expect('"}') == '}':
+        reader.i = reader.i + 1
+        return obj
+    while True:
+        reader.expect('"')
+        key, reader.i = reader.take(scanstring, 1)
+        reader.expect(':')
+        reader.i = reader.i + 1
+        c = reader.skip()
+        if key in rows and c == '[':
+            obj[key] = records(reader)
+        elif key in rows and c == '{':
+            obj[key] = walk(reader, rows[key] or {})
+        else:
+            obj[key], reader.i = reader.take(decoder.raw_decode)
+        if reader.expect(',}') == '}':
+            reader.i = reader.i + 1
+            return obj
+        reader.i = reader.i + 1
+
+
+def plain(line):
+    """
+    Does a row's text write its strings just as archive.encode would?
+    Only then is it archived as it came: the raw needles of query.py and
+    scan.py are built with json.dumps, and would miss a row Duo sent with
+    \\/ or \\u escapes archive.encode writes differently, or UTF-8 it
+    writes as escapes.  A newline would split the row in two.
+    """
+    return line.isascii() and '\\' not in line and '\n' not in line and '\r' not in line
+
+
+def records(reader):
+    """
+    The rows of the array at the reader.  Each row is decoded on its own,
+    to pull out what an archive.Row keeps, and dropped.
+    """
+    found = []
+    reader.i = reader.i + 1
+    if reader.expect('{]') == ']':
+        reader.i = reader.i + 1
+        return found
+    while True:
+        reader.expect('{')
+        obj, end = reader.take(decoder.raw_decode)
+        line = reader.text[reader.i:end]
+        reader.i = end
+        found.append(archive.Row(obj, line if plain(line) else archive.encode(obj)))
+        if reader.expect(',]') == ']':
+            reader.i = reader.i + 1
+            return found
+        reader.i = reader.i + 1
+
+
+def read(fp):
+    """
+    Decode a response body from fp as it is read, for PooledAdmin's
+    api_call to hand the body of a 200 to.  Returns the object and None,
+    or None and the bytes we still have of a body we can't follow.
+    """
+    reader = Reader(fp)
+    try:
+        obj = walk(reader, ROWS)
+        if reader.skip():
+            raise Malformed('Extra data')
+    except ValueError:
+        return None, reader.rest()
+    return obj, None
+
+
+def parse(api, response, data):
+    """
+    The rows of a log call's response, as api.parse_json_response would
+    return them but with archive.Rows for the rows.  data is the body, or
+    what read() made of it as it came in.  Anything but a 200 with stat
+    OK, or a body we can't follow, is left to the api, which raises the
+    error or decodes it the usual way.
+    """
+    if response.status != 200:
+        return api.parse_json_response(response, data)
+    obj, rest = read(io.BytesIO(data)) if isinstance(data, bytes) else data
+    if obj is None:
+        return api.parse_json_response(response, rest)
+    if obj.get('stat') != 'OK' or 'response' not in obj:
+        body = json.dumps(obj, default = archive.Row.decode)
+        return api.parse_json_response(response, body.encode('utf-8'))
+    return obj['response']
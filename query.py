@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Query: Pull the rows for a time range, user, device or field value out of
+the daily archives written by LogWatcher
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import archive
+
+
+def parse_time(text):
+    """
+    Accepts an epoch or a local 'yy-mm-dd', 'yy-mm-dd HH:MM' or
+    'yy-mm-dd HH:MM:SS' time
+    """
+    if text.isdigit():
+        return int(text)
+    for fmt in ('%y-%m-%d %H:%M:%S', '%y-%m-%d %H:%M', '%y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(text, fmt)))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Bad time {text}'.format(text = text))
+
+
+def parse_where(text):
+    """
+    Splits a 'field.sub=value' filter into its path and value
+    """
+    field, sep, value = text.partition('=')
+    if not sep or not field:
+        raise argparse.ArgumentTypeError('Bad filter {text}, expecting field=value'.format(text = text))
+    return (field.split('.'), value)
+
+
+def lookup(row, path):
+    for field in path:
+        if not isinstance(row, dict):
+            return None
+        row = row.get(field)
+    return row
+
+
+def search(dirname, start, end, user = None, device = None, where = ()):
+    """
+    Yield the archived lines (as bytes) of rows with start <= timestamp <
+    end matching every filter.  Only the chunks the indexes say might
+    match are read; a user or device is looked up in the key index.
+    """
+    key = None
+    needles = []
+    if user:
+        key = 'u:' + user
+        needles.append(json.dumps(user))
+    elif device:
+        key = 'd:' + device
+    if device:
+        needles.append(json.dumps(device))
+    for path, value in where:
+        needles.append(json.dumps(value)[1:-1])
+    needles = [needle.encode('utf-8') for needle in needles]
+
+    for fname in archive.files(dirname, start, end):
+        for chunk in archive.read_chunks(fname, start, end, key):
+            for line in chunk.splitlines(True):
+                # Cheap check on the raw bytes before decoding
+                if not all(needle in line for needle in needles):
+                    continue
+                row = json.loads(line)
+                if not start <= row.get('timestamp', 0) < end:
+                    continue
+                if user and user != row.get('username') and user != lookup(row, ['user', 'name']):
+                    continue
+                if device and device != row.get('device') and device != lookup(row, ['auth_device', 'name']):
+                    continue
+                if all(str(lookup(row, path)) == value for path, value in where):
+                    yield line
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Query the Duo log archives')
+    ap.add_argument('-d', default='auth', help='Log directory (default auth)')
+    ap.add_argument('-f', type=parse_time, help='From this time (default midnight today)')
+    ap.add_argument('-t', type=parse_time, help='Up to this time (default now)')
+    ap.add_argument('-u', help='Only rows for this username')
+    ap.add_argument('-D', help='Only rows for this device')
+    ap.add_argument('where', nargs='*', type=parse_where, help='field=value filters, e.g. result=FAILURE access_device.ip=10.0.0.1')
+    arg = ap.parse_args()
+
+    end = arg.t or int(time.time()) + 1
+    start = arg.f if arg.f is not None else int(archive.day_bounds(end)[0])
+
+    out = sys.stdout.buffer
+    try:
+        for line in search(arg.d, start, end, arg.u, arg.D, arg.where):
+            out.write(line)
+        out.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
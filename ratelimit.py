@@ -0,0 +1,139 @@
+"""
+Ratelimit: A token bucket shared by the watchers of one Duo account
+"""
+
+import email.utils
+import threading
+import time
+
+# Calls per minute allowed by default, and the longest a caller will wait
+RATE = 10
+ACQUIRE_TIMEOUT = 60
+
+# How long to hold off when Duo says 429 without telling us for how long
+DEFAULT_RETRY = 60
+
+# Tokens each endpoint costs.  Duo limits the legacy v1 log endpoints more
+# tightly than the rest of the Admin API.
+WEIGHTS = {
+    '/admin/v1/logs/authentication': 2,
+    '/admin/v1/logs/administrator': 2,
+    '/admin/v1/logs/telephony': 2,
+}
+
+
+def weight(path):
+    return WEIGHTS.get(path, 1)
+
+
+def retry_after(response):
+    """
+    Seconds a 429 response asks us to wait, from its Retry-After or
+    X-RateLimit-Reset header
+    """
+    value = response.getheader('Retry-After')
+    if value:
+        if value.strip().isdigit():
+            return int(value)
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    value = response.getheader('X-RateLimit-Reset')
+    if value:
+        try:
+            reset = float(value)
+        except ValueError:
+            pass
+        else:
+            # Either an epoch or a number of seconds
+            return max(0, reset - time.time()) if reset > 1e9 else reset
+    return DEFAULT_RETRY
+
+
+class TokenBucket:
+    """
+    Hands out API calls at a steady rate with bursts of up to burst calls.
+    Callers reserve their tokens up front and sleep until the bucket has
+    refilled enough to cover them, so waiters are served in turn.  A 429
+    from Duo empties the bucket and stops it refilling for as long as Duo
+    asks.
+
+    level:     Float   -- Tokens available (negative while reserved ahead)
+    stamp:     Float   -- Monotonic time the level was computed at, in the
+                          future while we're holding off after a 429
+    throttled: Float   -- Total seconds callers spent waiting
+    refused:   Integer -- 429 responses seen
+    """
+    def __init__(self, name, per_minute = RATE, burst = None):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst or max(2, per_minute / 6.0)
+        self.level = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.throttled = 0.0
+        self.refused = 0
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.level = min(self.burst, self.level + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def acquire(self, weight = 1, timeout = ACQUIRE_TIMEOUT):
+        """
+        Wait for weight tokens.  Returns False, without taking any, if that
+        would take longer than timeout seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            wait = max(self.stamp - now, 0) + max(weight - self.level, 0) / self.rate
+            if wait > timeout:
+                return False
+            self.level = self.level - weight
+            self.throttled = self.throttled + wait
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def holdoff(self, weight = 1):
+        """
+        Seconds until weight tokens will be there for the taking
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return max(self.stamp - now, 0) + max(weight - self.level, 0) / self.rate
+
+    def throttle(self, seconds):
+        """
+        Duo said 429: hold everybody off for seconds
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.level = min(self.level, 0)
+            self.stamp = max(self.stamp, now + seconds)
+            self.refused = self.refused + 1
+
+    def update(self, response):
+        """
+        Believe what the X-RateLimit-Remaining header, if any, says is left
+        """
+        value = response.getheader('X-RateLimit-Remaining')
+        if not value:
+            return
+        try:
+            remaining = float(value)
+        except ValueError:
+            return
+        with self.lock:
+            self.level = min(self.level, remaining)
+
+    def status(self):
+        with self.lock:
+            self.refill(time.monotonic())
+        return 'limit {name}: level: {level:.1f}/{burst:g} rate: {rate:g}/min throttled: {secs:.0f}s 429s: {n}\n'.format(
+            name = self.name, level = self.level, burst = self.burst, rate = self.rate * 60,
+            secs = self.throttled, n = self.refused)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""
+Retention: Recompress, roll up and finally delete old daily archives
+according to a tiered policy
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import time
+
+import archive
+import oplog
+
+# Each tier and the age in days it lasts until: rows stay raw for a week,
+# are then recompressed, rolled up by month after 90 days and deleted after 370
+POLICY = 'raw:7,gz:90,month:370'
+
+# Tiers a policy can name.  gz and zst recompress each day's file, week
+# and month roll whole weeks or months of days up into one file.
+TIERS = ('raw',) + archive.FORMATS + ('week', 'month')
+ROLLUPS = ('week', 'month')
+
+# Megabytes per second read and written, so a run doesn't hold up the
+# watchers writing to the same disk
+RATE = 8
+
+# Anything in a log directory named for a day or a run of days
+dated_re = re.compile(r'^([0-9]{6})(-([0-9]{6}))?(\..*)?$')
+
+
+class Policy:
+    """
+    A retention policy, "tier:days,..." with days strictly increasing, the
+    age in days at which files move on from each tier to the next.  Past
+    the last one they are deleted.  At most one tier may be a rollup; its files
+    are compressed like the tier before it, or with gzip.
+
+    tiers:     List    -- (tier, first age) of each tier, youngest first
+    keep:      Integer -- Age in days at which files are deleted
+    fmt:       String  -- Compressed format of rolled up files
+    """
+    def __init__(self, text):
+        entries = []
+        for part in text.split(','):
+            tier, _, days = part.strip().partition(':')
+            if tier not in TIERS or not days.isdigit():
+                raise ValueError('Bad retention tier {part}'.format(part = part))
+            entries.append((tier, int(days)))
+        if [days for tier, days in entries] != sorted(set(days for tier, days in entries)):
+            raise ValueError('Retention ages must increase: {text}'.format(text = text))
+        if len([tier for tier, days in entries if tier in ROLLUPS]) > 1:
+            raise ValueError('At most one rollup tier: {text}'.format(text = text))
+
+        # Each tier starts where the one before it ends
+        self.tiers = [(entries[0][0], 0)] + [(entries[i + 1][0], entries[i][1]) for i in range(len(entries) - 1)]
+        self.keep = entries[-1][1]
+        self.fmt = 'gz'
+        for tier, start in self.tiers:
+            if tier in archive.FORMATS:
+                self.fmt = tier
+            elif tier in ROLLUPS:
+                break
+
+    def tier(self, age):
+        """
+        The tier for a day age days old, or None once it is to be deleted
+        """
+        if age >= self.keep:
+            return None
+        found = None
+        for tier, start in self.tiers:
+            if age >= start:
+                found = tier
+        return found
+
+
+class Throttle:
+    """
+    Holds a run to rate bytes per second by sleeping once it gets ahead
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.used = 0
+
+    def spend(self, nbytes):
+        self.used = self.used + nbytes
+        if self.rate:
+            ahead = self.used / self.rate - (time.time() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def date(day):
+    return datetime.datetime.strptime(day, '%y%m%d').date()
+
+
+def period(tier, day):
+    """
+    The first and last dates of the week (Monday on) or month holding day
+    """
+    if tier == 'week':
+        first = day - datetime.timedelta(days = day.weekday())
+        return first, first + datetime.timedelta(days = 6)
+    first = day.replace(day = 1)
+    following = (first + datetime.timedelta(days = 31)).replace(day = 1)
+    return first, following - datetime.timedelta(days = 1)
+
+
+def side_files(fname):
+    return [fname, fname + '.idx', fname + '.keys', fname + '.tail']
+
+
+def remove(fname):
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
+
+
+def sync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def guard(dirname):
+    """
+    The first day we mustn't touch: the day of the last row the watcher
+    has archived, which its writer may still have open
+    """
+    try:
+        with open(os.path.join(dirname, 'state')) as fp:
+            timestamp = json.load(fp).get('timestamp', 0)
+    except (FileNotFoundError, ValueError):
+        timestamp = 0
+    return time.strftime('%y%m%d', time.localtime(timestamp or time.time()))
+
+
+def recover(dirname):
+    """
+    Finish whatever a run that died part way through was doing: journals
+    are replayed, and files a combine never got to journal are dropped
+    """
+    for name in sorted(os.listdir(dirname)):
+        if name.endswith('.journal'):
+            finish(os.path.join(dirname, name))
+    for name in sorted(os.listdir(dirname)):
+        if dated_re.match(name) and '.new' in name.split('.')[1:]:
+            oplog.info('Removing unfinished {fname}', fname = os.path.realpath(os.path.join(dirname, name)))
+            remove(os.path.join(dirname, name))
+
+
+def plan(dirname, policy, today, first_kept = None):
+    """
+    The steps bringing dirname in line with policy as of date today, each
+    (verb, target, sources): ('delete', None, files), ('compress', target,
+    files) or ('rollup', target, files).  Days from first_kept on (%y%m%d)
+    are left alone.
+    """
+    first_kept = first_kept or guard(dirname)
+    steps = []
+    doomed = []
+    days = {}
+    for name in sorted(os.listdir(dirname)):
+        m = dated_re.match(name)
+        if not m or name.endswith('.journal'):
+            continue
+        last = m.group(3) or m.group(1)
+        if last >= first_kept:
+            continue
+        if policy.tier((today - date(last)).days) is None:
+            doomed.append(os.path.join(dirname, name))
+        elif not m.group(2) and (m.group(4) is None or m.group(4)[1:] in archive.FORMATS):
+            days.setdefault(m.group(1), []).append(os.path.join(dirname, name))
+    if doomed:
+        steps.append(('delete', None, doomed))
+
+    rolled = [archive.rollup_re.match(os.path.basename(fname)).groups()[:2] + (fname,)
+              for start, end, fname in archive.rollups(dirname) if fname not in doomed]
+    groups = {}
+    for day in sorted(days):
+        covering = [fname for first, last, fname in rolled if first <= day <= last]
+        if covering:
+            oplog.info('Leaving {files}, already rolled up in {rollup}',
+                       files = ' '.join(os.path.realpath(fname) for fname in days[day]),
+                       rollup = os.path.realpath(covering[0]))
+            continue
+        tier = policy.tier((today - date(day)).days)
+        if tier in ROLLUPS:
+            # Only whole periods are rolled up, once nothing more can
+            # arrive for them; until then the day is just compressed
+            first, last = period(tier, date(day))
+            if policy.tier((today - last).days) in ROLLUPS and last.strftime('%y%m%d') < first_kept:
+                groups.setdefault((first, last), []).extend(days[day])
+                continue
+            tier = policy.fmt
+        if tier in archive.FORMATS:
+            target = os.path.join(dirname, day + '.' + tier)
+            if days[day] != [target]:
+                steps.append(('compress', target, days[day]))
+
+    for (first, last), sources in sorted(groups.items()):
+        target = os.path.join(dirname, '{first}-{last}.{fmt}'.format(
+            first = first.strftime('%y%m%d'), last = last.strftime('%y%m%d'), fmt = policy.fmt))
+        steps.append(('rollup', target, sources))
+    return steps
+
+
+def combine(target, sources, throttle, fmt):
+    """
+    Copy the rows of sources, oldest first, into target compressed with
+    fmt, along with its index and, if any source had one, key index.  The
+    rows are cut into frames of FRAME_ROWS afresh, as a day written a few
+    rows a poll holds as many tiny chunks, which hardly compress apart.
+    The new files are synced and a journal naming the sources is written
+    before anything is renamed or deleted, so finish() can complete the
+    job after a crash.
+    """
+    compress = archive.compressor(fmt)
+    order = []
+    for fname in sources:
+        index = archive.load_index(fname)
+        order.append((index[0]['t0'] if index else 0, fname))
+    keyed = any(os.path.exists(fname + '.keys') for fname in sources)
+
+    tmp = target + '.new'
+    offset = 0
+    with open(tmp, 'wb') as fp, open(tmp + '.idx', 'w') as idx, open(tmp + '.keys', 'w') as kfp:
+        def put(lines, found, offset):
+            """
+            Write a frame of lines at offset and index it, returns the
+            offset after it
+            """
+            chunk = compress(b''.join(lines))
+            fp.write(chunk)
+            throttle.spend(len(chunk))
+            entry = archive.index_entry(lines, offset)
+            entry['length'] = len(chunk)
+            idx.write(archive.encode(entry) + '\n')
+            if keyed:
+                kfp.write(archive.encode({'offset': offset, 'keys': sorted(found)}) + '\n')
+            return offset + len(chunk)
+
+        lines = []
+        found = set()
+        for t0, fname in sorted(order):
+            keys = archive.load_keys(fname)
+            for entry, data in archive.read_entries(fname):
+                throttle.spend(entry['length'])
+                rows = data.splitlines(True)
+                known = keys.get(entry['offset'])
+                while rows:
+                    taken = rows[:archive.FRAME_ROWS - len(lines)]
+                    rows = rows[len(taken):]
+                    lines.extend(taken)
+                    if keyed and known is not None:
+                        # The chunk's keys for each frame it goes into;
+                        # too many only costs a frame read for nothing
+                        found.update(known)
+                    elif keyed:
+                        for line in taken:
+                            found.update(archive.row_keys(json.loads(line)))
+                    if len(lines) == archive.FRAME_ROWS:
+                        offset = put(lines, found, offset)
+                        lines = []
+                        found = set()
+        if lines:
+            put(lines, found, offset)
+        for out in (fp, idx, kfp):
+            out.flush()
+            os.fsync(out.fileno())
+    if not keyed:
+        remove(tmp + '.keys')
+
+    # Keep the newest source's mtime, so export doesn't take the new file
+    # for new rows
+    mtime = max(os.path.getmtime(fname) for fname in sources)
+    os.utime(tmp, (mtime, mtime))
+
+    journal = target + '.journal'
+    with open(journal + '.new', 'w') as fp:
+        fp.write(json.dumps({'target': target, 'sources': sources, 'keys': keyed}) + '\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(journal + '.new', journal)
+    sync_dir(os.path.dirname(target) or '.')
+    finish(journal)
+
+
+def finish(journal):
+    """
+    Put a combined file in place of its sources: its index and keys go
+    first, the data last, then the sources go.  Every step can be
+    repeated, so a journal is simply replayed until it is gone.
+    """
+    with open(journal) as fp:
+        job = json.load(fp)
+    target = job['target']
+    for suffix in ('.idx', '.keys', ''):
+        if os.path.exists(target + '.new' + suffix):
+            os.rename(target + '.new' + suffix, target + suffix)
+    if not job['keys']:
+        remove(target + '.keys')
+    for fname in job['sources']:
+        if fname != target:
+            for side in side_files(fname):
+                remove(side)
+    sync_dir(os.path.dirname(target) or '.')
+    os.remove(journal)
+
+
+def apply(dirname, steps, throttle, deadline = None):
+    """
+    Carry out the steps of a plan, stopping once past deadline.  Returns
+    how many were done.
+    """
+    done = 0
+    for verb, target, sources in steps:
+        if deadline and time.time() >= deadline:
+            oplog.info('Out of time in {dir}, {n} steps left', dir = os.path.realpath(dirname), n = len(steps) - done)
+            break
+        if verb == 'delete':
+            for fname in sources:
+                os.remove(fname)
+            oplog.info('Removed {files}', files = ' '.join(os.path.realpath(fname) for fname in sources))
+        else:
+            fmt = target.rsplit('.', 1)[-1]
+            size = sum(os.path.getsize(fname) for fname in sources)
+            combine(target, sources, throttle, fmt)
+            oplog.info('{verb} {files} into {target}, {size} to {new} bytes',
+                       verb = 'Compressed' if verb == 'compress' else 'Rolled up',
+                       files = ' '.join(os.path.basename(fname) for fname in sources),
+                       target = os.path.realpath(target),
+                       size = size,
+                       new = os.path.getsize(target))
+        done = done + 1
+    return done
+
+
+def log_dirs(top = '.'):
+    """
+    The log directories under top, one or two levels down, that a
+    watcher keeps a state file in
+    """
+    found = []
+    for name in sorted(os.listdir(top)):
+        path = os.path.join(top, name)
+        if os.path.exists(os.path.join(path, 'state')):
+            found.append(path)
+        elif os.path.isdir(path):
+            found.extend(os.path.join(path, sub) for sub in sorted(os.listdir(path))
+                         if os.path.exists(os.path.join(path, sub, 'state')))
+    return found
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Recompress, roll up and delete old daily Duo log archives')
+    ap.add_argument('-p', default=POLICY, help='Retention policy (default {policy})'.format(policy = POLICY))
+    ap.add_argument('-r', type=float, default=RATE,
+                    help='Megabytes per second to read and write, 0 for no limit (default {rate})'.format(rate = RATE))
+    ap.add_argument('-T', type=float, help='Stop starting new steps after this many seconds; the next run carries on')
+    ap.add_argument('-n', action='store_true', help='Just show what would be done')
+    ap.add_argument('dirs', nargs='*', help='Log directories (default those under the current directory with a state file)')
+    arg = ap.parse_args()
+
+    policy = Policy(arg.p)
+    throttle = Throttle(arg.r * 1000000)
+    deadline = time.time() + arg.T if arg.T else None
+    today = datetime.date.today()
+    for dirname in arg.dirs or log_dirs():
+        if not arg.n:
+            recover(dirname)
+        steps = plan(dirname, policy, today)
+        if arg.n:
+            for verb, target, sources in steps:
+                print(verb, target or '', ' '.join(sources))
+            continue
+        apply(dirname, steps, throttle, deadline)
+        if deadline and time.time() >= deadline:
+            break
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Scan: Count archived Duo log rows by field across many days, using every core
+"""
+
+import argparse
+import collections
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+
+import archive
+import query
+
+# Bytes of archive handed to a worker at a time
+CHUNK_BYTES = 8 << 20
+
+
+def tasks(dirname, start, end):
+    """
+    Yield (file, format, [(offset, length), ...]) pieces of the daily and
+    rolled up files between start and end, each about CHUNK_BYTES long.
+    Plain files are split on line boundaries, and end at their last
+    newline; compressed ones are split on frame boundaries, and the rows
+    in their .tail come as they are, in place of the pieces.
+    """
+    for fname in archive.files(dirname, start, end):
+        fmt = fname.rsplit('.', 1)[-1] if '.' in os.path.basename(fname) else None
+        if fmt:
+            tail = archive.read_tail(fname)
+            index = archive.load_index(fname)
+            pieces = []
+            size = 0
+            for entry in index:
+                if entry['t1'] < start or entry['t0'] >= end:
+                    continue
+                pieces.append((entry['offset'], entry['length']))
+                size = size + entry['length']
+                if size >= CHUNK_BYTES:
+                    yield (fname, fmt, pieces)
+                    pieces = []
+                    size = 0
+            if pieces:
+                yield (fname, fmt, pieces)
+            entry = archive.tail_entry(index, tail)
+            if entry and entry['t1'] >= start and entry['t0'] < end:
+                yield (fname, None, tail[1])
+            continue
+
+        with open(fname, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                # Up to the last newline; after it is a row still being written
+                size = mm.rfind(b'\n') + 1
+                offset = 0
+                while offset < size:
+                    split = mm.find(b'\n', min(offset + CHUNK_BYTES, size) - 1) + 1
+                    yield (fname, None, [(offset, split - offset)])
+                    offset = split
+
+
+# Set in each worker by setup()
+job = {}
+
+
+def setup(start, end, fields, needles):
+    job['start'] = start
+    job['end'] = end
+    job['fields'] = [field.split('.') for field in fields]
+    job['needles'] = needles
+
+
+def read(fname, fmt, pieces):
+    """
+    The (decompressed) bytes of the pieces of a daily file
+    """
+    with open(fname, 'rb') as fp:
+        if fmt:
+            decompress = archive.decompressor(fmt)
+            data = []
+            for offset, length in pieces:
+                fp.seek(offset)
+                data.append(decompress(fp.read(length)))
+            return b''.join(data)
+        with mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            return b''.join(mm[offset:offset + length] for offset, length in pieces)
+
+
+def count(task):
+    """
+    Worker: count the rows of one piece of a daily file by job['fields'],
+    the pieces being the rows themselves for a compressed file's tail
+    """
+    fname, fmt, pieces = task
+    start = job['start']
+    end = job['end']
+    fields = job['fields']
+    needles = job['needles']
+    counts = collections.Counter()
+    rows = 0
+
+    if isinstance(pieces, bytes):
+        data = pieces
+    else:
+        data = read(fname, fmt, pieces)
+
+    for line in data.splitlines():
+        # Early filter on the raw bytes, before paying for json.loads
+        if needles and not all(needle in line for needle in needles):
+            continue
+        row = json.loads(line)
+        if not start <= row.get('timestamp', 0) < end:
+            continue
+        rows = rows + 1
+        counts[tuple(str(query.lookup(row, path)) for path in fields)] += 1
+
+    return rows, counts
+
+
+def scan(dirname, start, end, fields, needles = (), processes = None):
+    """
+    Count the rows between start and end, by the values of fields, over
+    a pool of processes.  Returns (rows, Counter).
+    """
+    needles = [needle.encode('utf-8') for needle in needles]
+    total = 0
+    counts = collections.Counter()
+    with multiprocessing.Pool(processes, setup, (start, end, fields, needles)) as pool:
+        for rows, found in pool.imap_unordered(count, tasks(dirname, start, end)):
+            total = total + rows
+            counts.update(found)
+    return total, counts
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Count archived Duo log rows by field')
+    ap.add_argument('-d', default='auth', help='Log directory (default auth)')
+    ap.add_argument('-f', type=query.parse_time, help='From this time (default 370 days ago)')
+    ap.add_argument('-t', type=query.parse_time, help='Up to this time (default now)')
+    ap.add_argument('-g', action='append', default=[], help='Count by this field, e.g. result, factor, '
+                    'application.name or user.name (repeatable)')
+    ap.add_argument('-m', action='append', default=[], help='Only rows whose raw JSON contains this text (repeatable)')
+    ap.add_argument('-j', type=int, help='Worker processes (default one per core)')
+    ap.add_argument('-J', action='store_true', help='Print the counts as JSON')
+    arg = ap.parse_args()
+
+    end = arg.t or int(time.time()) + 1
+    start = arg.f if arg.f is not None else end - 370 * 86400
+    fields = arg.g or ['result']
+
+    t0 = time.time()
+    total, counts = scan(arg.d, start, end, fields, arg.m, arg.j)
+    elapsed = time.time() - t0
+
+    if arg.J:
+        print(json.dumps({
+            'fields': fields,
+            'rows': total,
+            'counts': [list(key) + [n] for key, n in counts.most_common()],
+        }))
+        return 0
+
+    print('{fields}: {rows} rows in {secs:.1f}s'.format(fields = ' '.join(fields), rows = total, secs = elapsed))
+    for key, n in counts.most_common():
+        print('{n:10d}  {key}'.format(n = n, key = '  '.join(key)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Scheduler: Adapt each watcher's polling interval to its log's volume
+"""
+
+import math
+import threading
+import time
+
+# Seconds over which the observed arrival rate is averaged
+RATE_WINDOW = 600.0
+
+# How many new rows we'd like each poll to pick up
+TARGET_ROWS = 100
+
+# Defaults for the bounds on the interval and the API call budget
+MIN_INTERVAL = 30
+MAX_INTERVAL = 600
+BUDGET = 6
+
+
+class Budget:
+    """
+    The Duo API calls per minute we allow the watchers of one account,
+    shared out in proportion to the calls each watcher would like to make.
+
+    per_minute: Float  -- Calls per minute for all the watchers together
+    demand:     Dict   -- Calls per minute each watcher wants, by name
+    """
+    def __init__(self, per_minute = BUDGET):
+        self.per_minute = float(per_minute)
+        self.demand = {}
+        self.lock = threading.Lock()
+
+    def floor(self, name, demand):
+        """
+        Record the calls per minute name wants and return the shortest
+        interval its share of the budget allows
+        """
+        with self.lock:
+            self.demand[name] = demand
+            total = sum(self.demand.values())
+        if total <= self.per_minute:
+            return 0
+        return 60.0 * total / (self.per_minute * demand)
+
+
+class Adaptive:
+    """
+    Picks the polling interval of one watcher from the rate rows have been
+    arriving at, between low and high and within its share of the budget.
+
+    rate:      Float   -- Recent rows per second, None until two fetches
+    fill:      Float   -- Fraction of the last page that was filled
+    interval:  Integer -- Interval to wait before the next poll
+    initial:   Integer -- Interval until there is a rate to go by
+    """
+    def __init__(self, name, budget, low = MIN_INTERVAL, high = MAX_INTERVAL, interval = None):
+        self.name = name
+        self.budget = budget
+        self.low = low
+        self.high = high
+        self.rate = None
+        self.fill = 0.0
+        self.initial = min(max(interval or low, low), high)
+        self.interval = self.initial
+        self.last = None
+        self.accepted = 0
+
+    def observe(self, handle, now = None):
+        """
+        Account for a completed fetch by handle, a LogWatcher, and return
+        the interval to wait before the next poll
+        """
+        now = now or time.time()
+        if handle.page:
+            self.fill = float(handle.received) / handle.page
+        if self.last is not None and now > self.last:
+            dt = now - self.last
+            rate = (handle.accepted - self.accepted) / dt
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = self.rate + (1 - math.exp(-dt / RATE_WINDOW)) * (rate - self.rate)
+        self.last = now
+        self.accepted = handle.accepted
+
+        if self.rate is None:
+            # Nothing to go by yet, after a start or a reload
+            wanted = self.initial
+        elif self.rate:
+            wanted = min(max(TARGET_ROWS / self.rate, self.low), self.high)
+        else:
+            wanted = self.high
+        floor = self.budget.floor(self.name, 60.0 / wanted)
+        self.interval = int(round(min(max(wanted, floor), self.high)))
+        return self.interval
+
+    def behind(self):
+        """
+        True if the last page came back full, so more rows are waiting
+        """
+        return self.fill >= 1.0
@@ -0,0 +1,508 @@
+"""
+Sinks: Where a LogWatcher's rows go.  The local daily files are one sink;
+network sinks send the rows on to syslog or HTTP collectors in batches,
+from a spool on disk, so a collector being down never holds up or loses
+collection.
+"""
+
+import gzip
+import http.client
+import json
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+import durability
+import metrics
+import oplog
+
+# Most rows a network sink sends at once, unless argus_cf says otherwise
+BATCH = 500
+
+# Most megabytes a spool holds, unless argus_cf says otherwise.  A required
+# sink whose spool is full holds up its watchers' state files.
+SPOOL_MB = 1024
+
+# Bytes at which a spool moves on to a new segment file
+SEGMENT_BYTES = 16 << 20
+
+# Bytes read from a spool at a time
+READ_BYTES = 1 << 20
+
+# Seconds between tries of a failing collector, doubling up to RETRY_MAX
+RETRY_MIN = 1
+RETRY_MAX = 60
+
+# Seconds a network sink waits on its collector
+TIMEOUT = 30
+
+# RFC 5424 facility (local0) and severity (informational) of our messages
+FACILITY = 16
+SEVERITY = 6
+
+
+class Sink:
+    """
+    Takes the rows of any number of LogWatchers.  A watcher hands each
+    batch it archives to write(), and calls commit() before replacing its
+    state file; the state file only moves on if every required sink
+    acknowledged by returning True.
+
+    name:      String  -- What the sink is called in argus_cf and the metrics
+    required:  Boolean -- Whether a watcher's state waits for this sink
+    """
+    name = 'sink'
+    required = True
+
+    def write(self, log, rows, lines):
+        """
+        Take rows just archived by watcher log, and their JSON lines
+        """
+
+    def commit(self, log, fsync):
+        """
+        Make what watcher log has written safe, to disk if fsync.  Returns
+        True once it is.
+        """
+        return True
+
+    def status(self):
+        return ''
+
+    def close(self):
+        pass
+
+
+class File_sink(Sink):
+    """
+    A watcher's own daily files, see archive.DailyArchive
+
+    writer:    DailyArchive -- The watcher's archive
+    """
+    name = 'archive'
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, log, rows, lines):
+        self.writer.write(rows, lines)
+
+    def commit(self, log, fsync):
+        if fsync:
+            self.writer.sync()
+        else:
+            self.writer.flush()
+        return True
+
+
+class Spool:
+    """
+    Rows waiting for a network sink, as lines of "log<TAB>timestamp<TAB>row"
+    in numbered segment files under dirname.  The cursor file says how far
+    the sender has got; segments it is past are deleted.  A partial line
+    left by a crash is cut off when the spool is opened.
+
+    limit:     Integer -- Most bytes waiting before append() refuses more
+    segments:  List    -- Numbers of the segment files, oldest first
+    sizes:     Dict    -- Bytes in each segment, by number
+    cursor:    Tuple   -- (segment, offset) delivered up to
+    """
+    def __init__(self, dirname, limit):
+        self.dirname = dirname
+        self.limit = limit
+        self.lock = threading.Lock()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        try:
+            with open(self.path('cursor')) as fp:
+                self.cursor = tuple(json.load(fp))
+        except FileNotFoundError:
+            self.cursor = None
+        self.segments = sorted(int(name) for name in os.listdir(dirname) if name.isdigit())
+        if self.cursor is None:
+            self.cursor = (self.segments[0] if self.segments else 0, 0)
+        for seg in [seg for seg in self.segments if seg < self.cursor[0]]:
+            os.unlink(self.path(seg))
+            self.segments.remove(seg)
+        if not self.segments:
+            self.segments = [self.cursor[0]]
+        self.sizes = {}
+        for seg in self.segments[:-1]:
+            self.sizes[seg] = os.path.getsize(self.path(seg))
+        self.fp = open(self.path(self.segments[-1]), 'ab')
+        self.sizes[self.segments[-1]] = self.recover()
+
+    def path(self, name):
+        return os.path.join(self.dirname, name if isinstance(name, str) else '{seg:012d}'.format(seg = name))
+
+    def recover(self):
+        """
+        Cut the last segment back to its last complete line, returns its size
+        """
+        size = self.fp.seek(0, os.SEEK_END)
+        end = size
+        with open(self.fp.name, 'rb') as fp:
+            while end > 0:
+                start = max(0, end - READ_BYTES)
+                fp.seek(start)
+                data = fp.read(end - start)
+                if data.endswith(b'\n'):
+                    break
+                cut = data.rfind(b'\n')
+                if cut >= 0:
+                    end = start + cut + 1
+                    break
+                end = start
+        if end != size:
+            oplog.warning('Truncating {file} from {size} to {end}', file = os.path.realpath(self.fp.name), size = size, end = end)
+            self.fp.truncate(end)
+            self.fp.seek(end)
+        return end
+
+    def backlog(self):
+        """
+        Bytes appended and not yet delivered, called with the lock held
+        """
+        seg, offset = self.cursor
+        return sum(size for n, size in self.sizes.items() if n >= seg) - offset
+
+    def waiting(self):
+        with self.lock:
+            return self.backlog()
+
+    def append(self, records, fsync):
+        """
+        Add records, forcing them to disk if fsync.  Returns False, adding
+        nothing, if that would take the spool over its limit; an empty
+        spool takes any batch.
+        """
+        data = ''.join(records).encode('utf-8')
+        with self.lock:
+            waiting = self.backlog()
+            if waiting and waiting + len(data) > self.limit:
+                return False
+            self.fp.write(data)
+            self.fp.flush()
+            if fsync:
+                os.fsync(self.fp.fileno())
+            seg = self.segments[-1]
+            self.sizes[seg] = self.sizes[seg] + len(data)
+            if self.sizes[seg] >= SEGMENT_BYTES:
+                self.fp.close()
+                seg = seg + 1
+                self.fp = open(self.path(seg), 'ab')
+                self.segments.append(seg)
+                self.sizes[seg] = 0
+                if fsync:
+                    durability.fsync_dir(self.dirname)
+        return True
+
+    def read(self, rows):
+        """
+        Returns up to rows records after the cursor, each (log, timestamp,
+        line), and the cursor to ack once they are delivered
+        """
+        with self.lock:
+            seg, offset = self.cursor
+            size = self.sizes[seg]
+            last = seg == self.segments[-1]
+        if offset >= size:
+            if last:
+                return [], self.cursor
+            return [], (self.segments[self.segments.index(seg) + 1], 0)
+        records = []
+        with open(self.path(seg), 'rb') as fp:
+            fp.seek(offset)
+            while len(records) < rows and offset < size:
+                data = fp.read(min(READ_BYTES, size - offset))
+                lines = data.splitlines(True)
+                if len(lines) > 1 and not lines[-1].endswith(b'\n'):
+                    lines.pop()
+                elif not lines[-1].endswith(b'\n'):
+                    # One row longer than READ_BYTES
+                    lines = [data + fp.readline()]
+                for line in lines[:rows - len(records)]:
+                    log, timestamp, row = line.decode('utf-8').rstrip('\n').split('\t', 2)
+                    records.append((log, int(timestamp), row))
+                    offset = offset + len(line)
+                fp.seek(offset)
+        return records, (seg, offset)
+
+    def ack(self, cursor):
+        """
+        Record that everything up to cursor was delivered
+        """
+        with open(self.path('cursor.new'), 'w') as fp:
+            fp.write(json.dumps(cursor) + '\n')
+        os.rename(self.path('cursor.new'), self.path('cursor'))
+        with self.lock:
+            self.cursor = tuple(cursor)
+            while self.segments[0] < self.cursor[0]:
+                seg = self.segments.pop(0)
+                del self.sizes[seg]
+                os.unlink(self.path(seg))
+
+    def close(self):
+        self.fp.close()
+
+
+class Spooled_sink(Sink):
+    """
+    A sink sending rows on over the network.  Committed rows are appended
+    to the sink's spool, which is all a watcher waits for; a thread of the
+    sink's own sends them from there in batches of up to batch rows,
+    trying again with a growing delay while the collector is failing.
+    Delivery is at least once: a batch sent just before a crash is sent
+    again afterwards.  A sink that isn't required drops the rows its full
+    spool has no room for instead of holding up the watchers.
+
+    spool:     Spool   -- Rows committed and not yet delivered
+    waiting:   Dict    -- Records written and not yet committed, by log
+    batch:     Integer -- Most rows sent at once
+    rows:      Integer -- Rows delivered since we started
+    sent:      Integer -- Bytes delivered since we started
+    batches:   Integer -- Batches delivered since we started
+    errors:    Integer -- Failed sends
+    dropped:   Integer -- Rows dropped by a sink that isn't required
+    refused:   Integer -- Commits refused by a required sink
+    sends:     Histogram -- Seconds per batch delivered
+    """
+    def __init__(self, name, spooldir, required = True, batch = BATCH, spool_mb = SPOOL_MB):
+        self.name = name
+        self.required = required
+        self.batch = batch
+        self.spool = Spool(os.path.join(spooldir, name), spool_mb << 20)
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.rows = 0
+        self.sent = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+        self.refused = 0
+        self.sends = metrics.Histogram(metrics.CALL_BUCKETS)
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = 'sink ' + name, daemon = True)
+        self.thread.start()
+
+    def write(self, log, rows, lines):
+        records = ['{log}\t{timestamp}\t{line}\n'.format(log = log, timestamp = row.get('timestamp', 0), line = line)
+                   for row, line in zip(rows, lines)]
+        with self.lock:
+            self.waiting.setdefault(log, []).extend(records)
+
+    def commit(self, log, fsync):
+        with self.lock:
+            records = self.waiting.pop(log, None)
+        if not records:
+            return True
+        try:
+            spooled = self.spool.append(records, fsync)
+            error = 'spool full'
+        except OSError as errtxt:
+            spooled = False
+            error = str(errtxt)
+        if spooled:
+            self.wakeup.set()
+            return True
+        if not self.required:
+            with self.lock:
+                self.dropped = self.dropped + len(records)
+            oplog.warning('Sink {sink} dropped {n} rows of {name}: {error}', key = ('sink', self.name),
+                          sink = self.name, n = len(records), name = log, error = error)
+            return True
+        with self.lock:
+            self.waiting[log] = records + self.waiting.get(log, [])
+            self.refused = self.refused + 1
+        oplog.error('Sink {sink} is holding up {name}: {error}', key = ('sink', self.name),
+                    sink = self.name, name = log, error = error)
+        return False
+
+    def run(self):
+        delay = 0
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            records, cursor = self.spool.read(self.batch)
+            if not records:
+                if cursor != self.spool.cursor:
+                    self.spool.ack(cursor)
+                else:
+                    self.wakeup.wait(1.0)
+                continue
+            t0 = time.monotonic()
+            try:
+                n = self.send(records)
+            except Exception as errtxt:
+                self.errors = self.errors + 1
+                self.disconnect()
+                delay = min(RETRY_MAX, delay * 2 or RETRY_MIN)
+                oplog.warning('Sink {sink} failed, retrying in {secs}s: {error}', key = ('sink', self.name),
+                              sink = self.name, secs = delay, error = str(errtxt))
+                self.stopped.wait(delay)
+                continue
+            delay = 0
+            self.sends.observe(time.monotonic() - t0)
+            self.spool.ack(cursor)
+            self.rows = self.rows + len(records)
+            self.sent = self.sent + n
+            self.batches = self.batches + 1
+
+    def send(self, records):
+        """
+        Deliver (log, timestamp, line) records, returns the bytes sent
+        """
+        raise NotImplementedError
+
+    def disconnect(self):
+        pass
+
+    def status(self):
+        """
+        Argus status line for the sink
+        """
+        line = 'sink {name}: sent {rows} rows {sent} bytes in {batches} batches, spooled {waiting} bytes, ' \
+               'errors: {errors} dropped: {dropped} refused: {refused}\n'
+        return line.format(
+            name = self.name, rows = self.rows, sent = self.sent, batches = self.batches, waiting = self.spool.waiting(),
+            errors = self.errors, dropped = self.dropped, refused = self.refused)
+
+    def close(self):
+        """
+        Stop sending; what is left in the spool goes out after a restart
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.disconnect()
+        self.spool.close()
+
+
+class Syslog_sink(Spooled_sink):
+    """
+    RFC 5424 syslog over TCP, or TLS with tls set, one message per row
+    with octet counting framing (RFC 6587).  The message's time stamp is
+    the row's, its MSGID the log's name and its MSG the row's JSON.  TCP
+    syslog has no acknowledgements, so a batch counts as delivered once
+    written to the socket; one the collector closed is noticed before the
+    next batch and the batch goes to a fresh connection.
+    """
+    def __init__(self, name, spooldir, host, port = 514, tls = False, ca_certs = None, facility = FACILITY,
+                 app = 'duo_watcher', **kwargs):
+        self.host = host
+        self.port = port
+        self.context = ssl.create_default_context(cafile = ca_certs) if tls else None
+        self.prefix = '<{pri}>1 '.format(pri = facility * 8 + SEVERITY)
+        self.hostname = socket.gethostname()
+        self.app = app
+        self.sock = None
+        super().__init__(name, spooldir, **kwargs)
+
+    def connect(self):
+        if self.sock is not None:
+            readable, writable, errored = select.select([self.sock], [], [], 0)
+            if not readable:
+                return self.sock
+            self.disconnect()
+        sock = socket.create_connection((self.host, self.port), TIMEOUT)
+        if self.context:
+            sock = self.context.wrap_socket(sock, server_hostname = self.host)
+        self.sock = sock
+        return sock
+
+    def send(self, records):
+        frames = []
+        for log, timestamp, line in records:
+            msg = '{prefix}{ts} {host} {app} {pid} {log} - {line}'.format(
+                prefix = self.prefix, ts = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp)),
+                host = self.hostname, app = self.app, pid = os.getpid(), log = log[:32], line = line).encode('utf-8')
+            frames.append(str(len(msg)).encode('ascii') + b' ' + msg)
+        data = b''.join(frames)
+        self.connect().sendall(data)
+        return len(data)
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class Http_sink(Spooled_sink):
+    """
+    A POST of each batch to url as JSON lines of {"log": name, "event": row},
+    gzipped if gzip is set, with any extra headers.  Anything but a 2xx
+    reply counts as a failure and the batch is sent again.
+    """
+    def __init__(self, name, spooldir, url, headers = None, gzip = False, ca_certs = None, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Sink {name} needs an http or https url'.format(name = name))
+        self.parts = parts
+        self.target = parts.path or '/'
+        if parts.query:
+            self.target = self.target + '?' + parts.query
+        self.headers = dict(headers or {}, **{'Content-Type': 'application/x-ndjson'})
+        if gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.gzip = gzip
+        self.context = ssl.create_default_context(cafile = ca_certs) if parts.scheme == 'https' else None
+        self.conn = None
+        super().__init__(name, spooldir, **kwargs)
+
+    def send(self, records):
+        body = ''.join('{{"log":{log},"event":{line}}}\n'.format(log = json.dumps(log), line = line)
+                       for log, timestamp, line in records).encode('utf-8')
+        if self.gzip:
+            body = gzip.compress(body, 6)
+        if self.conn is None:
+            if self.context:
+                self.conn = http.client.HTTPSConnection(self.parts.hostname, self.parts.port, timeout = TIMEOUT,
+                                                        context = self.context)
+            else:
+                self.conn = http.client.HTTPConnection(self.parts.hostname, self.parts.port, timeout = TIMEOUT)
+        self.conn.request('POST', self.target, body, self.headers)
+        response = self.conn.getresponse()
+        response.read()
+        if response.will_close:
+            self.disconnect()
+        if not 200 <= response.status < 300:
+            raise RuntimeError('HTTP {status} {reason}'.format(status = response.status, reason = response.reason))
+        return len(body)
+
+    def disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+KINDS = {
+    'syslog': Syslog_sink,
+    'http': Http_sink,
+}
+
+
+def make(cf, spooldir = None):
+    """
+    The network sinks described by argus_cf's "sinks" entry, e.g.
+
+        "sinks": {
+            "siem": {"type": "syslog", "host": "siem.example.edu", "port": 6514, "tls": true},
+            "lake": {"type": "http", "url": "https://lake.example.edu/duo", "required": false}
+        }
+
+    each spooled under spooldir/{name}, spooldir being argus_cf's "spool"
+    entry or "spool"
+    """
+    spooldir = spooldir or cf.get('spool', 'spool')
+    made = []
+    for name, spec in sorted(cf.get('sinks', {}).items()):
+        spec = dict(spec)
+        kind = spec.pop('type', None)
+        if kind not in KINDS:
+            raise ValueError('Sink {name} has unknown type {kind}'.format(name = name, kind = kind))
+        made.append(KINDS[kind](name, spooldir, **spec))
+    return made
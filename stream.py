@@ -0,0 +1,246 @@
+"""
+Stream: Fan newly archived Duo log rows out to local subscribers
+"""
+
+import collections
+import hmac
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import archive
+import oplog
+
+# Most rows a subscriber may have waiting before it is sent back to
+# catch up from the archive
+QUEUE_ROWS = 10000
+
+# Seconds a new connection has to send its request
+REQUEST_TIMEOUT = 10
+
+
+class Subscriber:
+    """
+    One subscriber's bounded queue of (timestamp, count, line) entries.
+    The publisher never waits on it: when it would overflow, the queue is
+    emptied and marked as overflowed instead, and the subscriber has to
+    pick up the rows it missed from the archive.
+    """
+    def __init__(self, name, limit = QUEUE_ROWS):
+        self.name = name
+        self.limit = limit
+        self.entries = collections.deque()
+        self.overflowed = False
+        self.cond = threading.Condition()
+
+    def put(self, entries):
+        with self.cond:
+            if self.overflowed:
+                return
+            if len(self.entries) + len(entries) > self.limit:
+                self.entries.clear()
+                self.overflowed = True
+            else:
+                self.entries.extend(entries)
+            self.cond.notify()
+
+    def get(self, timeout = None):
+        """
+        Returns the waiting entries, or None if we overflowed
+        """
+        with self.cond:
+            if not self.entries and not self.overflowed:
+                self.cond.wait(timeout)
+            if self.overflowed:
+                return None
+            entries = list(self.entries)
+            self.entries.clear()
+            return entries
+
+
+class Bus:
+    """
+    Carries rows from the LogWatchers to the subscribers of their logs.
+
+    heads:     Dict    -- Position (timestamp, count) of the last row
+                          published for each log, by name
+    paths:     Dict    -- Archive directory of each log, by name
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.heads = {}
+        self.paths = {}
+
+    def register(self, name, path, head):
+        with self.lock:
+            self.paths[name] = path
+            self.heads[name] = tuple(head)
+
+    def publish(self, name, entries):
+        """
+        Hand out (timestamp, count, line) entries for rows of log name that
+        are archived and accounted for in its state file
+        """
+        if not entries:
+            return
+        with self.lock:
+            self.heads[name] = entries[-1][:2]
+            subscribers = [sub for sub in self.subscribers if sub.name == name]
+        for sub in subscribers:
+            sub.put(entries)
+
+    def subscribe(self, name):
+        """
+        Returns a new Subscriber to log name and the position of the last
+        row published before it started listening
+        """
+        sub = Subscriber(name)
+        with self.lock:
+            self.subscribers.append(sub)
+            return sub, self.heads[name]
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def status(self):
+        with self.lock:
+            return 'stream: {n} subscribers\n'.format(n = len(self.subscribers))
+
+
+def replay(path, position, head):
+    """
+    Yield (timestamp, count, line) for the archived rows after position up
+    to and including head, positions being (timestamp, count) as in the
+    state files
+    """
+    prev = None
+    count = 0
+    for fname in archive.files(path, position[0], head[0] + 1):
+        for chunk in archive.read_chunks(fname, position[0], head[0] + 1):
+            for line in chunk.splitlines(True):
+                timestamp = json.loads(line).get('timestamp', 0)
+                if timestamp < position[0]:
+                    continue
+                if timestamp == prev:
+                    count = count + 1
+                else:
+                    prev = timestamp
+                    count = 1
+                if (timestamp, count) <= tuple(position):
+                    continue
+                if (timestamp, count) > tuple(head):
+                    return
+                yield (timestamp, count, line)
+
+
+def frame(entry):
+    """
+    The wire form of an entry: a JSON array of timestamp, count and row
+    """
+    line = entry[2].rstrip(b'\n') if isinstance(entry[2], bytes) else entry[2].encode('utf-8')
+    return b'[%d,%d,%s]\n' % (entry[0], entry[1], line)
+
+
+class Stream_handler(socketserver.StreamRequestHandler):
+    """
+    Serves one subscriber.  The client sends a JSON line naming the log and
+    optionally a position to resume after, e.g.
+
+        {"log": "auth", "resume": [1598932352, 2]}
+
+    and then receives [timestamp, count, row] lines: first the archived rows
+    after the resume position, then new rows as they are archived.  The
+    last timestamp and count received make the resume position for the
+    next connection.  A server with a secret, such as the one the HA
+    instances follow each other on, also wants it in the request, as
+    "secret", and refuses the connection without it.
+    """
+    def handle(self):
+        bus = self.server.bus
+        self.request.settimeout(REQUEST_TIMEOUT)
+        try:
+            request = json.loads(self.rfile.readline() or b'{}')
+            name = request['log']
+            if not self.allowed(request):
+                oplog.warning('Refused a stream subscriber from {peer}: wrong secret', key = ('stream', 'secret'),
+                              peer = self.client_address[0] if isinstance(self.client_address, tuple) else 'the Unix socket')
+                self.wfile.write(b'{"error": "wrong secret"}\n')
+                return
+            path = bus.paths[name]
+        except (ValueError, KeyError, TypeError, socket.timeout):
+            self.wfile.write(b'{"error": "expecting {\\"log\\": name, \\"resume\\": [timestamp, count]}"}\n')
+            return
+        self.request.settimeout(None)
+
+        position = request.get('resume')
+        if position is not None:
+            position = tuple(position)
+        try:
+            while True:
+                sub, head = bus.subscribe(name)
+                try:
+                    if position is None:
+                        position = head
+                    for entry in replay(path, position, head):
+                        self.wfile.write(frame(entry))
+                        position = entry[:2]
+                    self.wfile.flush()
+                    position = max(position, head)
+
+                    while True:
+                        entries = sub.get()
+                        if entries is None:
+                            break
+                        data = [frame(entry) for entry in entries if entry[:2] > position]
+                        if data:
+                            self.wfile.write(b''.join(data))
+                            self.wfile.flush()
+                            position = entries[-1][:2]
+                finally:
+                    bus.unsubscribe(sub)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def allowed(self, request):
+        """
+        Whether request carries the server's secret, if it has one
+        """
+        secret = self.server.secret
+        if not secret:
+            return True
+        return hmac.compare_digest(str(request.get('secret', '')).encode('utf-8'), secret.encode('utf-8'))
+
+
+class TCP_server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Unix_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(bus, addr = None, port = None, path = None, secret = None):
+    """
+    Start serving subscribers on a TCP port, on addr or else localhost,
+    and/or a Unix socket in the background, returns the servers.  With a
+    secret, only subscribers that send it are served.
+    """
+    servers = []
+    if port:
+        servers.append(TCP_server((addr or '127.0.0.1', port), Stream_handler))
+    if path:
+        if os.path.exists(path):
+            os.remove(path)
+        servers.append(Unix_server(path, Stream_handler))
+    for server in servers:
+        server.bus = bus
+        server.secret = secret
+        threading.Thread(target = server.serve_forever, name = 'stream', daemon = True).start()
+        oplog.info('Streaming on {where}', where = server.server_address)
+    return servers
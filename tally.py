@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+"""
+Tally: Hourly counts and approximate distinct users of the authentication
+logs, kept up to date as rows are archived so questions like "failures per
+application per hour" don't need a scan of the archive.
+
+Each day's tally is kept in {log}/%y%m%d.tally next to its daily file:
+
+    tally.py -d 261018 -b hour,result auth
+    tally.py -b application -w result=denied -n 10 auth
+    tally.py -R -d 261001 -e 261017 auth      # tally days from before -g
+"""
+
+import argparse
+import base64
+import functools
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+import zlib
+
+import archive
+import durability
+import oplog
+import sinks
+import stream
+
+# What rows are counted by
+FIELDS = ('hour', 'result', 'reason', 'factor', 'application')
+
+# HyperLogLog precision: 2**P registers of a byte, a standard error of
+# 1.04 / sqrt(2**P), about 1.6%
+P = 12
+
+# Most seconds between checkpoints of the day being archived
+EVERY = 60
+
+# Rows listed by default
+TOP = 20
+
+
+class Hll:
+    """
+    A HyperLogLog sketch of a set of strings: how many distinct ones were
+    added, to within a couple of percent, in 2**P bytes whatever the count
+
+    registers: Bytearray -- Most leading zeros seen, plus one, per bucket
+    """
+    m = 1 << P
+    alpha = 0.7213 / (1 + 1.079 / (1 << P))
+
+    def __init__(self, registers = None):
+        self.registers = registers or bytearray(self.m)
+
+    def add(self, value):
+        self.mark(*sketch(value))
+
+    def mark(self, bucket, rank):
+        if rank > self.registers[bucket]:
+            self.registers[bucket] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def estimate(self):
+        zeros = self.registers.count(0)
+        if zeros == self.m:
+            return 0
+        raw = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        if raw <= 2.5 * self.m and zeros:
+            # Linear counting is better while many buckets are empty
+            return int(round(self.m * math.log(float(self.m) / zeros)))
+        return int(round(raw))
+
+    def dump(self):
+        return base64.b64encode(zlib.compress(bytes(self.registers))).decode('ascii')
+
+    @classmethod
+    def load(cls, text):
+        return cls(bytearray(zlib.decompress(base64.b64decode(text))))
+
+
+@functools.lru_cache(maxsize = 1 << 16)
+def sketch(value):
+    """
+    The (bucket, rank) a string marks in a sketch: the top P bits of its
+    64 bit hash, and one more than the leading zeros of the rest.  Cached,
+    as the same users turn up all day.
+    """
+    h = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size = 8).digest(), 'big')
+    rest = h & ((1 << (64 - P)) - 1)
+    return h >> (64 - P), (64 - P) - rest.bit_length() + 1
+
+
+# (result, reason, factor, application, user) of a row, kept on
+# archive.Rows as pages.py decodes them so they aren't decoded again
+facts = archive.row_facts
+
+
+def failed(result):
+    return bool(result) and result.lower() != 'success'
+
+
+class Tally:
+    """
+    What one day of an authentication log adds up to
+
+    day:       String  -- The day, %y%m%d
+    position:  Tuple   -- (timestamp, count) of the last row counted, as in
+                          the state files
+    rows:      Integer -- Rows counted
+    counts:    Dict    -- Rows by (hour, result, reason, factor, application)
+    users:     Hll     -- Users of the day
+    hours:     Dict    -- Hll of the users of each hour
+    applications: Dict -- Hll of the users of each application
+    failures:  Dict    -- Rows by (user, result) for results other than success
+    """
+    def __init__(self, day):
+        self.day = day
+        self.position = (0, 0)
+        self.rows = 0
+        self.counts = {}
+        self.users = Hll()
+        self.hours = {}
+        self.applications = {}
+        self.failures = {}
+        self.last = (None, 0)
+
+    def add(self, row, timestamp):
+        """
+        Count a row archived after everything counted so far
+        """
+        if timestamp == self.position[0]:
+            self.position = (timestamp, self.position[1] + 1)
+        else:
+            self.position = (timestamp, 1)
+        if self.last[0] != timestamp:
+            self.last = (timestamp, time.localtime(timestamp).tm_hour)
+        hour = self.last[1]
+        result, reason, factor, application, user = facts(row)
+        key = (hour, result, reason, factor, application)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.rows = self.rows + 1
+        if user:
+            mark = sketch(user)
+            self.users.mark(*mark)
+            if hour not in self.hours:
+                self.hours[hour] = Hll()
+            self.hours[hour].mark(*mark)
+            if application not in self.applications:
+                self.applications[application] = Hll()
+            self.applications[application].mark(*mark)
+            if failed(result):
+                self.failures[(user, result)] = self.failures.get((user, result), 0) + 1
+
+    def dump(self):
+        return {
+            'day': self.day,
+            'position': list(self.position),
+            'rows': self.rows,
+            'counts': [list(key) + [n] for key, n in sorted(self.counts.items())],
+            'users': self.users.dump(),
+            'hours': dict((str(hour), hll.dump()) for hour, hll in sorted(self.hours.items())),
+            'applications': dict((name, hll.dump()) for name, hll in sorted(self.applications.items())),
+            'failures': [list(key) + [n] for key, n in sorted(self.failures.items())],
+        }
+
+    @classmethod
+    def load(cls, obj):
+        tally = cls(obj['day'])
+        tally.position = tuple(obj['position'])
+        tally.rows = obj['rows']
+        tally.counts = dict((tuple(entry[:-1]), entry[-1]) for entry in obj['counts'])
+        tally.users = Hll.load(obj['users'])
+        tally.hours = dict((int(hour), Hll.load(text)) for hour, text in obj['hours'].items())
+        tally.applications = dict((name, Hll.load(text)) for name, text in obj['applications'].items())
+        tally.failures = dict((tuple(entry[:-1]), entry[-1]) for entry in obj['failures'])
+        return tally
+
+    def report(self, by = ('hour',), where = None, top = TOP):
+        """
+        The rows counted grouped by the FIELDS in by, for those matching the
+        field values in where, biggest groups first, at most top of them.
+        Without where, groups by hour alone or by application alone also
+        give their distinct users.  The users with the most failures come
+        too, of the result in where if there is one.
+        """
+        where = where or {}
+        for field in list(by) + list(where):
+            if field not in FIELDS:
+                raise ValueError('Unknown field {field}, expecting one of {fields}'.format(field = field, fields = ', '.join(FIELDS)))
+        picks = [FIELDS.index(field) for field in by]
+        wanted = [(FIELDS.index(field), int(value) if field == 'hour' else value) for field, value in where.items()]
+        groups = {}
+        for key, n in self.counts.items():
+            if all(key[i] == value for i, value in wanted):
+                group = tuple(key[i] for i in picks)
+                groups[group] = groups.get(group, 0) + n
+        sketches = None
+        if not where:
+            sketches = self.hours if tuple(by) == ('hour',) else self.applications if tuple(by) == ('application',) else None
+        out = []
+        for group, n in sorted(groups.items(), key = lambda item: (-item[1], item[0]))[:top]:
+            entry = dict(zip(by, group))
+            entry['rows'] = n
+            if sketches is not None and group[0] in sketches:
+                entry['users'] = sketches[group[0]].estimate()
+            out.append(entry)
+        results = [value for i, value in wanted if FIELDS[i] == 'result']
+        failures = [{'user': user, 'result': result, 'rows': n} for (user, result), n in self.failures.items()
+                    if not results or result in results]
+        failures.sort(key = lambda entry: (-entry['rows'], entry['user']))
+        return {
+            'day': self.day,
+            'rows': self.rows,
+            'users': self.users.estimate(),
+            'position': list(self.position),
+            'groups': out,
+            'failures': failures[:top],
+        }
+
+
+def day_of(timestamp):
+    return time.strftime('%y%m%d', time.localtime(timestamp))
+
+
+def day_start(day):
+    return time.mktime(time.strptime(day, '%y%m%d'))
+
+
+def path(dirname, day):
+    return os.path.join(dirname, day + '.tally')
+
+
+def load(dirname, day):
+    """
+    The checkpointed Tally of a day, or None
+    """
+    try:
+        with open(path(dirname, day)) as fp:
+            return Tally.load(json.load(fp))
+    except FileNotFoundError:
+        return None
+
+
+def save(dirname, tally, fsync = True):
+    fname = path(dirname, tally.day)
+    with open(fname + '.new', 'w') as fp:
+        fp.write(json.dumps(tally.dump(), separators = (',', ':')) + '\n')
+        if fsync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.rename(fname + '.new', fname)
+    if fsync:
+        durability.fsync_dir(dirname)
+
+
+def catch_up(dirname, tally, head = None):
+    """
+    Count the archived rows of tally's day after its position, up to and
+    including head if given.  Returns how many there were.
+    """
+    start = day_start(tally.day)
+    end = archive.day_bounds(start)[1]
+    position = tally.position if tally.position[0] >= start else (start, 0)
+    head = head or (end - 1, float('inf'))
+    n = 0
+    for timestamp, count, line in stream.replay(dirname, position, head):
+        if timestamp >= end:
+            break
+        tally.add(json.loads(line), timestamp)
+        n = n + 1
+    return n
+
+
+def current(dirname, day):
+    """
+    A day's Tally with the rows archived since its last checkpoint counted
+    too, built from the archive if it has none.  Returns None for a day
+    with no tally and no rows.
+    """
+    tally = load(dirname, day) or Tally(day)
+    if not catch_up(dirname, tally) and not tally.rows:
+        return None
+    return tally
+
+
+class Tally_sink(sinks.Sink):
+    """
+    Keeps the tally of a watcher's log as rows are archived.  Each row is
+    counted as it is written; the day's tally is checkpointed when the
+    watcher commits, at most every EVERY seconds, and once the day is
+    over.  Only the File_sink comes before us, so a checkpoint never
+    counts a row the archive could still lose.  After a restart the rows
+    archived since the last checkpoint are counted again from the archive.
+
+    tally:     Tally   -- The day being archived, or None before any rows
+    end:       time_t  -- Midnight ending that day
+    finished:  List    -- Tallies of days that are over, to save at commit
+    saved:     Float   -- Monotonic time of our last checkpoint
+    """
+    name = 'tally'
+    required = False
+
+    def __init__(self, dirname, head):
+        self.dirname = dirname
+        self.lock = threading.Lock()
+        self.tally = None
+        self.end = 0
+        self.finished = []
+        self.saved = time.monotonic()
+        if head[0]:
+            self.advance(head[0])
+            if tuple(self.tally.position) > tuple(head):
+                # Counted rows the archive lost; count the day again
+                self.tally = Tally(self.tally.day)
+            n = catch_up(dirname, self.tally, head)
+            if n:
+                oplog.info('Counted {n} rows of {dirname} archived since its last tally', n = n, dirname = dirname)
+
+    def advance(self, timestamp):
+        """
+        Move on to the day holding timestamp
+        """
+        day = day_of(timestamp)
+        self.tally = load(self.dirname, day) or Tally(day)
+        self.end = archive.day_bounds(timestamp)[1]
+
+    def write(self, log, rows, lines):
+        with self.lock:
+            for row in rows:
+                timestamp = row.get('timestamp', 0)
+                if self.tally is None or timestamp >= self.end:
+                    if self.tally is not None:
+                        self.finished.append(self.tally)
+                    self.advance(timestamp)
+                self.tally.add(row, timestamp)
+
+    def commit(self, log, fsync, force = False):
+        with self.lock:
+            due = self.finished
+            if self.tally is not None and (force or due or time.monotonic() - self.saved >= EVERY):
+                due = due + [self.tally]
+            self.finished = []
+            try:
+                for tally in due:
+                    save(self.dirname, tally, fsync)
+            except OSError as errtxt:
+                oplog.error('Unable to save the tally of {dirname}: {error}', dirname = self.dirname, error = str(errtxt))
+                return True
+            if due:
+                self.saved = time.monotonic()
+        return True
+
+    def report(self, day = None, by = ('hour',), where = None, top = TOP):
+        """
+        Report on day, from memory for the day being archived and from its
+        checkpoint for any other, saved once the day was over.  We answer
+        on the Argus' thread, so never replay the archive here; days from
+        before tallying began have no checkpoint until tally.py -R.
+        """
+        with self.lock:
+            if self.tally is not None and (day is None or day == self.tally.day):
+                return self.tally.report(by, where, top)
+        tally = load(self.dirname, day or day_of(time.time()))
+        return tally.report(by, where, top) if tally else None
+
+    def close(self):
+        self.commit(None, True, force = True)
+
+
+def render(report):
+    """
+    A report as text, a line per group
+    """
+    if report is None:
+        return 'Nothing tallied\n'
+    lines = ['{day}: {rows} rows, about {users} users\n'.format(day = report['day'], rows = report['rows'], users = report['users'])]
+    for entry in report['groups']:
+        fields = ' '.join('{key}={value}'.format(key = key, value = value) for key, value in entry.items() if key not in ('rows', 'users'))
+        users = ' (about {n} users)'.format(n = entry['users']) if 'users' in entry else ''
+        lines.append('  {fields}: {rows}{users}\n'.format(fields = fields or 'all', rows = entry['rows'], users = users))
+    if report['failures']:
+        lines.append('Most failures:\n')
+        for entry in report['failures']:
+            lines.append('  {user} {result}: {rows}\n'.format(**entry))
+    return ''.join(lines)
+
+
+def parse(words):
+    """
+    (day, by, where, top, as_json) from the words of a tally query:
+    [day] [by f1,f2] [where k=v,...] [top N] [json]
+    """
+    day = None
+    by = ('hour',)
+    where = {}
+    top = TOP
+    as_json = False
+    words = list(words)
+    while words:
+        word = words.pop(0)
+        if word == 'by' and words:
+            by = tuple(field for field in words.pop(0).split(',') if field)
+        elif word == 'where' and words:
+            for pair in words.pop(0).split(','):
+                key, sep, value = pair.partition('=')
+                if not sep:
+                    raise ValueError('Expecting field=value, not {pair}'.format(pair = pair))
+                where[key] = value
+        elif word == 'top' and words:
+            top = int(words.pop(0))
+        elif word == 'json':
+            as_json = True
+        elif len(word) == 6 and word.isdigit():
+            day = word
+        else:
+            raise ValueError('Unexpected {word}'.format(word = word))
+    return day, by, where, top, as_json
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Report or rebuild the daily tallies of authentication logs')
+    ap.add_argument('-d', help='Day to report on, %%y%%m%%d (default today)')
+    ap.add_argument('-e', help='With -R, last day to rebuild (default -d)')
+    ap.add_argument('-b', default='hour', help='Fields to group by, of ' + ','.join(FIELDS) + ' (default hour)')
+    ap.add_argument('-w', action='append', default=[], help='Only rows with this field=value (repeatable)')
+    ap.add_argument('-n', type=int, default=TOP, help='Most groups and users listed (default {n})'.format(n = TOP))
+    ap.add_argument('-j', action='store_true', help='Print JSON')
+    ap.add_argument('-R', action='store_true', help='Tally the days from -d to -e again from the archive and save them')
+    ap.add_argument('dirs', nargs='+', help='Log directories, e.g. auth')
+    arg = ap.parse_args()
+
+    day = arg.d or day_of(time.time())
+    if arg.R:
+        t = day_start(day)
+        end = day_start(arg.e or day)
+        while t <= end:
+            d = day_of(t)
+            for dirname in arg.dirs:
+                tally = Tally(d)
+                catch_up(dirname, tally)
+                if tally.rows:
+                    save(dirname, tally)
+                    print('{dirname} {day}: {rows} rows'.format(dirname = dirname, day = d, rows = tally.rows))
+            t = archive.day_bounds(t)[1]
+        return 0
+
+    words = ['by', arg.b] + (['where', ','.join(arg.w)] if arg.w else []) + ['top', str(arg.n)]
+    try:
+        day, by, where, top, as_json = parse([day] + words)
+    except ValueError as errtxt:
+        ap.error(str(errtxt))
+    for dirname in arg.dirs:
+        tally = current(dirname, day)
+        try:
+            report = tally.report(by, where, top) if tally else None
+        except ValueError as errtxt:
+            ap.error(str(errtxt))
+        if arg.j:
+            print(json.dumps({'log': dirname, 'report': report}))
+        else:
+            print('{dirname} '.format(dirname = dirname) + render(report), end = '')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
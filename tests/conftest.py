@@ -0,0 +1,12 @@
+"""
+The modules live at the top of the repository and the fake Duo log in
+benchmarks, so both go on the path
+"""
+
+import os
+import sys
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, os.path.join(TOP, 'benchmarks'))
+sys.path.insert(0, TOP)
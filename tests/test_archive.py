@@ -0,0 +1,58 @@
+"""
+DailyArchive.recover cuts a daily file back to what was complete when
+we went down
+"""
+
+import os
+import random
+import time
+
+import archive
+import replay
+
+# Noon, so the rows stay within a day
+START = int(time.mktime((2020, 9, 1, 12, 0, 0, 0, 0, -1)))
+
+
+def lines(fname):
+    return b''.join(archive.read_chunks(fname)).splitlines()
+
+
+def test_partial_line(tmp_path):
+    rows = replay.generate(1500, START, False, random.Random(3))
+    writer = archive.DailyArchive(str(tmp_path))
+    writer.write(rows[:1000])
+    writer.flush()
+    fname = writer.fname
+    # Lines that made it to the file but not the index, and a partial one
+    with open(fname, 'ab') as fp:
+        fp.write(''.join(archive.encode(row) + '\n' for row in rows[1000:1010]).encode('utf-8'))
+        fp.write(archive.encode(rows[1010])[:20].encode('utf-8'))
+
+    writer = archive.DailyArchive(str(tmp_path))
+    writer.write(rows[1010:])
+    writer.close()
+    assert lines(fname) == [archive.encode(row).encode('utf-8') for row in rows]
+    assert sum(entry['rows'] for entry in archive.load_index(fname)) == len(rows)
+
+
+def test_truncated_frame(tmp_path):
+    rows = replay.generate(2500, START, False, random.Random(4))
+    writer = archive.DailyArchive(str(tmp_path), 'gz')
+    writer.write(rows[:1200])
+    writer.flush()
+    fname = writer.fname
+    size = os.path.getsize(fname)
+    # Half of a frame that never made it to the index
+    with open(fname, 'ab') as fp:
+        fp.write(archive.compressor('gz')(b'{"timestamp": 0}\n' * 100)[:50])
+
+    writer = archive.DailyArchive(str(tmp_path), 'gz')
+    writer.write(rows[1200:1300])
+    assert os.path.getsize(fname) == size
+    # The rows waiting in the tail came back
+    assert len(writer.pending) == 300
+    writer.write(rows[1300:])
+    writer.close()
+    assert lines(fname) == [archive.encode(row).encode('utf-8') for row in rows]
+    assert not os.path.exists(fname + '.tail')
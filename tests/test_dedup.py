@@ -0,0 +1,63 @@
+"""
+dedup.Window picks out the rows a fetch gets back again
+"""
+
+import collections
+import json
+import random
+
+import dedup
+import duo_watcher
+import replay
+
+
+def row(timestamp, username = 'admin0', action = 'admin_login'):
+    return {'timestamp': timestamp, 'username': username, 'action': action}
+
+
+def test_reordered_second():
+    window = dedup.Window()
+    first = [row(10), row(11, 'admin1'), row(11), row(11)]
+    assert window.filter(first) == first
+    # The same second back in another order, with one more identical row
+    again = [row(11), row(11, 'admin1'), row(11), row(11)]
+    assert window.filter(again) == [row(11)]
+    assert window.timestamp == 11
+    assert len(window.dump()) == 4
+
+
+def test_overlapping_seconds():
+    window = dedup.Window()
+    window.filter([row(10), row(11), row(12, 'admin1')])
+    # A page starting a few seconds before mintime
+    fresh = window.filter([row(13), row(9), row(12, 'admin1'), row(10), row(12, 'admin2')])
+    assert fresh == [row(12, 'admin2'), row(13)]
+    assert window.timestamp == 13
+    assert window.filter([row(13)]) == []
+
+
+def test_after_cursor():
+    window = dedup.Window()
+    window.filter([row(10)])
+    # Rows after a v2 cursor are all new, and are remembered
+    assert window.filter([row(10, 'admin1')], after = True) == [row(10, 'admin1')]
+    assert window.filter([row(10, 'admin1'), row(10)]) == []
+
+
+def test_fake_log():
+    """
+    Every row of a reordering, overlapping fake log is let through once
+    """
+    rng = random.Random(1)
+    rows = replay.generate(3000, 1600000000, False, rng)
+    api = replay.Fake(rows, 0.5, rng)
+    window = dedup.Window()
+    got = []
+    for i in range(200):
+        params = {'mintime': str(window.timestamp)}
+        page = api.parse_json_response(*api.api_call('GET', '/admin/v1/logs/administrator', params))
+        got.extend(window.filter(page))
+        if api.visible == len(rows) and len(page) < duo_watcher.V1_PAGE_LIMIT:
+            break
+    expected = collections.Counter(json.dumps(row, sort_keys = True) for row in rows)
+    assert collections.Counter(json.dumps(row, sort_keys = True) for row in got) == expected
@@ -0,0 +1,97 @@
+"""
+LogWatcher.reconcile brings a state file back in line with the archive
+after a crash, and fetching on from there archives every row once
+"""
+
+import collections
+import json
+import os
+import random
+import time
+
+import archive
+import duo_watcher
+import durability
+import ratelimit
+import replay
+
+# Noon, so the rows stay within a day
+START = int(time.mktime((2020, 9, 1, 12, 0, 0, 0, 0, -1)))
+
+
+def watcher(dirname, api):
+    return duo_watcher.LogWatcher('test', 'administrator', api, path = dirname, limiter = ratelimit.TokenBucket('test', 1e9, 1e9),
+                                  policy = durability.Policy('none'))
+
+
+def split(rows, n):
+    """
+    The index of the first row of a second at or after n, as a page never
+    ends part way through a second
+    """
+    while 0 < n < len(rows) and rows[n]['timestamp'] == rows[n - 1]['timestamp']:
+        n = n + 1
+    return n
+
+
+def drain(handle, api):
+    for i in range(100):
+        if not handle.fetch() and api.visible == len(api.rows):
+            break
+    handle.save_state(force = True)
+    handle.writer.close()
+
+
+def archived_once(dirname, rows):
+    expected = collections.Counter(archive.encode(row).encode('utf-8') for row in rows)
+    return replay.archived(dirname) == expected
+
+
+def setup(tmp_path):
+    rng = random.Random(2)
+    rows = replay.generate(3000, START, False, rng)
+    return str(tmp_path / 'test'), rows, replay.Fake(rows, 0.3, rng)
+
+
+def test_roll_forward(tmp_path):
+    dirname, rows, api = setup(tmp_path)
+    a = split(rows, 1000)
+    b = split(rows, 1500)
+    handle = watcher(dirname, api)
+    handle.archive(rows[:a])
+    handle.save_state(force = True)
+    # Crash with rows archived but not committed
+    handle.archive(rows[a:b])
+    handle.writer.flush()
+
+    handle = watcher(dirname, api)
+    assert (handle.state['timestamp'], handle.state['count']) == durability.tail(dirname)[:2]
+    assert handle.state['timestamp'] == rows[b - 1]['timestamp']
+    drain(handle, api)
+    assert archived_once(dirname, rows)
+
+
+def test_roll_back(tmp_path):
+    dirname, rows, api = setup(tmp_path)
+    a = split(rows, 1000)
+    b = split(rows, 1500)
+    handle = watcher(dirname, api)
+    handle.archive(rows[:a])
+    handle.save_state(force = True)
+    handle.archive(rows[a:b])
+    handle.save_state(force = True)
+    handle.writer.close()
+
+    # The state file survived a crash but the last chunk didn't
+    fname = os.path.join(dirname, time.strftime('%y%m%d', time.localtime(START)))
+    index = archive.load_index(fname)
+    with open(fname + '.idx', 'w') as fp:
+        fp.write(''.join(json.dumps(entry) + '\n' for entry in index[:-1]))
+    os.truncate(fname, index[-1]['offset'])
+
+    handle = watcher(dirname, api)
+    assert handle.state['timestamp'] == rows[a - 1]['timestamp']
+    assert handle.state['count'] == sum(1 for row in rows[:a] if row['timestamp'] == rows[a - 1]['timestamp'])
+    assert 'seen' not in handle.state
+    drain(handle, api)
+    assert archived_once(dirname, rows)
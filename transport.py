@@ -0,0 +1,157 @@
+"""
+Transport: Pooled keep-alive connections for the Duo Admin API
+"""
+
+import duo_client
+import http.client
+import threading
+import time
+
+# Seconds we trust an idle connection to still be open at the far end
+IDLE_TIMEOUT = 55
+
+# Most connections to one API host in use at once
+MAX_CONNECTIONS = 4
+
+# Errors meaning the server dropped a kept-alive connection on us
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Keeps the idle keep-alive connections to one API host for reuse and
+    caps the number of connections in use at once.  Shared by every
+    client (and so every thread) talking to that host.
+
+    host:      String  -- API host name
+    idle:      List    -- (connection, time it went idle), newest last
+    created:   Integer -- Connections opened
+    reused:    Integer -- Requests sent on an already open connection
+    stale:     Integer -- Reused connections the server had already closed
+    """
+    def __init__(self, host, maxconn = MAX_CONNECTIONS, timeout = IDLE_TIMEOUT):
+        self.host = host
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.busy = 0
+        self.created = 0
+        self.reused = 0
+        self.stale = 0
+
+    def get(self):
+        """
+        Wait for a free slot and return an idle connection, or None if the
+        caller should open a new one
+        """
+        self.slots.acquire()
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self.lock:
+            self.busy = self.busy + 1
+            while self.idle:
+                conn, since = self.idle.pop()
+                if now - since < self.timeout:
+                    self.reused = self.reused + 1
+                    break
+                expired.append(conn)
+                conn = None
+            if conn is None:
+                self.created = self.created + 1
+        for old in expired:
+            old.close()
+        return conn
+
+    def put(self, conn, reusable):
+        """
+        Give back the slot taken by get() along with its connection, None
+        if opening one failed
+        """
+        if reusable:
+            with self.lock:
+                self.idle.append((conn, time.monotonic()))
+                self.busy = self.busy - 1
+        else:
+            if conn is not None:
+                conn.close()
+            with self.lock:
+                self.busy = self.busy - 1
+        self.slots.release()
+
+    def status(self):
+        return '{host}: {idle} idle {busy} busy created: {created} reused: {reused} stale: {stale}'.format(
+            host = self.host, idle = len(self.idle), busy = self.busy,
+            created = self.created, reused = self.reused, stale = self.stale)
+
+
+def pool_for(host):
+    """
+    Returns the connection pool for an API host
+    """
+    with pools_lock:
+        if host not in pools:
+            pools[host] = ConnectionPool(host)
+        return pools[host]
+
+
+def status():
+    """
+    Argus status lines for all our pools
+    """
+    return ''.join('pool {status}\n'.format(status = pools[host].status()) for host in sorted(pools))
+
+
+class PooledAdmin(duo_client.Admin):
+    """
+    A duo_client.Admin that sends its requests over the kept-alive
+    connections of its host's ConnectionPool instead of opening a new
+    connection (and doing a new TLS handshake) for every call
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool_for(self.host)
+        self.local = threading.local()
+
+    def api_call(self, method, path, params, consume = None):
+        """
+        duo_client's api_call, except that with consume the body of a 200
+        is handed to consume to read as it comes in, and what consume
+        returns takes the place of the body
+        """
+        self.local.consume = consume
+        try:
+            return super().api_call(method, path, params)
+        finally:
+            self.local.consume = None
+
+    def _make_request(self, method, uri, body, headers):
+        consume = getattr(self.local, 'consume', None)
+        while True:
+            conn = self.pool.get()
+            reused = conn is not None
+            try:
+                if not reused:
+                    conn = self._connect()
+                conn.request(method, uri, body, headers)
+                response = conn.getresponse()
+                if consume is not None and response.status == 200:
+                    data = consume(response)
+                else:
+                    data = response.read()
+            except STALE_ERRORS:
+                self.pool.put(conn, False)
+                if reused and method == 'GET':
+                    with self.pool.lock:
+                        self.pool.stale = self.pool.stale + 1
+                    continue
+                raise
+            except Exception:
+                self.pool.put(conn, False)
+                raise
+            self.pool.put(conn, not response.will_close)
+            return (response, data)